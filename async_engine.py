@@ -0,0 +1,159 @@
+from __future__ import print_function
+
+# asyncio based request engine for the profiler.
+# grequests gives every request its own session, so each query pays for a fresh TCP (and TLS) handshake.
+# Here a fixed number of worker coroutines share one aiohttp session whose connector keeps HTTP/1.1
+# connections alive and hands them back out, so the handshake is paid once per connection instead of
+# once per query. Requires Python 3 and aiohttp; otpprofiler falls back to grequests without them.
+
+import asyncio
+import json
+import random
+import time
+
+import aiohttp
+
+KEEPALIVE_TIMEOUT = 60  # seconds an idle connection is kept open for reuse
+CONNECT_TIMEOUT = 30  # seconds
+STOP_POLL_INTERVAL = 0.1  # seconds between checks of the stop flag
+
+
+class Response(object):
+    """The subset of requests.Response that the profiler response callbacks use.
+    sent and received are epoch timestamps taken just before the request is issued
+    and just after the full body has been read. In open-loop runs scheduled is the epoch
+    time the request was meant to be sent at, otherwise it is None."""
+
+    # the connection is owned by the session pool, so there is nothing for callbacks to close
+    connection = None
+
+    def __init__(self, url, status_code, content, sent, received, scheduled=None):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+        self.sent = sent
+        self.received = received
+        self.scheduled = scheduled
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def __repr__(self):
+        return '<Response [%s]>' % self.status_code
+
+
+async def _wait(tasks, stop):
+    """Wait for tasks to finish. Once stop (a threading.Event or anything else with is_set) is set the tasks still
+    running are cancelled, so requests in flight are abandoned instead of waited for. Raises the first task error."""
+    tasks = list(tasks)
+    running = tasks
+    while running:
+        done, running = await asyncio.wait(running, timeout=STOP_POLL_INTERVAL)
+        failed = [task for task in done if not task.cancelled() and task.exception() is not None]
+        if running and (failed or (stop is not None and stop.is_set())):
+            for task in running:
+                task.cancel()
+            await asyncio.wait(running)
+            running = ()
+        if failed:
+            raise failed[0].exception()
+
+
+async def _worker(session, jobs, headers, stop):
+    # jobs is a plain iterator shared by all workers. That is safe because next() never awaits.
+    for url, callback in jobs:
+        if stop is not None and stop.is_set():
+            break
+        sent = time.time()
+        async with session.get(url, headers=headers) as r:
+            content = await r.read()
+            status_code = r.status
+        callback(Response(url, status_code, content, sent, time.time()))
+
+
+async def _fetch_all(jobs, concurrency, headers, stop):
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=concurrency,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT)
+    # no total timeout, to match requests: a slow plan is a measurement, not an error
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT)
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        await _wait([asyncio.ensure_future(_worker(session, jobs, headers, stop)) for i in range(concurrency)], stop)
+
+
+def fetch_all(jobs, concurrency=5, headers=None, stop=None):
+    """Fetch an iterable of (url, callback) pairs with at most concurrency requests in flight,
+    calling callback(response) as each body arrives. Any exception aborts the whole batch.
+    Setting the stop event, e.g. from a callback, drops the remaining jobs and cancels the requests in flight."""
+    asyncio.run(_fetch_all(iter(jobs), concurrency, headers, stop))
+
+
+# Open-loop load.
+# fetch_all is closed-loop: a worker only sends its next request when the previous one has finished,
+# so a slow server lowers the offered load and the queueing it causes never shows up in the numbers.
+# Here requests leave on a fixed arrival schedule no matter how many are still outstanding. Every response
+# carries both its scheduled and its actual send time, so latency can be measured from the scheduled
+# time (received - scheduled), which corrects for coordinated omission.
+
+ARRIVALS = ('constant', 'poisson')
+
+
+def arrival_offsets(rate, arrivals='constant', seed=1):
+    """Generate send times in seconds from the start of the run for a target rate in requests
+    per second, either evenly spaced or as a Poisson process with a fixed random sequence."""
+    rnd = random.Random(seed)
+    offset = 0.0
+    while True:
+        yield offset
+        if arrivals == 'poisson':
+            offset += rnd.expovariate(rate)
+        else:
+            offset += 1.0 / rate
+
+
+async def _fetch_one(session, url, callback, headers, scheduled):
+    sent = time.time()
+    async with session.get(url, headers=headers) as r:
+        content = await r.read()
+        status_code = r.status
+    callback(Response(url, status_code, content, sent, time.time(), scheduled))
+
+
+async def _fetch_open_loop(jobs, rate, arrivals, seed, max_connections, headers, stop):
+    connector = aiohttp.TCPConnector(limit=max_connections, limit_per_host=max_connections,
+                                     keepalive_timeout=KEEPALIVE_TIMEOUT)
+    timeout = aiohttp.ClientTimeout(total=None, sock_connect=CONNECT_TIMEOUT)
+    loop = asyncio.get_running_loop()
+    async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+        start = loop.time()
+        start_epoch = time.time()
+        pending = set()
+        errors = []
+
+        def finished(task):
+            pending.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                errors.append(task.exception())
+
+        for (url, callback), offset in zip(jobs, arrival_offsets(rate, arrivals, seed)):
+            # surface failures now rather than after the whole schedule has been sent
+            if errors:
+                raise errors[0]
+            delay = start + offset - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if stop is not None and stop.is_set():
+                break
+            task = asyncio.ensure_future(_fetch_one(session, url, callback, headers, start_epoch + offset))
+            pending.add(task)
+            task.add_done_callback(finished)
+        await _wait(pending, stop)
+        if errors:
+            raise errors[0]
+
+
+def fetch_open_loop(jobs, rate, arrivals='constant', seed=1, max_connections=0, headers=None, stop=None):
+    """Fetch an iterable of (url, callback) pairs, sending them at rate requests per second on the
+    given arrival schedule regardless of how many are outstanding. max_connections caps the connection
+    pool (0 for no cap). A sender that falls behind the schedule shows up as sent being later than
+    scheduled; waiting for a free connection under the cap counts towards the latency. stop works as in fetch_all."""
+    asyncio.run(_fetch_open_loop(iter(jobs), rate, arrivals, seed, max_connections, headers, stop))
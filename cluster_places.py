@@ -1,68 +1,126 @@
 from __future__ import print_function
 
-import random
+# Endpoints are projected to UTM zone 35 all at once and clustered with DBSCAN over an explicit kd-tree (or
+# ball tree) neighbour index. Every place is jittered by up to JITTER meters before clustering, as it always was,
+# and places that are still identical (the same place listed more than once) are clustered as one weighted sample.
+# Clusters are then aggregated in one grouped pass with bincount: the centroid of a cluster is weighted by the
+# hits of its members (a plain mean if none of them has hits), and its hits are their sum.
+#
+# The output is reproducible: the jitter of a place is derived from a hash of its name, coordinates and a seed,
+# not drawn from the random module. Given the endpoints of a previous clustering (previous=, with 'id', 'lat' and
+# 'lon'), every new endpoint within match_radius meters of a previous one takes over its id and coordinates, one
+# to one, nearest first. Those endpoints come first, in the order of previous, and the really new ones follow
+# with ids after the largest previous one. otpprofiler.py pairs endpoints by id, so the requests (and id_tuples) of
+# an existing benchmark stay the same after a Piwik refresh, apart from those of endpoints that are gone.
+
+import hashlib
 import sys
 
 import numpy as np
 import unicodecsv
 import utm
+from scipy.spatial import cKDTree
 from sklearn.cluster import DBSCAN
 
-
-def clusterEndpoints(orig_endpoints, eps=2500, min_samples=2, return_outliers=True):
-    coords = []
-    coordhits = []
-    for i, l in enumerate(orig_endpoints):
-        name = l['name']
-        lon = l['lon']
-        lat = l['lat']
-        hits = l['hits'] if 'hits' in l else 0
-
-        lat = float(lat)
-        lon = float(lon)
-
-        utm35_coordinates = utm.from_latlon(lat, lon, 35)
-        x = utm35_coordinates[0]
-        y = utm35_coordinates[1]
-
-        x += random.uniform(-50, 50)
-        y += random.uniform(-50, 50)
-
-        coords.append((x, y))
-        coordhits.append((hits,))
-
-    coords = np.array(coords)
-    coordhits = np.array(coordhits)
-
-    db = DBSCAN(eps=eps, min_samples=min_samples, algorithm='auto', metric='euclidean').fit(coords)
-    coords = np.hstack((coords,coordhits))
-    cluster_labels = db.labels_
-    n_clusters = len(set(cluster_labels))
-    print('Clustered. Num clusters:', n_clusters)
-    clusters = (coords[cluster_labels == n] for n in range(-1, n_clusters))
-
-    outliers = next(clusters)
-
-    endpoints = []
-    if return_outliers:
-        for o in outliers:
-            if np.isnan(o[0]):
+UTM_ZONE = 35
+JITTER = 50  # meters
+
+
+def jitter(names, lats, lons, seed=0):
+    "(n, 2) array of offsets in [-JITTER, JITTER) meters, a function of each place and the seed only"
+    # coordinates are formatted to a fixed precision, the repr of NumPy floats differs between NumPy versions
+    digests = b''.join(hashlib.sha1(('%d|%s|%.7f|%.7f' % (seed, name, float(lat), float(lon))).encode('utf-8'))
+                       .digest()[:8] for name, lat, lon in zip(names, lats, lons))
+    units = np.frombuffer(digests, dtype='<u4').reshape(-1, 2) / 2.0 ** 32
+    return (units * 2 - 1) * JITTER
+
+
+def match_previous(endpoints, previous, radius):
+    """Give endpoints the id and coordinates of the nearest previous endpoint within radius meters, one to one,
+    and the ones left without a match new ids after the largest previous id. Returns the endpoints that took
+    over a previous id in the order of previous, followed by the new ones."""
+    next_id = max([int(p['id']) for p in previous] + [-1]) + 1
+    matched = {}  # index in previous -> endpoint
+    if previous and endpoints:
+        px, py = utm.from_latlon(np.array([float(p['lat']) for p in previous]),
+                                 np.array([float(p['lon']) for p in previous]), UTM_ZONE)[:2]
+        ex, ey = utm.from_latlon(np.array([ep['lat'] for ep in endpoints]),
+                                 np.array([ep['lon'] for ep in endpoints]), UTM_ZONE)[:2]
+        # every (endpoint, previous) pair within radius, nearest first, ties in endpoint order
+        candidates = cKDTree(np.column_stack((ex, ey))).sparse_distance_matrix(
+            cKDTree(np.column_stack((px, py))), radius, output_type='ndarray')
+        candidates.sort(order=['v', 'i', 'j'])
+        for e, p in zip(candidates['i'].tolist(), candidates['j'].tolist()):
+            if 'id' in endpoints[e] or p in matched:
                 continue
-            lat, lon = utm.to_latlon(o[0], o[1], 35, 'N')
-
-            endpoints.append({'name': 'o%d' % len(endpoints), 'lon': lon, 'lat': lat,'hits':o[2]})
-
-    for c in clusters:
-        if len(c) == 0:
-            continue
-        cp = np.nanmean(c, axis=0)
-        hitsum = np.sum(c[:,2])
-        if np.isnan(cp[0]):
-            continue
-        lat, lon = utm.to_latlon(cp[0], cp[1], 35, 'N')
-
-        endpoints.append({'name': 'c%d' % len(endpoints), 'lon': lon, 'lat': lat,'hits':hitsum})
+            matched[p] = endpoints[e]
+            endpoints[e].update(id=previous[p]['id'], lat=float(previous[p]['lat']), lon=float(previous[p]['lon']))
+    new = [ep for ep in endpoints if 'id' not in ep]
+    for ep in new:
+        ep['id'] = next_id
+        next_id += 1
+    print('Reused', len(matched), 'of', len(previous), 'previous endpoints,', len(new), 'new')
+    return [matched[p] for p in sorted(matched)] + new
+
+
+def clusterEndpoints(orig_endpoints, eps=2500, min_samples=2, return_outliers=True, algorithm='kd_tree', n_jobs=None,
+                     seed=0, previous=None, match_radius=None):
+    orig_endpoints = list(orig_endpoints)
+    names = [l.get('name', '') for l in orig_endpoints]
+    lats = np.array([float(l['lat']) for l in orig_endpoints])
+    lons = np.array([float(l['lon']) for l in orig_endpoints])
+    hits = np.array([float(l['hits']) if 'hits' in l else 0.0 for l in orig_endpoints])
+    valid = np.isfinite(lats) & np.isfinite(lons)
+    if not valid.all():
+        print('Skipping', np.count_nonzero(~valid), 'endpoints without coordinates')
+        names = [name for name, v in zip(names, valid) if v]
+        lats, lons, hits = lats[valid], lons[valid], hits[valid]
+    if len(lats) == 0:
+        return []
+
+    x, y = utm.from_latlon(lats, lons, UTM_ZONE)[:2]
+    coords = np.column_stack((x, y)) + jitter(names, lats, lons, seed)
+
+    unique_coords, inverse, counts = np.unique(coords, axis=0, return_inverse=True, return_counts=True)
+    db = DBSCAN(eps=eps, min_samples=min_samples, algorithm=algorithm, metric='euclidean', n_jobs=n_jobs)
+    db.fit(unique_coords, sample_weight=counts)
+    cluster_labels = db.labels_[inverse.reshape(-1)]
+    n_clusters = cluster_labels.max() + 1
+    # number the clusters in the order of their first member in the input, np.unique sorted the samples
+    members = cluster_labels >= 0
+    first = np.full(n_clusters, len(cluster_labels))
+    np.minimum.at(first, cluster_labels[members], np.flatnonzero(members))
+    renumber = np.empty(n_clusters, dtype=np.intp)
+    renumber[np.argsort(first)] = np.arange(n_clusters)
+    cluster_labels[members] = renumber[cluster_labels[members]]
+    print('Clustered. Num clusters:', n_clusters + 1)
 
+    endpoints = []
+    outliers = cluster_labels == -1
+    # utm.to_latlon refuses empty arrays
+    if return_outliers and outliers.any():
+        o_lats, o_lons = utm.to_latlon(coords[outliers, 0], coords[outliers, 1], UTM_ZONE, 'N')
+        for lat, lon, h in zip(o_lats, o_lons, hits[outliers]):
+            endpoints.append({'name': 'o%d' % len(endpoints), 'lon': lon, 'lat': lat, 'hits': h})
+
+    if n_clusters > 0:
+        labels = cluster_labels[members]
+        c_coords = coords[members]
+        c_hits = hits[members]
+        hitsum = np.bincount(labels, weights=c_hits, minlength=n_clusters)
+        size = np.bincount(labels, minlength=n_clusters)
+        weighted = hitsum > 0
+        # hit weighted centroids, the plain mean of clusters without hits
+        weights = np.where(weighted[labels], c_hits, 1.0)
+        norm = np.where(weighted, hitsum, size)
+        cx = np.bincount(labels, weights=c_coords[:, 0] * weights, minlength=n_clusters) / norm
+        cy = np.bincount(labels, weights=c_coords[:, 1] * weights, minlength=n_clusters) / norm
+        c_lats, c_lons = utm.to_latlon(cx, cy, UTM_ZONE, 'N')
+        for lat, lon, h in zip(c_lats, c_lons, hitsum):
+            endpoints.append({'name': 'c%d' % len(endpoints), 'lon': lon, 'lat': lat, 'hits': h})
+
+    if previous is not None:
+        endpoints = match_previous(endpoints, previous, eps if match_radius is None else match_radius)
     return endpoints
 
 
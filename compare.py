@@ -1,6 +1,11 @@
 from __future__ import print_function
+from __future__ import division
 
-import json
+import re
+
+import numpy as np
+
+import summary_io
 
 UNRESTRICTED_MODES = set(["WALK", "BICYCLE", "CAR"])
 
@@ -12,166 +17,278 @@ def parsetime(aa):
     return float(aa.split()[0])
 
 
-def extractdurations(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
+# Every comparison dimension is read from one table per run summary, built in a single pass over its responses:
+# {'ids': [id_tuple, ...], 'index': {id_tuple: row}, 'request_class': [...], column: numpy array with a value per id_tuple}
+# walk_speed and bicycle_speed are NaN for responses without walking or cycling, at most one of them is set.
+# latency is the client side latency in ms, NaN in summaries that do not record it.
+COLUMNS = ('duration', 'n_itins', 'n_modes', 'n_legs', 'n_trips', 'walk_speed', 'bicycle_speed',
+           'total_time', 'avg_time', 'timed_out', 'latency')
+NAN_COLUMNS = ('walk_speed', 'bicycle_speed', 'latency')
+COLUMN_TYPES = {'n_itins': np.int64, 'n_modes': np.int64, 'n_legs': np.int64, 'n_trips': np.int64,
+                'total_time': np.int64, 'timed_out': np.bool_}
+
+
+def response_speeds(response):
+    "(walk_speed, bicycle_speed) in m/s of a response, None where there was no walking or cycling"
+    walk_time = 0
+    walk_distance = 0
+    bicycle_time = 0
+    bicycle_distance = 0
+    for itin in response.get("itins", ()):
+        if "BICYCLE" not in itin["leg_modes"]:
+            walk_distance += itin["walk_distance"]
+            for leg_mode, leg_time in zip(itin["leg_modes"], itin["leg_times"]):
+                if leg_mode == "WALK":
+                    walk_time += leg_time
+        else:
+            # walk_distance includes walk and bicycle distance
+            bicycle_distance += itin["walk_distance"]
+            for leg_mode, leg_time in zip(itin["leg_modes"], itin["leg_times"]):
+                if leg_mode == "WALK":
+                    # remove walk distance calculated with default walk speed from bicycle_distance
+                    bicycle_distance -= leg_time * 1.222
+                elif leg_mode == "BICYCLE":
+                    bicycle_time += leg_time
+    if bicycle_time > 0:
+        return None, float(bicycle_distance) / float(bicycle_time)
+    if walk_time > 0:
+        return float(walk_distance) / float(walk_time), None
+    return None, None
+
+
+def response_columns(response):
+    "The COLUMNS values of one response row"
+    itins = response.get("itins")
+    if not itins:
+        duration = -1
+        n_modes = 0
+        n_legs = 0
+        n_trips = 0
+    else:
+        duration = parsetime(itins[0]["duration"])
+        # WALK, BICYCLE and CAR only count towards the modes of an itinerary when they are its only modes
+        modes_set = set()
+        for itinerary in itins:
+            leg_modes = set(itinerary["leg_modes"])
+            if leg_modes.issubset(UNRESTRICTED_MODES):
+                modes_set.update(leg_modes)
+            else:
+                modes_set.update(leg_modes.difference(UNRESTRICTED_MODES))
+        n_modes = len(modes_set)
+        n_legs = itins[0]["n_legs"]
+        n_trips = len(itins[0]["trips"])
 
-    durations = {}
+    debug = response.get("debug") or {}
+    walk_speed, bicycle_speed = response_speeds(response)
+    return (duration, 0 if itins is None else len(itins), n_modes, n_legs, n_trips, walk_speed, bicycle_speed,
+            debug.get("totalTime", 0), parsetime(response.get("avg_time")) or 0, debug.get("timedOut", False),
+            response.get("latency_ms"))
 
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
 
-        if not "itins" in response or len(response["itins"]) == 0:
-            durations[id_tuple] = -1
-        else:
-            durations[id_tuple] = parsetime(response["itins"][0]["duration"])
-    return durations
+# the response fields response_columns reads, the only ones loaded from a columnar .npz summary
+RESPONSE_FIELDS = ('id_tuple', 'request_class', 'request_id', 'itins.duration', 'itins.leg_modes', 'itins.leg_times',
+                   'itins.n_legs', 'itins.trips', 'itins.walk_distance', 'debug.totalTime', 'debug.timedOut',
+                   'avg_time', 'latency_ms')
 
 
-def extractitineraries(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
+def load_table(filename):
+    "Parse a run summary (.json, streamed .jsonl or columnar .npz) once into a table of COLUMNS keyed by id_tuple"
+    rows = []
+    index = {}
+    for response in summary_io.iter_responses(filename, columns=RESPONSE_FIELDS):
+        id_tuple = response["id_tuple"]
+        # summaries from before request classes were recorded are grouped by request id
+        row = (id_tuple, response.get("request_class", str(response.get("request_id")))) + response_columns(response)
+        if id_tuple in index:
+            # later responses win, like the dict the summaries used to be loaded into
+            rows[index[id_tuple]] = row
+            continue
+        index[id_tuple] = len(rows)
+        rows.append(row)
 
-    itineraries = {}
+    table = {'ids': [row[0] for row in rows], 'index': index,
+             'request_class': np.array([row[1] for row in rows], dtype=object)}
+    for i, column in enumerate(COLUMNS):
+        values = [row[i + 2] for row in rows]
+        if column in NAN_COLUMNS:
+            values = [np.nan if v is None else v for v in values]
+        table[column] = np.array(values, dtype=COLUMN_TYPES.get(column, np.float64))
+    return table
 
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
 
-        if not "itins" in response:
-            itineraries[id_tuple] = 0
-        else:
-            itineraries[id_tuple] = len(response["itins"])
-    return itineraries
+def _table(table):
+    # the extract functions still accept a file name
+    return table if isinstance(table, dict) else load_table(table)
 
 
-def extractmodes(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
+def _column(table, column):
+    return dict(zip(table['ids'], table[column].tolist()))
 
-    num_modes = {}
 
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
+def extractdurations(table):
+    return _column(_table(table), 'duration')
 
-        if not "itins" in response or len(response["itins"]) == 0:
-            num_modes[id_tuple] = 0
-        else:
-            modes_set = set()
-            for itinerary in response["itins"]:
-                if len(set(itinerary).difference(UNRESTRICTED_MODES)) == 0:
-                    modes_set.union(itinerary["leg_modes"])
-                else:
-                    # Do not include WALK, BICYCLE or CAR if there are other modes
-                    modes_set.union(set(itinerary["leg_modes"]).difference(UNRESTRICTED_MODES))
-                modes_set.union(itinerary["leg_modes"])
-            num_modes[id_tuple] = len(modes_set)
-    return num_modes
 
+def extractitineraries(table):
+    return _column(_table(table), 'n_itins')
 
-def extractlegs(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
 
-    num_legs = {}
+def extractmodes(table):
+    return _column(_table(table), 'n_modes')
 
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
 
-        if not "itins" in response or len(response["itins"]) == 0:
-            num_legs[id_tuple] = 0
-        else:
-            num_legs[id_tuple] = response["itins"][0]["n_legs"]
-    return num_legs
+def extractlegs(table):
+    return _column(_table(table), 'n_legs')
 
-def extracttrips(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
 
-    num_trips = {}
+def extracttrips(table):
+    return _column(_table(table), 'n_trips')
 
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
 
-        if not "itins" in response or len(response["itins"]) == 0:
-            num_trips[id_tuple] = 0
-        else:
-            num_trips[id_tuple] = len(response["itins"][0]["trips"])
-    return num_trips
-
-
-def extractspeeds(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
-
-    walk_speeds = {}
-    bicycle_speeds = {}
-    walk_count = 0
-    bicycle_count = 0
-    walk_speed_sum = 0
-    bicycle_speed_sum = 0
-
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
-        walk_time = 0
-        walk_distance = 0
-        bicycle_time = 0
-        bicycle_distance = 0
-        if "itins" in response:
-            for itin in response["itins"]:
-                if "BICYCLE" not in itin["leg_modes"]:
-                    walk_distance += itin["walk_distance"]
-                    i = 0
-                    while i < len(itin["leg_modes"]):
-                        if itin["leg_modes"][i] == "WALK":
-                            walk_time += itin["leg_times"][i]
-                        i += 1
-                else:
-                    # walk_distance includes walk and bicycle distance
-                    bicycle_distance += itin["walk_distance"]
-                    i = 0
-                    while i < len(itin["leg_modes"]):
-                        if itin["leg_modes"][i] == "WALK":
-                            # remove walk distance calculated with default walk speed from bicycle_distance
-                            bicycle_distance -= itin["leg_times"][i] * 1.222
-                        elif itin["leg_modes"][i] == "BICYCLE":
-                            bicycle_time += itin["leg_times"][i]
-                        i += 1
-        if bicycle_time > 0:
-            response_bicycle_speed = float(bicycle_distance) / float(bicycle_time)
-            bicycle_count += 1
-            bicycle_speed_sum += response_bicycle_speed
-            bicycle_speeds[id_tuple] = response_bicycle_speed
-        elif walk_time > 0:
-            response_walk_speed = float(walk_distance) / float(walk_time)
-            walk_count += 1
-            walk_speed_sum += response_walk_speed
-            walk_speeds[id_tuple] = response_walk_speed
-    average_walk_speed = 0 if walk_speed_sum is 0 else walk_speed_sum / walk_count
-    average_cycling_speed = 0 if bicycle_speed_sum is 0 else bicycle_speed_sum / bicycle_count
-    return {"walk_speeds": walk_speeds, "bicycle_speeds": bicycle_speeds, "average_walk_speed": average_walk_speed,
-            "average_cycling_speed": average_cycling_speed}
-
-
-def extractperformance(filename):
-    blob = json.load(open(filename))
-    dataset = dict([(response["id_tuple"], response) for response in blob["responses"]])
-
-    total_times = {}
-    avg_times = {}
-    timeouts = {}
-
-    for id_tuple in dataset:
-        response = dataset[id_tuple]
-
-        total_times[id_tuple] = response["debug"]["totalTime"]
-
-        if response["avg_time"] != None:
-            avg_times[id_tuple] = float(response["avg_time"][:5])
-        else:
-            avg_times[id_tuple] = 0
-        timeouts[id_tuple] = response["debug"]["timedOut"]
+def extractspeeds(table):
+    table = _table(table)
+    walk = ~np.isnan(table['walk_speed'])
+    bicycle = ~np.isnan(table['bicycle_speed'])
+    ids = np.array(table['ids'], dtype=object)
+    return {"walk_speeds": dict(zip(ids[walk], table['walk_speed'][walk].tolist())),
+            "bicycle_speeds": dict(zip(ids[bicycle], table['bicycle_speed'][bicycle].tolist())),
+            "average_walk_speed": table['walk_speed'][walk].mean() if walk.any() else 0,
+            "average_cycling_speed": table['bicycle_speed'][bicycle].mean() if bicycle.any() else 0}
+
+
+def extractperformance(table):
+    table = _table(table)
+    return {"total_times": _column(table, 'total_time'),
+            "avg_times": _column(table, 'avg_time'),
+            "timeouts": _column(table, 'timed_out')}
+
+
+def align(table1, table2):
+    """Index array that reorders the rows of table2 to the id_tuples of table1, or None when
+    table2 lacks some of them."""
+    index2 = table2['index']
+    if not all(id_tuple in index2 for id_tuple in table1['ids']):
+        return None
+    return np.array([index2[id_tuple] for id_tuple in table1['ids']], dtype=np.int64)
+
+
+def print_diffs(fmt, ids, mask, *columns):
+    "Print fmt % (id_tuple, values...) for every row selected by mask"
+    for i in np.flatnonzero(mask):
+        print(fmt % ((ids[i],) + tuple(column[i].item() for column in columns)))
+
+
+def compare_counts(name, ids, a1, a2, threshold):
+    """Compare a count column of both runs. Returns the masks of rows with at least threshold
+    less in run 1 and in run 2, printing those rows."""
+    changed = a1 != a2
+    less1 = changed & (a2 >= a1 + threshold)
+    less2 = changed & ~less1 & (a1 >= a2 + threshold)
+    print_diffs("Test " + name + " %s t1=%d t2=%d diff=%d", ids, less1 | less2, a1, a2, a2 - a1)
+    return less1, less2
+
+
+# Significance testing of performance changes.
+# The threshold test of -p flags a route whenever a single sample on either side is off by -tt ms, so JVM GC noise
+# on a few queries is enough to fail it. With -sig the summaries of repeated runs are given for both sides
+# (--benchmarkruns, --profileruns), every route is reduced to the median of its runs, and the paired per-route
+# medians are tested for a slowdown overall and per request class:
+#   - a one-sided Wilcoxon signed-rank test on the log ratios profile / benchmark
+#   - a paired bootstrap confidence interval for the ratio of the median times
+# A slowdown is significant when the test rejects at alpha (Bonferroni corrected across request classes) and the
+# lower confidence bound of the ratio exceeds --minslowdown. Only significant slowdowns fail the comparison.
+
+SIGNIFICANCE_MIN_ROUTES = 10  # the tests are not run on fewer routes
+BOOTSTRAP_BATCH = 100
+
+
+def load_wilcoxon():
+    """scipy.stats.wilcoxon. Only -sig needs scipy, and its one-sided test needs scipy 1.2 or later, so it is
+    imported here and not with the module."""
+    try:
+        import scipy
+        from scipy.stats import wilcoxon
+    except ImportError:
+        print("-sig needs scipy 1.2 or later, which is not installed")
+        exit(1)
+    version = tuple(int(v) for v in re.findall(r'\d+', scipy.__version__)[:2])
+    if version < (1, 2):
+        print("-sig needs scipy 1.2 or later for its one-sided test, this is scipy %s" % scipy.__version__)
+        exit(1)
+    return wilcoxon
+
+
+def run_medians(tables, reference, metric):
+    "Per-route median of metric over a list of run tables, aligned to the routes of reference"
+    samples = []
+    for table in tables:
+        order = align(reference, table)
+        if order is None:
+            return None
+        samples.append(table[metric][order].astype(np.float64))
+    return np.nanmedian(np.vstack(samples), axis=0)
+
+
+def bootstrap_ratio(m1, m2, alpha, n_boot, seed=1):
+    "Ratio median(m2) / median(m1) and its two-sided 1 - 2 alpha paired bootstrap interval"
+    rng = np.random.RandomState(seed)
+    ratios = []
+    for i in range(0, n_boot, BOOTSTRAP_BATCH):
+        resample = rng.randint(0, len(m1), size=(min(BOOTSTRAP_BATCH, n_boot - i), len(m1)))
+        ratios.append(np.median(m2[resample], axis=1) / np.median(m1[resample], axis=1))
+    ratios = np.concatenate(ratios)
+    return (np.median(m2) / np.median(m1), np.percentile(ratios, 100 * alpha), np.percentile(ratios, 100 * (1 - alpha)))
+
+
+def slowdown_test(m1, m2, alpha, min_slowdown, n_boot):
+    "Test one group of paired route medians, returns a result dict or None when there are too few routes"
+    valid = (m1 > 0) & (m2 > 0)
+    m1 = m1[valid]
+    m2 = m2[valid]
+    if len(m1) < SIGNIFICANCE_MIN_ROUTES:
+        return None
+    log_ratios = np.log(m2 / m1)
+    if np.all(log_ratios == 0):
+        p = 1.0
+    else:
+        p = load_wilcoxon()(log_ratios, alternative='greater').pvalue
+    ratio, low, high = bootstrap_ratio(m1, m2, alpha, n_boot)
+    return {'n': len(m1), 'p': p, 'ratio': ratio, 'low': low, 'high': high,
+            'significant': bool(p < alpha and low > min_slowdown)}
+
+
+def significance(tables1, tables2, metric, alpha, min_slowdown, n_boot):
+    """Test the runs of tables2 against the runs of tables1 for a slowdown in metric.
+    Returns True when the slowdown is significant overall or in some request class."""
+    load_wilcoxon()  # fail before any work when scipy is missing
+    reference = tables1[0]
+    m1 = run_medians(tables1, reference, metric)
+    m2 = run_medians(tables2, reference, metric)
+    if m1 is None or m2 is None:
+        print("test data is not comparable")
+        exit(1)
 
-    return {"total_times": total_times, "avg_times": avg_times, "timeouts": timeouts}
+    print("Significance of %s slowdown from %d benchmark run(s) to %d profile run(s), alpha %.3f, minimum ratio %.3f" % (
+        metric, len(tables1), len(tables2), alpha, min_slowdown))
+    classes = sorted(set(reference['request_class']))
+    slower = False
+    for request_class in [None] + classes:
+        if request_class is None:
+            name = 'all'
+            result = slowdown_test(m1, m2, alpha, min_slowdown, n_boot)
+        else:
+            name = request_class
+            in_class = reference['request_class'] == request_class
+            # Bonferroni: every class is a separate test
+            result = slowdown_test(m1[in_class], m2[in_class], alpha / len(classes), min_slowdown, n_boot)
+        if result is None:
+            print("  %s: too few routes to test" % name)
+            continue
+        print("  %s: n=%d median ratio %.3f [%.3f, %.3f] p=%.4f%s" % (
+            name, result['n'], result['ratio'], result['low'], result['high'], result['p'],
+            " SIGNIFICANT SLOWDOWN" if result['significant'] else ""))
+        slower = slower or result['significant']
+    return slower
 
 
 def main(args):
@@ -190,256 +307,121 @@ def main(args):
     speeds = args.pop('speeds')
     speed_threshold = args.pop('speedthreshold')
     performance = args.pop('performance')
+    significant = args.pop('significance', False)
+    benchmark_runs = args.pop('benchmarkruns', None) or []
+    profile_runs = args.pop('profileruns', None) or []
+    metric = args.pop('metric', 'total_time')
+    alpha = args.pop('alpha', 0.05)
+    min_slowdown = args.pop('minslowdown', 1.0)
+    n_boot = args.pop('bootstrap', 2000)
     total_times_threshold = args.pop('totaltimethreshold')
     avg_times_threshold = args.pop('averagetimethreshold')
 
     print("Detecting regressions with a time threshold of %d seconds and test threshold %d " % (threshold, limit))
 
-    dur1 = extractdurations(fname1)
-    dur2 = extractdurations(fname2)
+    table1 = load_table(fname1)
+    table2 = load_table(fname2)
 
-    itin1 = {}
-    itin2 = {}
+    # rows of table2 in the order of table1, so that every column comparison is elementwise
+    order = align(table1, table2)
+    if order is None:
+        print("test data is not comparable")
+        exit(1)
+    ids = table1['ids']
+    count = len(ids)
+
+    def columns(column):
+        return table1[column], table2[column][order]
+
+    t1, t2 = columns('duration')
+    changed = t1 != t2
+    failed1 = changed & (t1 < 0) & (t2 > 0)
+    failed2 = changed & ~failed1 & (t1 > 0) & (t2 < 0)
+    rest = changed & ~failed1 & ~failed2
+    slower1_mask = rest & (t1 > t2 + threshold)
+    slower2_mask = rest & ~slower1_mask & (t2 > t1 + threshold)
+    print_diffs("Test route duration %s t1=%d t2=%d diff=%d", ids, failed1 | failed2 | slower1_mask | slower2_mask,
+                t1, t2, t2 - t1)
+    fails1 = int(failed1.sum())
+    fails2 = int(failed2.sum())
+    slower1 = int(slower1_mask.sum())
+    slower2 = int(slower2_mask.sum())
 
     if itineraries:
         print("Detecting regressions with a itinerary number threshold of %d and test threshold %d " % (
             itinerary_threshold, limit))
-        itin1 = extractitineraries(fname1)
-        itin2 = extractitineraries(fname2)
-
-    modes1 = {}
-    modes2 = {}
+        less1, less2 = compare_counts("itinerarys", ids, *columns('n_itins'), threshold=itinerary_threshold)
+        less_itin1 = int(less1.sum())
+        less_itin2 = int(less2.sum())
 
     if modes:
         print(
             "Detecting regressions with a mode number threshold of %d and test threshold %d " % (mode_threshold, limit))
-        modes1 = extractmodes(fname1)
-        modes2 = extractmodes(fname2)
-
-    legs1 = {}
-    legs2 = {}
+        less1, less2 = compare_counts("modes", ids, *columns('n_modes'), threshold=mode_threshold)
+        less_mode1 = int(less1.sum())
+        less_mode2 = int(less2.sum())
 
     if legs:
         print("Detecting regressions with a leg number threshold of %d and test threshold %d " % (leg_threshold, limit))
-        legs1 = extractlegs(fname1)
-        legs2 = extractlegs(fname2)
-
-    trips1 = {}
-    trips2 = {}
+        less1, less2 = compare_counts("legs", ids, *columns('n_legs'), threshold=leg_threshold)
+        less_legs1 = int(less1.sum())
+        less_legs2 = int(less2.sum())
 
     if trips:
         print("Detecting regressions with a trip number threshold of %d and test threshold %d " % (trip_threshold, limit))
-        trips1 = extracttrips(fname1)
-        trips2 = extracttrips(fname2)
-
-    speeds1 = {}
-    speeds2 = {}
+        less1, less2 = compare_counts("trips", ids, *columns('n_trips'), threshold=trip_threshold)
+        less_trips1 = int(less1.sum())
+        less_trips2 = int(less2.sum())
 
     if speeds:
         print("Detecting regressions with a speed difference threshold of %d and test threshold %d " % (
             speed_threshold, limit))
-        speeds1 = extractspeeds(fname1)
-        speeds2 = extractspeeds(fname2)
-
-    performance1 = {}
-    performance2 = {}
+        speeds1 = extractspeeds(table1)
+        speeds2 = extractspeeds(table2)
+        slower_walk = {}
+        slower_bicycle = {}
+        for speed_type, column, slower in (("walk_speeds", 'walk_speed', slower_walk),
+                                           ("bicycle_speeds", 'bicycle_speed', slower_bicycle)):
+            s1, s2 = columns(column)
+            # NaN compares unequal to everything, so only rows with this speed in both runs remain
+            both = ~np.isnan(s1) & ~np.isnan(s2) & (s1 != s2)
+            slower[1] = both & (s2 >= s1 + speed_threshold)
+            slower[2] = both & ~slower[1] & (s1 >= s2 + speed_threshold)
+            print_diffs("Test " + speed_type + " %s t1=%f t2=%f diff=%f", ids, slower[1] | slower[2], s1, s2, s2 - s1)
+        slower_walk1 = int(slower_walk[1].sum())
+        slower_walk2 = int(slower_walk[2].sum())
+        slower_bicycle1 = int(slower_bicycle[1].sum())
+        slower_bicycle2 = int(slower_bicycle[2].sum())
 
     if performance:
         print("Detecting regressions with a total request time difference threshold of %d, an average request time difference threshold of %d, \
                            and test threshold %d " % (total_times_threshold, avg_times_threshold, limit))
-        performance1 = extractperformance(fname1)
-        performance2 = extractperformance(fname2)
-
-    fails1 = 0
-    fails2 = 0
-    slower1 = 0
-    slower2 = 0
-    count = 0
-
-    less_itin1 = 0
-    less_itin2 = 0
-
-    less_mode1 = 0
-    less_mode2 = 0
-
-    less_legs1 = 0
-    less_legs2 = 0
-
-    less_trips1 = 0
-    less_trips2 = 0
-
-    slower_walk1 = 0
-    slower_walk2 = 0
-    slower_bicycle1 = 0
-    slower_bicycle2 = 0
-
-    longer_totaltime1 = 0
-    longer_totaltime2 = 0
-    longer_avgtime1 = 0
-    longer_avgtime2 = 0
-    more_timeouts1 = 0
-    more_timeouts2 = 0
-    totaltime_sum1 = 0
-    totaltime_sum2 = 0
-
-    for id in dur1:
-        if not id in dur2:
-            print("test data is not comparable")
-            exit(1)
-        t1 = dur1[id]
-        t2 = dur2[id]
-        if t1 != t2:
-            diffmsg = "Test route duration %s t1=%d t2=%d diff=%d" % (id, t1, t2, t2 - t1)
-            if t1 < 0 and t2 > 0:
-                fails1 += 1
-            elif t1 > 0 and t2 < 0:
-                fails2 += 1
-            elif t1 > t2 + threshold:
-                slower1 += 1
-            elif t2 > t1 + threshold:
-                slower2 += 1
-            else:
-                diffmsg = ""
-
-            if diffmsg:
-                print(diffmsg)
-
-        if itineraries:
-            i1 = itin1[id]
-            i2 = itin2[id]
-
-            if i1 != i2:
-                diffmsg = "Test itinerarys %s t1=%d t2=%d diff=%d" % (id, i1, i2, i2 - i1)
-                if i2 >= i1 + itinerary_threshold:
-                    less_itin1 += 1
-                elif i1 >= i2 + itinerary_threshold:
-                    less_itin2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-        if modes:
-            m1 = modes1[id]
-            m2 = modes2[id]
-
-            if m1 != m2:
-                diffmsg = "Test modes %s t1=%d t2=%d diff=%d" % (id, m1, m2, m2 - m1)
-                if m2 >= m1 + mode_threshold:
-                    less_mode1 += 1
-                elif m1 >= m2 + mode_threshold:
-                    less_mode2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-        if legs:
-            l1 = legs1[id]
-            l2 = legs2[id]
-
-            if l1 != l2:
-                diffmsg = "Test legs %s t1=%d t2=%d diff=%d" % (id, l1, l2, l2 - l1)
-                if l2 >= l1 + leg_threshold:
-                    less_legs1 += 1
-                elif l1 >= l2 + leg_threshold:
-                    less_legs2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-        if trips:
-            t1 = trips1[id]
-            t2 = trips2[id]
-
-            if t1 != t2:
-                diffmsg = "Test trips %s t1=%d t2=%d diff=%d" % (id, t1, t2, t2 - t1)
-                if t2 >= t1 + trip_threshold:
-                    less_trips1 += 1
-                elif t1 >= t2 + trip_threshold:
-                    less_trips2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-        if speeds:
-            if (id in speeds1["walk_speeds"] and id in speeds2["walk_speeds"]) or (
-                    id in speeds1["bicycle_speeds"] and id in speeds2["bicycle_speeds"]):
-                speed_type = "bicycle_speeds" if id in speeds1["bicycle_speeds"] else "walk_speeds"
-
-                s1 = speeds1[speed_type][id]
-                s2 = speeds2[speed_type][id]
-
-                if s1 != s2:
-                    diffmsg = "Test %s %s t1=%f t2=%f diff=%f" % (speed_type, id, s1, s2, s2 - s1)
-                    if s2 >= s1 + speed_threshold:
-                        if speed_type is "walk_speeds":
-                            slower_walk1 += 1
-                        else:
-                            slower_bicycle1 += 1
-                    elif s1 >= s2 + speed_threshold:
-                        if speed_type is "walk_speeds":
-                            slower_walk2 += 1
-                        else:
-                            slower_bicycle2 += 1
-                    else:
-                        diffmsg = ""
-
-                    if diffmsg:
-                        print(diffmsg)
-
-        if performance:
-            total_time1 = performance1["total_times"][id]
-            total_time2 = performance2["total_times"][id]
-            avg_times1 = performance1["avg_times"][id]
-            avg_times2 = performance2["avg_times"][id]
-            timeout1 = performance1["timeouts"][id]
-            timeout2 = performance2["timeouts"][id]
-
-            totaltime_sum1 += total_time1
-            totaltime_sum2 += total_time2
-
-            if total_time1 != total_time2:
-                diffmsg = "Test total time %s t1=%d t2=%d diff=%d" % (
-                    id, total_time1, total_time2, total_time1 - total_time2)
-                if total_time1 >= total_time2 + total_times_threshold:
-                    longer_totaltime1 += 1
-                elif total_time2 >= total_time1 + total_times_threshold:
-                    longer_totaltime2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-            if avg_times1 != avg_times2:
-                diffmsg = "Test average time %s t1=%f t2=%f diff=%f" % (
-                    id, avg_times1, avg_times2, avg_times1 - avg_times2)
-                if avg_times1 >= avg_times2 + avg_times_threshold:
-                    longer_avgtime1 += 1
-                elif avg_times2 >= avg_times1 + avg_times_threshold:
-                    longer_avgtime2 += 1
-                else:
-                    diffmsg = ""
-
-                if diffmsg:
-                    print(diffmsg)
-
-            if timeout1 != timeout2:
-                diffmsg = "Test timeouts %s t1=%r t2=%r" % (id, timeout1, timeout2)
-                if timeout1:
-                    more_timeouts1 += 1
-                else:
-                    more_timeouts2 += 1
-                print(diffmsg)
-
-        count += 1
+        total_time1, total_time2 = columns('total_time')
+        totaltime_sum1 = int(total_time1.sum())
+        totaltime_sum2 = int(total_time2.sum())
+
+        changed = total_time1 != total_time2
+        longer1 = changed & (total_time1 >= total_time2 + total_times_threshold)
+        longer2 = changed & ~longer1 & (total_time2 >= total_time1 + total_times_threshold)
+        print_diffs("Test total time %s t1=%d t2=%d diff=%d", ids, longer1 | longer2,
+                    total_time1, total_time2, total_time1 - total_time2)
+        longer_totaltime1 = int(longer1.sum())
+        longer_totaltime2 = int(longer2.sum())
+
+        avg_times1, avg_times2 = columns('avg_time')
+        changed = avg_times1 != avg_times2
+        longer1 = changed & (avg_times1 >= avg_times2 + avg_times_threshold)
+        longer2 = changed & ~longer1 & (avg_times2 >= avg_times1 + avg_times_threshold)
+        print_diffs("Test average time %s t1=%f t2=%f diff=%f", ids, longer1 | longer2,
+                    avg_times1, avg_times2, avg_times1 - avg_times2)
+        longer_avgtime1 = int(longer1.sum())
+        longer_avgtime2 = int(longer2.sum())
+
+        timeout1, timeout2 = columns('timed_out')
+        changed = timeout1 != timeout2
+        print_diffs("Test timeouts %s t1=%r t2=%r", ids, changed, timeout1, timeout2)
+        more_timeouts1 = int((changed & timeout1).sum())
+        more_timeouts2 = int((changed & timeout2).sum())
 
     print("Test count: %d" % count)
     print("Routings that failed only in %s: %d" % (fname1, fails1))
@@ -509,18 +491,25 @@ def main(args):
         print("Routes that have longer average request time in %s: %d" % (fname2, longer_avgtime2))
         print("Routes that have more timeouts in %s: %d" % (fname1, more_timeouts1))
         print("Routes that have more timeouts in %s: %d" % (fname2, more_timeouts2))
+        # with -sig only a significant slowdown fails, the threshold counts are informational
         rate = int(100 * float(count + longer_totaltime1 - longer_totaltime2) / float(count))
         if rate < limit:
             print("Total request time test failed, %d < %d" % (rate, limit))
-            fail = True
+            fail = fail or not significant
         rate = int(100 * float(count + longer_avgtime1 - longer_avgtime2) / float(count))
         if rate < limit:
             print("Average request time test failed, %d < %d" % (rate, limit))
-            fail = True
+            fail = fail or not significant
         rate = int(100 * float(count + more_timeouts1 - more_timeouts2) / float(count))
         if rate < limit:
             print("Timeout test failed, %d < %d" % (rate, limit))
             fail = True
+    if significant:
+        tables1 = [table1] + [load_table(fn) for fn in benchmark_runs]
+        tables2 = [table2] + [load_table(fn) for fn in profile_runs]
+        if significance(tables1, tables2, metric, alpha, min_slowdown, n_boot):
+            print("Performance test failed, significant slowdown")
+            fail = True
     if fail:
         exit(1)
     print("Test passed")
@@ -560,6 +549,18 @@ if __name__ == "__main__":
                         default=200)  # Changes in total request times (ms) less than this are ignored
     parser.add_argument('-at', '--averagetimethreshold', type=int,
                         default=40)  # Changes in total request times (ms) less than this are ignored
+    parser.add_argument('-sig', '--significance', action='store_true',
+                        default=False)  # fail only on a statistically significant slowdown instead of -tt/-at thresholds
+    parser.add_argument('-br', '--benchmarkruns', nargs='*',
+                        default=[])  # more run summaries of the benchmark side, repeated runs of the same requests
+    parser.add_argument('-pr', '--profileruns', nargs='*',
+                        default=[])  # more run summaries of the profile side
+    parser.add_argument('--metric', choices=('total_time', 'latency'),
+                        default='total_time')  # server reported totalTime or client side latency
+    parser.add_argument('--alpha', type=float, default=0.05)  # significance level
+    parser.add_argument('--minslowdown', type=float,
+                        default=1.0)  # lower confidence bound of the median ratio must exceed this
+    parser.add_argument('--bootstrap', type=int, default=2000)  # number of bootstrap resamples
 
     args = parser.parse_args()
     main(vars(args))
@@ -0,0 +1,81 @@
+from __future__ import print_function
+
+# On-disk cache of endpoint-to-endpoint distances.
+# The endpoint sets in requests.json and otpqa_router_requests.json hardly ever change, but every profiler run used
+# to compute its pair distances again. Here the full condensed distance matrix of an endpoint set (the upper
+# triangle, in the layout of scipy.spatial.distance.pdist) is computed once with vincenty_inverse_batch and saved
+# as a .npy file named after a hash of the endpoint coordinates. Later runs memory-map it, so only the pages of
+# the pairs actually looked up are read. Distances are in kilometers, NaN where Vincenty did not converge.
+#
+# The cache lives in $OTPQA_CACHE, by default ~/.cache/otpqa. Files of endpoint sets that are no longer used
+# can simply be deleted.
+
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+
+from vincenty import vincenty_inverse_batch
+
+CACHE_DIR = os.getenv('OTPQA_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'otpqa'))
+FORMAT_VERSION = 1
+# Above this many endpoints the matrix (8 * n * (n - 1) / 2 bytes, 64 MB at the limit) is too big to be worth
+# building, get_params computes the distances of the pairs it uses instead.
+MAX_ENDPOINTS = 4000
+
+
+def endpoints_hash(endpoints):
+    "Hash of the coordinates of an endpoint list, in order"
+    h = hashlib.sha1(('distances v%d\n' % FORMAT_VERSION).encode('ascii'))
+    for endpoint in endpoints:
+        h.update(('%r,%r\n' % (float(endpoint['lat']), float(endpoint['lon']))).encode('ascii'))
+    return h.hexdigest()
+
+
+def condensed_index(i, j, n):
+    "Position of the pair (i, j), i != j, in the condensed matrix of n points. Works on arrays too."
+    i, j = np.minimum(i, j), np.maximum(i, j)
+    return n * i - i * (i + 1) // 2 + (j - i - 1)
+
+
+def build(endpoints, filename):
+    "Compute the condensed distance matrix of endpoints into filename"
+    n = len(endpoints)
+    lats = np.array([float(endpoint['lat']) for endpoint in endpoints])
+    lons = np.array([float(endpoint['lon']) for endpoint in endpoints])
+    print("computing %d endpoint distances into %s" % (n * (n - 1) // 2, filename))
+
+    # write to a temporary file and rename it into place, so concurrent runs never see a half written matrix
+    fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=os.path.dirname(filename))
+    os.close(fd)
+    matrix = np.lib.format.open_memmap(tmpname, mode='w+', dtype=np.float64, shape=(n * (n - 1) // 2,))
+    for i in range(n - 1):
+        start = condensed_index(i, i + 1, n)
+        matrix[start:start + n - i - 1] = vincenty_inverse_batch(lats[i], lons[i], lats[i + 1:], lons[i + 1:])[0]
+    matrix.flush()
+    del matrix
+    os.chmod(tmpname, 0o644)
+    os.rename(tmpname, filename)
+
+
+class DistanceMatrix(object):
+    """Distances between all endpoints of a set, loaded from the cache or built into it."""
+
+    def __init__(self, endpoints, cache_dir=CACHE_DIR):
+        self.n = len(endpoints)
+        filename = os.path.join(cache_dir, 'distances.%s.npy' % endpoints_hash(endpoints))
+        if not os.path.exists(filename):
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            build(endpoints, filename)
+        self.matrix = np.load(filename, mmap_mode='r')
+
+    def distances(self, i, j):
+        "Distances in km between endpoints i and j, given as index arrays. NaN where Vincenty did not converge."
+        i = np.asarray(i, dtype=np.int64)
+        j = np.asarray(j, dtype=np.int64)
+        ret = np.zeros(i.shape)
+        apart = i != j
+        ret[apart] = self.matrix[condensed_index(i[apart], j[apart], self.n)]
+        return ret
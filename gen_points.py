@@ -1,20 +1,232 @@
+from __future__ import print_function
+
+# Intersections are extracted from the PBF in a single parse, by one imposm process since more of them deadlock. Node
+# coordinates are appended in chunks to files in a temporary directory (ids as int64, coordinates as int32 in units
+# of 1e-7 degrees, the precision of OSM itself) and memory-mapped afterwards. The node ids of highways are kept in
+# NumPy arrays, one per parsed block; sorting them all once finds the ids seen more than once, the intersections,
+# whose coordinates are then looked up in the node index with a binary search. This takes about 24 bytes per node
+# and highway node reference instead of two Python sets of ids and a second parse.
+#
+# All intersections are then projected at once and checked against a cKDTree of the GTFS stops in one batched
+# query; the ones within radius of a stop are eligible. num_points of them are sampled
+#   uniform     uniformly at random
+#   stratified  from a grid of STRATUM_SIZE meter cells, each cell getting its share of the points, so no area
+#               is over or under represented by chance
+#   density     with probability proportional to the number of stops within radius
+#
+# The stops of all GTFS feeds in the directory are read in parallel, one feed per process, straight into NumPy
+# arrays, and stops that several feeds share (the same coordinates) are kept once. The result is cached in
+# $OTPQA_CACHE under a hash of the checksums of the feeds, so it is only read again when a feed changes.
+
 from imposm.parser import OSMParser
-from random import random, randint, shuffle
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain
 from zipfile import ZipFile
-from math import radians, cos
-from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
+import numpy as np
+import codecs
 import csv
+import hashlib
 import os
+import shutil
+import tempfile
+
+from distance_cache import CACHE_DIR
+
+COORD_SCALE = 10 ** 7  # node coordinates are stored as integers in units of 1e-7 degrees
+SAMPLING = ('uniform', 'stratified', 'density')
+STRATUM_SIZE = 5000  # meters
+
+
+class NodeIndex(object):
+    """Coordinates of all nodes by id, on disk"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fp_ids = open(os.path.join(directory, 'ids.bin'), 'wb')
+        self.fp_coords = open(os.path.join(directory, 'coords.bin'), 'wb')
+        self.n = 0
+        self.last_id = -1
+        self.is_sorted = True
+        self.ids = self.coords = None
+
+    def add(self, coords):
+        "coords_callback: append a chunk of (id, lon, lat)"
+        if not coords:
+            return
+        chunk = np.array(coords, dtype=np.float64)
+        ids = chunk[:, 0].astype(np.int64)
+        if ids[0] <= self.last_id or (len(ids) > 1 and (np.diff(ids) <= 0).any()):
+            self.is_sorted = False  # blocks from parallel parsers may arrive out of order
+        self.last_id = ids[-1]
+        ids.tofile(self.fp_ids)
+        np.round(chunk[:, 1:] * COORD_SCALE).astype(np.int32).tofile(self.fp_coords)
+        self.n += len(ids)
+
+    def finish(self):
+        "Close the files and map them, sorted by id"
+        self.fp_ids.close()
+        self.fp_coords.close()
+        if self.n == 0:
+            self.ids, self.coords = np.zeros(0, dtype=np.int64), np.zeros((0, 2), dtype=np.int32)
+            return
+        ids = np.memmap(os.path.join(self.directory, 'ids.bin'), dtype=np.int64, mode='r')
+        coords = np.memmap(os.path.join(self.directory, 'coords.bin'), dtype=np.int32, mode='r', shape=(self.n, 2))
+        if not self.is_sorted:
+            order = np.argsort(ids, kind='stable')
+            sorted_ids = np.memmap(os.path.join(self.directory, 'ids.sorted.bin'), dtype=np.int64, mode='w+',
+                                   shape=(self.n,))
+            sorted_ids[:] = ids[order]
+            sorted_coords = np.memmap(os.path.join(self.directory, 'coords.sorted.bin'), dtype=np.int32, mode='w+',
+                                      shape=(self.n, 2))
+            sorted_coords[:] = coords[order]
+            del order
+            ids, coords = sorted_ids, sorted_coords
+        self.ids, self.coords = ids, coords
+
+    def lookup(self, ids):
+        "(lon, lat) array of the nodes with the given ids and a mask of the ids found"
+        pos = np.minimum(np.searchsorted(self.ids, ids), max(self.n - 1, 0))
+        found = (self.ids[pos] == ids) if self.n else np.zeros(len(ids), dtype=bool)
+        return self.coords[pos[found]] / float(COORD_SCALE), found
+
+
+def intersection_nodes(pbffilename):
+    "(lon, lat) array of the nodes that are on more than one highway, or twice on the same one"
+    tmpdir = tempfile.mkdtemp(prefix='gen_points.')
+    try:
+        index = NodeIndex(tmpdir)
+        highway_nds = []
+
+        def road(ways):
+            nds = np.fromiter(chain.from_iterable(nds for id, tags, nds in ways if 'highway' in tags),
+                              dtype=np.int64)
+            if len(nds):
+                highway_nds.append(nds)
+
+        # Avoid some sort of deadlock by setting concurrency to 1 (stacktrace shows sem.acquire())
+        p = OSMParser(concurrency=1, coords_callback=index.add, ways_callback=road)
+        p.parse(pbffilename)
+        index.finish()
+        print("  %d nodes, %d highway node references" % (index.n, sum(len(nds) for nds in highway_nds)))
+
+        nds = np.concatenate(highway_nds) if highway_nds else np.zeros(0, dtype=np.int64)
+        del highway_nds[:]
+        nds.sort()
+        # if we've ever seen a node before, it's an intersection
+        intersection_nds = np.unique(nds[1:][nds[1:] == nds[:-1]])
+        del nds
+
+        coords, found = index.lookup(intersection_nds)
+        if not found.all():
+            print("  %d intersection nodes are missing from the extract" % np.count_nonzero(~found))
+        del index
+        return coords
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
 
-def project(coord) :
-    "This projection completely wrecks heading but preserves distances. (lon, lat) -> (x, y)"
+def feed_checksum(path):
+    h = hashlib.sha1()
+    with open(path, 'rb') as fp:
+        for block in iter(lambda: fp.read(1 << 20), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+def read_stops(path):
+    "(n, 2) array of the (lon, lat) of the stops in a GTFS zip, or a message why there are none"
+    zf = ZipFile(path)
+    try:
+        data = zf.read("stops.txt")
+    except KeyError:
+        return "This ZIP file does not contain a stops.txt, skipping."
+    finally:
+        zf.close()
+    if data.startswith(codecs.BOM_UTF8):
+        data = data[len(codecs.BOM_UTF8):]
+    if not isinstance(data, str):
+        data = data.decode('utf-8')  # Python 3, csv reads text
+    rd = csv.reader(data.splitlines(True))
+    header = [name.strip() for name in next(rd, [])]
+    try:
+        lat_idx = header.index("stop_lat")
+        lon_idx = header.index("stop_lon")
+    except ValueError:
+        return "Stops.txt does not contain lat or lon columns, skipping."
+    # stations' generic nodes and boarding areas may have no coordinates
+    n_columns = max(lat_idx, lon_idx) + 1
+    return np.array([(row[lon_idx], row[lat_idx]) for row in rd
+                     if len(row) >= n_columns and row[lon_idx].strip() and row[lat_idx].strip()],
+                    dtype=np.float64).reshape(-1, 2)
+
+
+def load_stops(paths, cache_dir=CACHE_DIR):
+    "(lon, lat) array of the distinct stops of the GTFS feeds at paths"
+    with ProcessPoolExecutor() as executor:
+        checksums = list(executor.map(feed_checksum, paths))
+        key = hashlib.sha1(''.join('%s\n' % checksum for checksum in sorted(checksums)).encode('ascii'))
+        filename = os.path.join(cache_dir, 'stops.%s.npy' % key.hexdigest())
+        if os.path.exists(filename):
+            print("  cached in", filename)
+            return np.load(filename)
+
+        stop_coords = []
+        for path, stops in zip(paths, executor.map(read_stops, paths)):
+            print("  ", os.path.basename(path))
+            if isinstance(stops, np.ndarray):
+                stop_coords.append(stops)
+            else:
+                print(stops)
+    stop_coords = np.concatenate(stop_coords) if stop_coords else np.zeros((0, 2))
+    # stops shared by feeds, at the same coordinates to OSM precision
+    fixed = np.unique(np.round(stop_coords * COORD_SCALE).astype(np.int64), axis=0)
+    print("  %d stops, %d distinct" % (len(stop_coords), len(fixed)))
+    stop_coords = fixed / float(COORD_SCALE)
+
+    if not os.path.isdir(cache_dir):
+        os.makedirs(cache_dir)
+    fd, tmpname = tempfile.mkstemp(suffix='.npy', dir=cache_dir)
+    with os.fdopen(fd, 'wb') as fp:
+        np.save(fp, stop_coords)
+    os.chmod(tmpname, 0o644)
+    os.rename(tmpname, filename)
+    return stop_coords
+
+
+def project(coords) :
+    "This projection completely wrecks heading but preserves distances. (n, 2) array of (lon, lat) -> (x, y)"
     m_per_degree = 111111.0
-    lon, lat = coord
+    coords = np.asarray(coords, dtype=np.float64).reshape(-1, 2)
+    lon, lat = coords[:, 0], coords[:, 1]
     y = lat * m_per_degree
-    x = lon * cos(radians(lat)) * m_per_degree
-    return (x, y)
-    
-def get_random_points( dirname, nn, radius=2000 ):
+    x = lon * np.cos(np.radians(lat)) * m_per_degree
+    return np.column_stack((x, y))
+
+
+def stratified_choice(xy, nn, rng, size=STRATUM_SIZE):
+    "Indices of nn of the points xy, allocated over grid cells of size meters in proportion to their points"
+    cells = np.floor(xy / size).astype(np.int64)
+    cell_ids, cell_of, counts = np.unique(cells, axis=0, return_inverse=True, return_counts=True)
+    cell_of = cell_of.reshape(-1)
+    quota = counts * (float(nn) / len(xy))
+    take = np.floor(quota).astype(np.int64)
+    # the points left over go to the cells with the largest remainders, ties at random
+    rest = nn - take.sum()
+    if rest > 0:
+        order = np.lexsort((rng.random_sample(len(counts)), -(quota - take)))
+        take[order[:rest]] += 1
+    # a random rank within each cell, points ranked below their cell's quota are taken
+    order = np.lexsort((rng.random_sample(len(xy)), cell_of))
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    rank = np.empty(len(xy), dtype=np.int64)
+    rank[order] = np.arange(len(xy)) - starts[cell_of[order]]
+    chosen = np.flatnonzero(rank < take[cell_of])
+    rng.shuffle(chosen)
+    return chosen
+
+
+def get_random_points( dirname, nn, radius=2000, sampling='uniform', seed=None ):
 
     filenames = os.listdir( dirname )
 
@@ -30,96 +242,60 @@ def get_random_points( dirname, nn, radius=2000 ):
     if len(zip_filenames)==0:
         raise Exception( "No GTFS feeds found in directory." )
 
-    print "Collecting stop locations from GTFS files..."
-    stop_coords = []
-    for fn in zip_filenames:
-        print "  ", fn
-        zf = ZipFile( os.path.join( dirname, fn ) )
-        try:
-            fp = zf.open("stops.txt")
-        except KeyError, e:
-            print "This ZIP file does not contain a stops.txt, skipping."
-            continue
-        rd = csv.reader(fp)
-        header = rd.next()
-        try:
-            lat_idx = header.index("stop_lat")
-            lon_idx = header.index("stop_lon")
-        except ValueError, e:
-            print "Stops.txt does not contain lat or lon columns, skipping."
-            continue 
-        for row in rd:
-            stop_coords.append( (float(row[lon_idx]), float(row[lat_idx])) )
-    print "Done."
-
-    all_nds = set()
-    intersection_nds = set()
-    def road(ways):
-        for id, tags, nds in ways:
-            if 'highway' not in tags:
-                continue
-
-            # if we've ever seen any of these nds before, they're intersections    
-            for nd in nds:
-                if nd in all_nds:
-                    intersection_nds.add( nd )
-                all_nds.add( nd )
-
-    print "Collecting intersection nodes from PBF file..."
-    print "  ", pbffilename
-    # concurrency is automatically set to number of cores
-    p = OSMParser(ways_callback=road)
-    p.parse(pbffilename)
-    all_nds.clear() # cannot del() because it's referenced in a nested scope    
-    print "Done."
-
-    nd_coords = {}
-    def get_coords(coords):
-        for id, lon, lat in coords:
-            if (id in intersection_nds):
-                nd_coords[id] = (lon, lat)
-
-    print "Getting lat/lon coordinates of intersection nodes..."
-    # Avoid some sort of deadlock by setting concurrency to 1 (stacktrace shows sem.acquire())
-    p = OSMParser(concurrency=1, coords_callback=get_coords)
-    p.parse(pbffilename)
-    print "Done."
-
-    print "Adding projected GTFS stop locations to a KD tree."
-    # kdtree requires a long-lived immutable input, so make a copy
-    projected_stop_coords = map(project, stop_coords)
-    kdtree = KDTree(projected_stop_coords)
-    print "Done."
-
-    print "Choosing nodes near transit at random..."
-    ret = []
-    intersection_nds = list(intersection_nds)
-    shuffle(intersection_nds)
-    for nd in intersection_nds :
-        # Check that it's within radius of a stop
-        coord = nd_coords[nd]
-        distance, nearest_coord = kdtree.query(project(coord))
-        if distance > radius: 
-            continue
-        ret.append( coord )
-        if len(ret) >= nn: 
-            break
-
-    print "Done."
+    print("Collecting stop locations from GTFS files...")
+    stop_coords = load_stops([os.path.join( dirname, fn ) for fn in sorted(zip_filenames)])
+    if len(stop_coords) == 0:
+        raise Exception( "No stops found in the GTFS feeds." )
+    print("Done.")
+
+    print("Collecting intersection nodes from PBF file...")
+    print("  ", pbffilename)
+    intersection_coords = intersection_nodes(pbffilename)
+    print("Done.")
+
+    print("Adding projected GTFS stop locations to a KD tree.")
+    kdtree = cKDTree(project(stop_coords))
+    print("Done.")
+
+    print("Choosing nodes near transit at random...")
+    # Check that they're within radius of a stop
+    xy = project(intersection_coords)
+    distance, nearest = kdtree.query(xy, distance_upper_bound=radius)
+    eligible = np.flatnonzero(distance <= radius)
+    print("  %d of %d intersections are within %d m of a stop" % (len(eligible), len(xy), radius))
+    if len(eligible) == 0:
+        # the stratified quotas and the density weights divide by the number of points
+        print("Done.")
+        return []
+    rng = np.random.RandomState(seed)
+    nn = min(nn, len(eligible))
+    if sampling == 'uniform':
+        chosen = rng.choice(len(eligible), nn, replace=False)
+    elif sampling == 'stratified':
+        chosen = stratified_choice(xy[eligible], nn, rng)
+    elif sampling == 'density':
+        stops = kdtree.query_ball_point(xy[eligible], radius, return_length=True)
+        chosen = rng.choice(len(eligible), nn, replace=False, p=stops / float(stops.sum()))
+    else:
+        raise ValueError("sampling must be one of %s" % (SAMPLING,))
+    ret = [tuple(coord) for coord in intersection_coords[eligible[chosen]].tolist()]
+
+    print("Done.")
     return ret
 
 if __name__=='__main__':
     import sys
     # fn = "/Users/brandon/Documents/nysdot/graph/tristate.pbf"
 
-    if len(sys.argv)<3:
-        print "usage: cmd dirname num_points"
+    if len(sys.argv)<3 or (len(sys.argv) > 3 and sys.argv[3] not in SAMPLING):
+        print("usage: cmd dirname num_points [%s]" % '|'.join(SAMPLING))
         exit()
 
     dirname = sys.argv[1]
     ct = int(sys.argv[2])
+    sampling = sys.argv[3] if len(sys.argv) > 3 else 'uniform'
 
-    nodes = get_random_points(dirname, ct)
+    nodes = get_random_points(dirname, ct, sampling=sampling)
 
     fpout = open("endpoints_random.csv","w")
     fpout.write("name,lat,lon\n")
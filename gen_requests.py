@@ -47,8 +47,9 @@ def generateRequestsFromEndpoints(endpoints,TEST_ALL_MODES=True,random=False):
     import csv
     endpoints_json = []
 
+    # endpoints clustered against a previous benchmark keep their ids, see cluster_places.py
     for i, rec in enumerate( endpoints ):
-        endpoint_rec = {'id':i, 'random':random, 'lon':float(rec['lon']), 'lat':float(rec['lat']), 'name':rec['name'], 'notes':None}
+        endpoint_rec = {'id':rec.get('id', i), 'random':random, 'lon':float(rec['lon']), 'lat':float(rec['lat']), 'name':rec['name'], 'notes':None}
         endpoints_json.append( endpoint_rec )
     json_out['endpoints'] = endpoints_json
 
@@ -2,8 +2,6 @@ from __future__ import print_function
 
 import json
 import os
-import grequests
-import requests
 import sys
 import pprint
 
@@ -11,6 +9,7 @@ import unicodecsv
 import numpy as np
 import gen_requests
 import cluster_places
+import piwik_harvester
 
 token = os.getenv('PIWIK_TOKEN', None)
 
@@ -22,6 +21,9 @@ period = 'month'
 
 client_cert = 'client.pem'
 
+# progress of the harvest, an interrupted run continues from here. See piwik_harvester.py.
+checkpoint = os.getenv('PIWIK_CHECKPOINT', 'piwik_harvest.checkpoint.jsonl')
+
 sites_router = {
     '4': {'name': 'reittiopas.hsl.fi', 'router': ('hsl','finland'), 'eps': 100, 'min_samples': 2, 'hits_percentile': 50},
     #'opas.matka.fi': {'router': ('finland',), 'eps': 250, 'min_samples': 2, 'hits_percentile': 40},
@@ -40,32 +42,16 @@ sites_router = {
     '49': {'name': 'rovaniemi.digitransit.fi', 'router': ('waltti','finland'),'eps': 100, 'min_samples': 2, 'hits_percentile': 50},
 }
 
-router_sites = {}
-
-sitesurl = '%(baseurl)s/?module=API&method=SitesManager.getSitesWithAtLeastViewAccess&format=JSON&token_auth=%(token)s' % {
-    'baseurl': piwik_baseurl, 'token': token}
-r = requests.get(sitesurl, cert=client_cert)
-piwiksites = r.json()
-r.close()
 
-for psite in piwiksites:
-    siteid = psite['idsite']
-    if not siteid in sites_router:
-        continue
-
-    siteinfo = sites_router[siteid]
-    routers = siteinfo['router']
-    for router in routers:
-        if not router in router_sites:
-            router_sites[router] = []
-
-        siteinfo['idsite'] = psite['idsite']
-        router_sites[router].append(siteinfo)
-
-
-def clean_label(label):
-    label = label.strip('/')
-    return label[:label.find('?')]
+# Clustering reuses the endpoint ids and coordinates of the previous requests file, so that existing baseline runs
+# stay comparable. Set PIWIK_PREVIOUS to an empty string to number all endpoints from scratch.
+previous_file = os.getenv('PIWIK_PREVIOUS', 'otpqa_router_requests.json')
+previous_endpoints = {}
+if previous_file and os.path.exists(previous_file):
+    for psites in json.load(open(previous_file)).values():
+        for psite in psites:
+            previous_endpoints[psite['name']] = psite['requests']['endpoints']
+    print('Reusing the endpoints of', len(previous_endpoints), 'sites in', previous_file)
 
 
 def parse_place(place):
@@ -77,36 +63,22 @@ def parse_place(place):
     return dict(name=name, lat=lat, lon=lon)
 
 
-def response_callback_factory(places, label, idsubdatatable, hits):
-    fromp = parse_place(label)
-    def handle_response(response, *args, **kwargs):
-        if response.status_code != 200:
-            status = 'failed'
-            return None
-
-        tourls = response.json()
-
-        for tu in tourls:
-            if tu['label'] == 'Others':
-                continue
-
-            if tu['label'].strip() == '':
-                continue
+# every site is harvested once, even when it belongs to several routers
+harvester = piwik_harvester.Harvester(piwik_baseurl, token, client_cert, period=period, checkpoint=checkpoint,
+                                      rate=float(os.getenv('PIWIK_RATE', piwik_harvester.RATE)))
+places_by_site = harvester.harvest(sorted(sites_router), lambda label: parse_place(label) is not None)
 
-            tolabel = clean_label(tu['label'])
-
-            tohits = tu['nb_hits']
-            top = parse_place(tolabel)
+router_sites = {}
 
-            if fromp and top:
-                if tolabel in places:
-                    places[tolabel] += tohits
-                else:
-                    places[tolabel] = tohits
-        response.connection.close()
-        #print(idsubdatatable, label, hits, response)
+for siteid in sorted(places_by_site):
+    siteinfo = sites_router[siteid]
+    siteinfo['idsite'] = siteid
+    routers = siteinfo['router']
+    for router in routers:
+        if not router in router_sites:
+            router_sites[router] = []
 
-    return handle_response
+        router_sites[router].append(siteinfo)
 
 
 for router in router_sites:
@@ -116,65 +88,7 @@ for router in router_sites:
     router_clustered_endpoints = []
     for site in rsites:
         print(site['name'],'/',site['idsite'])
-        site_places = {}
-
-        siteid = site['idsite']
-
-        url = '%(baseurl)s/?module=API&method=Actions.getPageUrls&idSite=%(siteid)s&period=%(period)s&date=today&format=JSON&token_auth=%(token)s&filter_column=label&filter_pattern=^reitti$' % {
-            'baseurl': piwik_baseurl, 'siteid': siteid, 'period': period, 'token': token}
-
-        r = requests.get(url, cert=client_cert)
-        pageurls = r.json()
-        r.close()
-
-        if len(pageurls) == 0 or pageurls[0]['label'] != 'reitti':
-            print('Retrieving page url for reitti-pages failed for sited %s' % siteid)
-            continue
-
-        reitti_page = pageurls[0]
-
-        idsubtable = reitti_page['idsubdatatable']
-
-        subdataurl = '%(baseurl)s/?module=API&method=Actions.getPageUrls&idSite=%(siteid)s&period=%(period)s&date=today&format=JSON&token_auth=%(token)s&filter_limit=5000&idSubtable=%(idsubtable)s' % {
-            'baseurl': piwik_baseurl, 'idsubtable': idsubtable, 'period': period, 'siteid': siteid, 'token': token}
-
-        r = requests.get(subdataurl, cert=client_cert)
-        frompageurls = r.json()
-        r.close()
-
-        reqs = []
-
-        for fpu in frompageurls:
-            if fpu['label'] == 'Others':
-                continue
-            if 'idsubdatatable' not in fpu:
-                continue
-            if fpu['label'].strip() == '':
-                continue
-            label = clean_label(fpu['label'])
-            idsubdatatable = fpu['idsubdatatable']
-            hits = fpu['nb_hits']
-
-            site_places[label] = hits
-
-            url = '%(baseurl)s/?module=API&method=Actions.getPageUrls&idSite=%(siteid)s&period=%(period)s&date=today&format=JSON&token_auth=%(token)s&filter_limit=5000&idSubtable=%(idsubtable)s' % {
-                'baseurl': piwik_baseurl, 'idsubtable': idsubdatatable, 'period': period, 'siteid': siteid,
-                'token': token}
-
-            response_callback = response_callback_factory(site_places, label, idsubdatatable, hits)
-            headers = {'Accept': 'application/json'}
-            req = grequests.get(url, cert=client_cert, headers=headers, hooks=dict(response=response_callback))
-            reqs.append(req)
-
-
-        def exception_handler(request, exception):
-            raise exception
-
-        res = grequests.imap(reqs, size=20, exception_handler=exception_handler)
-        for i,_ in enumerate(res):
-            pass
-
-        print(i,'requests done')
+        site_places = places_by_site[site['idsite']]
 
         endpoints = []
         for rawplace in sorted((p[1], p[0]) for p in site_places.items()):
@@ -183,15 +97,19 @@ for router in router_sites:
                 endpoints.append({'name': place['name'], 'lat': place['lat'], 'lon': place['lon'], 'hits': rawplace[0]})
 
 
+        previous = previous_endpoints.get(site['name'], [])
         clustered_endpoints = cluster_places.clusterEndpoints(endpoints,
                                                               eps=site['eps'],
-                                                              min_samples=site['min_samples'])
+                                                              min_samples=site['min_samples'],
+                                                              previous=previous)
 
         nphits = np.array([ep['hits'] for ep in clustered_endpoints], dtype=np.uint32)
         hits_limit = np.percentile(nphits, site['hits_percentile'])
         print('HITS MIN:', hits_limit)
 
-        clustered_endpoints = [ep for ep in clustered_endpoints if ep['hits'] > hits_limit]
+        # endpoints that are already in the benchmark stay in it
+        previous_ids = set(ep['id'] for ep in previous)
+        clustered_endpoints = [ep for ep in clustered_endpoints if ep['id'] in previous_ids or ep['hits'] > hits_limit]
 
         router_endpoints += endpoints
         router_clustered_endpoints += clustered_endpoints
@@ -0,0 +1,110 @@
+from __future__ import division
+
+# Mergeable latency histogram in the style of HdrHistogram.
+# Values are recorded as integer microseconds. Below 2**SUB_BUCKET_BITS they are counted exactly; above that
+# each power of two is split into 2**(SUB_BUCKET_BITS - 1) equal buckets, so every recorded value is off by
+# less than 1 / 2**(SUB_BUCKET_BITS - 1) of itself (0.4% with the default 9 bits) and the number of buckets
+# grows with the log of the value range. Only non-empty buckets are stored, and two histograms with the same
+# SUB_BUCKET_BITS are merged by adding their counts, so worker processes and separate runs can be combined
+# without keeping the individual samples.
+
+SUB_BUCKET_BITS = 9
+PERCENTILES = (('p50', 50.0), ('p90', 90.0), ('p99', 99.0), ('p999', 99.9))
+
+
+def bucket_of(us):
+    "Lower bound, in microseconds, of the bucket that holds us"
+    shift = us.bit_length() - SUB_BUCKET_BITS
+    if shift <= 0:
+        return us
+    return (us >> shift) << shift
+
+
+def bucket_width(lower):
+    shift = lower.bit_length() - SUB_BUCKET_BITS
+    return 1 if shift <= 0 else 1 << shift
+
+
+class Histogram(object):
+    """Latency histogram. record() takes milliseconds and all statistics are returned in milliseconds."""
+
+    def __init__(self):
+        self.counts = {}  # bucket lower bound (us) -> count
+        self.count = 0
+        self.total = 0  # us
+        self.min = None  # us
+        self.max = None  # us
+
+    def record(self, ms):
+        us = max(0, int(round(ms * 1000)))
+        b = bucket_of(us)
+        self.counts[b] = self.counts.get(b, 0) + 1
+        self.count += 1
+        self.total += us
+        self.min = us if self.min is None else min(self.min, us)
+        self.max = us if self.max is None else max(self.max, us)
+
+    def merge(self, other):
+        "Add the counts of other into this histogram. Returns self."
+        for b, c in other.counts.items():
+            self.counts[b] = self.counts.get(b, 0) + c
+        self.count += other.count
+        self.total += other.total
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def percentile(self, p):
+        "Value at percentile p (0-100) in ms, taken as the middle of its bucket and clamped to [min, max]"
+        if self.count == 0:
+            return None
+        rank = max(1, int(-(-p * self.count // 100)))  # ceil
+        seen = 0
+        for b in sorted(self.counts):
+            seen += self.counts[b]
+            if seen >= rank:
+                value = b + (bucket_width(b) - 1) / 2.0
+                return min(max(value, self.min), self.max) / 1000.0
+        return self.max / 1000.0
+
+    def mean(self):
+        return None if self.count == 0 else self.total / self.count / 1000.0
+
+    def summary(self):
+        "Dict of count, mean, p50, p90, p99, p999 and max in ms"
+        ret = {'count': self.count, 'mean': self.mean(), 'max': None if self.max is None else self.max / 1000.0}
+        for name, p in PERCENTILES:
+            ret[name] = self.percentile(p)
+        return ret
+
+    def to_dict(self):
+        "JSON-friendly form, restored with Histogram.from_dict()"
+        return {'sub_bucket_bits': SUB_BUCKET_BITS, 'min': self.min, 'max': self.max, 'total': self.total,
+                'counts': sorted(self.counts.items())}
+
+    @classmethod
+    def from_dict(cls, d):
+        if d['sub_bucket_bits'] != SUB_BUCKET_BITS:
+            raise ValueError("histogram was recorded with %d sub-bucket bits, expected %d" %
+                             (d['sub_bucket_bits'], SUB_BUCKET_BITS))
+        h = cls()
+        h.counts = dict((int(b), int(c)) for b, c in d['counts'])
+        h.count = sum(h.counts.values())
+        h.total = d['total']
+        h.min = d['min']
+        h.max = d['max']
+        return h
+
+
+def summarize(histograms):
+    """Summary of a {request_class: Histogram} dict for the run output: percentiles and the
+    serialized histogram of every class, plus the same for all classes merged under 'all'."""
+    merged = Histogram()
+    classes = {}
+    for request_class, h in sorted(histograms.items()):
+        merged.merge(h)
+        classes[request_class] = dict(h.summary(), histogram=h.to_dict())
+    return {'unit': 'msec',
+            'all': dict(merged.summary(), histogram=merged.to_dict()),
+            'classes': classes}
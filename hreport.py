@@ -3,8 +3,11 @@ from future.standard_library import install_aliases
 import json
 import numpy as np
 import math
+import os
 from datetime import datetime
 import pprint
+import summary_io
+from histogram import Histogram
 
 
 install_aliases()
@@ -32,27 +35,12 @@ def humanize(lt):
     return os
 
 
-def main(filenames, input_blob=None, dt_url=None):
-    if (filenames is None or len(filenames) == 0) and input_blob is None:
-        return
-
-    if input_blob is None:
-        datasets = []
-        for fn in filenames:
-            blob = json.load(open(fn))
-            dataset = dict([(response["id_tuple"], response) for response in blob['responses']])
-            datasets.append(dataset)
-    else:
-        datasets = [dict([(response["id_tuple"], response) for response in input_blob['responses']]), ]
-
-    id_tuples = datasets[0].keys()
+# Reports are written out as they are generated, and statistics are kept in running accumulators, so memory does not
+# grow with the report. Above PAGE_SIZE queries write_report splits the report into pages of PAGE_SIZE rows, written
+# next to each other as PREFIX.1.html, PREFIX.2.html, ..., and writes an index page with links to them instead.
+PAGE_SIZE = 1000
 
-    if len(id_tuples) == 0:
-        print("Input does not contain any data")
-        exit()
-
-    yield "<html>"
-    yield """<head><style>table, th, td {
+HEAD = """<head><style>table, th, td {
     border: 1px solid black;
     border-collapse: collapse;
 }
@@ -61,14 +49,39 @@ th, td {
     vertical-align:top;
 }</style></head>"""
 
-    yield """<table border="1">"""
 
-    dataset_total_times = dict(zip(range(len(datasets)), [[] for x in range(len(datasets))]))
-    dataset_avg_times = dict(zip(range(len(datasets)), [[] for x in range(len(datasets))]))
-    dataset_fails = dict(zip(range(len(datasets)), [0] * len(datasets)))
+class DatasetStats(object):
+    """Fail count and total time distribution of one dataset over the report rows written so far."""
 
+    def __init__(self):
+        self.fails = 0
+        self.total_times = Histogram()
+
+    def html(self, n):
+        median = self.total_times.percentile(50)
+        mean = self.total_times.mean()
+        return "<td>fails: %s (%.2f%%). total time: median:%.2fs mean:%.2fs</td>" % (
+            self.fails, 100 * self.fails / float(n), float('nan') if median is None else median,
+            float('nan') if mean is None else mean)
+
+
+def load_datasets(filenames, input_blob=None):
+    "The responses of each run summary, or of input_blob, keyed by id_tuple. None when there is nothing to report."
+    if (filenames is None or len(filenames) == 0) and input_blob is None:
+        return None
+
+    if input_blob is None:
+        blobs = [summary_io.load_summary(fn) for fn in filenames]
+    else:
+        blobs = [input_blob]
+    return [dict([(response["id_tuple"], response) for response in blob['responses']]) for blob in blobs]
+
+
+def report_rows(datasets, id_tuples, dt_url, stats):
+    "Generate the table rows of id_tuples, counting into stats, one DatasetStats per dataset"
     for id_tuple in id_tuples:
         otpurl = ''
+        dturl = ''
         if dt_url is not None:
 
             otpurl = datasets[0][id_tuple]['url']
@@ -88,8 +101,7 @@ th, td {
             if not 'total_time' in response:
                 continue
 
-            dataset_total_times[i].append(parsetime(response['total_time']))
-            dataset_avg_times[i].append(parsetime(response['avg_time']))
+            stats[i].total_times.record(parsetime(response['total_time']))
 
             yield "<td>%s total, %s avg / %s</td>" % (
                 response['total_time'], response['avg_time'], datasets[i][id_tuple]['mode'])
@@ -109,12 +121,12 @@ th, td {
                 continue
 
             if len(response['itins']) == 0:
-                dataset_fails[i] += 1
+                stats[i].fails += 1
                 yield "<td style=\"background-color:#EDA1A1\">NONE</td></tr></table></tr>"
                 continue
 
             if all((itin['walk_limit_exceeded'] for itin in response['itins'])):
-                dataset_fails[i] += 1
+                stats[i].fails += 1
                 yield "<td style=\"background-color:#EDA1A1\">LONG WALK (%.1f km)</td></tr></table></tr>" % (min((itin['walk_distance'] for itin in response['itins']))/1000.0)
                 continue
 
@@ -130,24 +142,123 @@ th, td {
             yield "</td>"
         yield "</tr>"
 
-    yield "<tr><td>stats</td>"
-    for i in range(len(datasets)):
-        yield "<td>fails: %s (%.2f%%). total time: median:%.2fs mean:%.2fs</td>" % (
-            dataset_fails[i], 100 * dataset_fails[i] / float(len(id_tuples)), np.median(dataset_total_times[i]),
-            np.mean(dataset_total_times[i]))
-    yield "</tr>"
+
+def stats_row(stats, n):
+    return "<tr><td>stats</td>" + "".join(s.html(n) for s in stats) + "</tr>"
+
+
+def single_page(datasets, id_tuples, dt_url):
+    "Generate the report of id_tuples as one page"
+    stats = [DatasetStats() for dataset in datasets]
+
+    yield "<html>"
+    yield HEAD
+
+    yield """<table border="1">"""
+
+    for chunk in report_rows(datasets, id_tuples, dt_url, stats):
+        yield chunk
+
+    yield stats_row(stats, len(id_tuples))
 
     yield "</table>"
 
     yield "</html>"
 
 
+def main(filenames, input_blob=None, dt_url=None):
+    "Generate the whole report as a single page"
+    datasets = load_datasets(filenames, input_blob)
+    if datasets is None:
+        return
+
+    id_tuples = list(datasets[0].keys())
+
+    if len(id_tuples) == 0:
+        print("Input does not contain any data")
+        exit()
+
+    for chunk in single_page(datasets, id_tuples, dt_url):
+        yield chunk
+
+
+def write_report(fp, filenames=None, input_blob=None, dt_url=None, page_prefix='report', page_size=PAGE_SIZE):
+    """Write the report to the open file fp as it is generated. With more than page_size queries the rows go to
+    page files page_prefix.N.html and fp gets an index page linking to them. The pages link back to the index when
+    fp is a file in the same directory. Returns the page file names."""
+    datasets = load_datasets(filenames, input_blob)
+    if datasets is None:
+        return []
+
+    id_tuples = list(datasets[0].keys())
+
+    if len(id_tuples) == 0:
+        print("Input does not contain any data")
+        exit()
+
+    if len(id_tuples) <= page_size:
+        for chunk in single_page(datasets, id_tuples, dt_url):
+            fp.write(chunk)
+        return []
+
+    stats = [DatasetStats() for dataset in datasets]
+    n_pages = (len(id_tuples) + page_size - 1) // page_size
+    page_filenames = ['%s.%d.html' % (page_prefix, k + 1) for k in range(n_pages)]
+    index_filename = getattr(fp, 'name', None)
+    if not (isinstance(index_filename, str) and os.path.isfile(index_filename) and
+            os.path.dirname(os.path.abspath(index_filename)) == os.path.dirname(os.path.abspath(page_prefix))):
+        index_filename = None  # stdout or a pipe, there is nothing to link to
+    index_rows = []
+    for k, page_filename in enumerate(page_filenames):
+        page = id_tuples[k * page_size:(k + 1) * page_size]
+        fails_before = [s.fails for s in stats]
+
+        nav = '<p><a href="%s">index</a>' % os.path.basename(index_filename) if index_filename else '<p>'
+        if k > 0:
+            nav += ' <a href="%s">previous</a>' % os.path.basename(page_filenames[k - 1])
+        if k + 1 < n_pages:
+            nav += ' <a href="%s">next</a>' % os.path.basename(page_filenames[k + 1])
+        nav += ' page %d of %d</p>' % (k + 1, n_pages)
+
+        fpage = open(page_filename, 'w')
+        fpage.write("<html>")
+        fpage.write(HEAD)
+        fpage.write(nav)
+        fpage.write("""<table border="1">""")
+        for chunk in report_rows(datasets, page, dt_url, stats):
+            fpage.write(chunk)
+        fpage.write("</table>")
+        fpage.write(nav)
+        fpage.write("</html>")
+        fpage.close()
+
+        index_rows.append('<tr><td><a href="%s">page %d</a></td><td>%s ... %s</td>%s</tr>' % (
+            os.path.basename(page_filename), k + 1, page[0], page[-1],
+            ''.join('<td>fails: %d</td>' % (s.fails - before) for s, before in zip(stats, fails_before))))
+
+    fp.write("<html>")
+    fp.write(HEAD)
+    fp.write("""<table border="1">""")
+    for row in index_rows:
+        fp.write(row)
+    fp.write(stats_row(stats, len(id_tuples)))
+    fp.write("</table>")
+    fp.write("</html>")
+    return page_filenames
+
+
 if __name__ == '__main__':
+    import argparse
     import sys
 
-    if len(sys.argv) < 2:
-        print("usage: cmd fn1[fn2[fn3...]]")
-        exit()
+    parser = argparse.ArgumentParser(description='HTML report of run summaries')
+    parser.add_argument('filenames', nargs='+') # run_summary files in any format
+    parser.add_argument('-o', '--output', default=None) # report file, large reports get page files next to it. stdout by default
+    args = parser.parse_args()
 
-        for line in main(sys.argv[1:]):
-            print(line)
+    if args.output is None:
+        write_report(sys.stdout, args.filenames)
+    else:
+        fp = open(args.output, 'w')
+        write_report(fp, args.filenames, page_prefix=os.path.splitext(args.output)[0])
+        fp.close()
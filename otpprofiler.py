@@ -8,21 +8,33 @@ install_aliases()
 from urllib.parse import urlparse, urlencode
 from urllib.request import urlopen, Request
 from urllib.error import HTTPError
+from queue import Empty
 
-import time, itertools, json
+import time, itertools, json, math
 import subprocess, urllib, random
+import multiprocessing, threading, traceback
 import pprint
+import uuid
 from copy import copy
 from datetime import date, timedelta
 from random import randint, seed
-from vincenty import vincenty_inverse
+from vincenty import vincenty_inverse_batch
+import numpy as np
+import distance_cache
+import summary_io
+import telemetry
+import response_store
+import runstore
+from histogram import Histogram
+import histogram
 
 import sys
 
-# python-requests no longer has first-class support for concurrent asynchronous HTTP requests
-# the author has moved it to https://github.com/kennethreitz/grequests
-# python-requests wraps urllib2 providing a much nicer API.
-import grequests
+# The default engine is async_engine (asyncio + aiohttp), which keeps connections to the router alive.
+# grequests is the fallback on installations without aiohttp. It is only imported when used, because
+# importing it monkeypatches the socket module with gevent, which asyncio does not cooperate with.
+# The replay engine does not use the network, it answers from a response_store.
+ENGINES = ('asyncio', 'grequests', 'replay')
 
 IGNORED_DATES = set((
     '-12-06',
@@ -69,13 +81,10 @@ SHOW_PARAMS = False
 SHOW_URL = False
 SHOW_RESPONSE = False
 
-# globals to store accumulated responses. one file for summaries, one file for full itineraries.
-response_json = []
-full_itins_json = []
 pp = pprint.PrettyPrinter(indent=4)
-n = 0  # number of responses received
-N = 0  # total number of responses expected
-t0 = 0  # time that search begins
+
+
+DISTANCE_BATCH = 1024  # endpoint pairs per distance lookup or vectorized computation in get_params
 
 
 def cycle(seq):
@@ -95,7 +104,71 @@ def pairs(iterable):
         yield (x, next(it, None))
 
 
-def get_params(fast, count, filename="requests.json", requests_json=None, modes=None):
+def feistel_permutation(n, seed):
+    """Lazily yield a pseudo-random permutation of range(n) in O(1) memory.
+    A keyed 4-round Feistel network is a bijection on the smallest even-bit-width domain >= n, so the outputs
+    below n are every number in range(n) exactly once, and there are at most 4 n of them to go through."""
+    bits = max(2, (n - 1).bit_length())
+    bits += bits % 2
+    half = bits // 2
+    mask = (1 << half) - 1
+    rnd = random.Random(seed)
+    keys = [rnd.getrandbits(32) for i in range(4)]
+    # a counter and not range(), which is a list on Python 2
+    for i in itertools.count():
+        if i >> bits:
+            break
+        left, right = i >> half, i & mask
+        for key in keys:
+            f = ((right ^ key) * 0x45d9f3b) & 0xffffffff
+            f = ((f >> 16) ^ f) & mask
+            left, right = right, left ^ f
+        x = (left << half) | right
+        if x < n:
+            yield x
+
+
+def endpoint_pairs(ids, count, seed=1):
+    """Yield (origin, target) index pairs into a list of endpoints with the given ids for count requests.
+    Pairs are chosen by endpoint id and not by position, so that the pairs (and id_tuples) of an existing benchmark
+    stay the same when endpoints are added to or dropped from its endpoint list (see cluster_places.py). Endpoints
+    without unique non-negative integer ids are identified by their position.
+    With at least 2 * count endpoints ids 0 and 1, 2 and 3, ... are paired up in order, which keeps the pairs of
+    existing benchmarks. Otherwise every ordered pair of distinct endpoints is yielded once, in the order of a
+    seeded permutation of the m * m id pairs, m the power of two above the largest id, so that exactly count unique
+    pairs can be taken. The order only depends on m and the seed, the pairs of new endpoints fall in between."""
+    if not all(isinstance(eid, int) and eid >= 0 for eid in ids) or len(set(ids)) < len(ids):
+        ids = range(len(ids))
+    position = dict((eid, i) for i, eid in enumerate(ids))
+    if not position:
+        return
+    max_id = max(position)
+
+    if len(position) >= 2 * count:
+        i = 0
+        while i <= max_id:
+            if i in position and i + 1 in position:
+                yield position[i], position[i + 1]
+            i += 2
+        return
+
+    m = 1 << max(1, max_id.bit_length())
+    for k in feistel_permutation(m * m, seed):
+        o, t = divmod(k, m)
+        if o != t and o in position and t in position:
+            yield position[o], position[t]
+
+
+def endpoint_distances(endpoints, count):
+    """The cached distance matrix of endpoints, or None when the set is too large to cache. Runs that pair endpoints
+    in order (see endpoint_pairs) only look up count distances, which are computed as they are needed."""
+    if len(endpoints) > distance_cache.MAX_ENDPOINTS or len(endpoints) >= 2 * count:
+        return None
+    return distance_cache.DistanceMatrix(endpoints)
+
+
+def get_params(fast, count, filename="requests.json", requests_json=None, modes=None, seed=1):
+    "Lazily generate the query parameters of count requests, cycling over the request types"
     if requests_json is None and filename is not None:
         requests_json = json.load(open(filename))
     requests = requests_json['requests']
@@ -106,60 +179,54 @@ def get_params(fast, count, filename="requests.json", requests_json=None, modes=
         exit()
     print("test count=%d" % count)
 
-    if elen > 2 * count:
-        endpoints = endpoints[:2 * count]
-    elif elen < 2 * count:
-        newpoints = []
-        pairIds = {}
-        i = 0
-        prevr = 0
-        seed(1)  # use a fixed random sequence to get repeatable results
-        for j in range(0, count * 10):  # apply a large top limit to ensure the loop ends
-            r = randint(0, elen - 1)
-            if i % 2 != 0:
-                pair_id = str(prevr) + "_" + str(r)
-                if pair_id in pairIds:
-                    # point pair already exists, pick a new one
-                    continue
-                pairIds[pair_id] = True
-            # got a valid new endpoint, continue with new endpoint
-            newpoints.append(endpoints[r])
-            prevr = r
-            i += 1
-            if i >= count * 2:
-                break  # done
-
-        endpoints = newpoints
-
-    # Make sure there is an even number of endpoints
-    if len(endpoints) % 2 != 0:
-        endpoints = endpoints[:-1]
-
-    ret = []
+    matrix = endpoint_distances(endpoints, count) if modes is None else None
+
     # if fast :
     # else :
-    for (request, (origin, target)) in zip(cycle(requests), pairs(endpoints)):
-        req = copy(request)
-        req['oid'] = origin['id']
-        req['tid'] = target['id']
-        req['fromPlace'] = "%s,%s" % (origin['lat'], origin['lon'])
-        req['toPlace'] = "%s,%s" % (target['lat'], target['lon'])
-        req['walkSpeed'] = 1.222
-
-        if req['fromPlace'] == req['toPlace']:
-            continue
-
-        if modes is None:
-            dist = vincenty_inverse((origin['lat'], origin['lon']),(target['lat'], target['lon']))
-            if dist > (0.9/1000)*req['maxWalkDistance'] and req['mode'] in ('BICYCLE','WALK'):
-                req['mode'] += ',TRANSIT'
-        else:
-            req['mode'] = modes
+    candidates = ((request, o, t) for (request, (o, t)) in zip(cycle(requests), endpoint_pairs([endpoint.get('id') for endpoint in endpoints], count, seed)))
+    n = 0
+    while n < count:
+        # Distances decide whether WALK/BICYCLE requests are too long to be made without transit.
+        # They are looked up in the distance cache, or computed for a batch of pairs at a time.
+        batch = []
+        for (request, o, t) in candidates:
+            origin, target = endpoints[o], endpoints[t]
+            # Endpoints with the same coordinates would be a zero length trip. With sampled pairs another
+            # pair is drawn instead, so the count is only short when the endpoint set runs out of pairs.
+            if (origin['lat'], origin['lon']) == (target['lat'], target['lon']):
+                continue
+            batch.append((request, o, t))
+            if len(batch) >= min(DISTANCE_BATCH, count - n):
+                break
+        if not batch:
+            break
+
+        if matrix is not None:
+            dists = matrix.distances([o for (request, o, t) in batch], [t for (request, o, t) in batch])
+            converged = ~np.isnan(dists)
+        elif modes is None:
+            coords = np.array([(endpoints[o]['lat'], endpoints[o]['lon'], endpoints[t]['lat'], endpoints[t]['lon'])
+                               for (request, o, t) in batch], dtype=np.float64)
+            dists, converged = vincenty_inverse_batch(coords[:, 0], coords[:, 1], coords[:, 2], coords[:, 3])
+
+        for i, (request, o, t) in enumerate(batch):
+            origin, target = endpoints[o], endpoints[t]
+            req = copy(request)
+            req['oid'] = origin['id']
+            req['tid'] = target['id']
+            req['fromPlace'] = "%s,%s" % (origin['lat'], origin['lon'])
+            req['toPlace'] = "%s,%s" % (target['lat'], target['lon'])
+            req['walkSpeed'] = 1.222
+
+            if modes is None:
+                # pairs where the distance did not converge keep their mode, as before
+                if converged[i] and dists[i] > (0.9/1000)*req['maxWalkDistance'] and req['mode'] in ('BICYCLE','WALK'):
+                    req['mode'] += ',TRANSIT'
+            else:
+                req['mode'] = modes
 
-        ret.append(req)
-
-    # TODO yield
-    return ret
+            yield req
+        n += len(batch)
 
 
 def getServerInfo(host):
@@ -200,6 +267,23 @@ def getServerInfo(host):
     return (sha1, version, cpuName, nCores)
 
 
+def request_class(params):
+    "Requests are grouped for latency statistics by mode, arriveBy and time of day, e.g. 'WALK,TRANSIT|arriveBy|14:00'"
+    mode = params['mode'] if 'mode' in params else params['modes']
+    return "%s|%s|%s" % (mode, 'arriveBy' if params.get('arriveBy') else 'departAt', params.get('time'))
+
+
+def client_latency(response):
+    """Client side wall-clock latency of a response in ms. In open-loop runs it is measured from the
+    scheduled send time. Responses from grequests only measure up to the response headers."""
+    if getattr(response, 'sent', None) is not None:
+        start = response.scheduled if response.scheduled is not None else response.sent
+        return (response.received - start) * 1000
+    if getattr(response, 'elapsed', None) is not None:
+        return response.elapsed.total_seconds() * 1000
+    return None
+
+
 # summarize the result for an itinerary planner request
 def summarize_plan(itinerary):
     routes = []
@@ -312,15 +396,51 @@ def summarize_profile_non_transit_leg(leg, leg_modes, leg_times):
         leg_times.append(times)
 
 
+class RunState(object):
+    """Everything a profiler run accumulates: the response rows, one file for summaries, one file for full
+    itineraries, and the progress counters. Every run gets its own, so that runs can go on in parallel threads."""
+
+    def __init__(self, label=None):
+        self.label = label  # prefixed to progress lines, to tell parallel runs apart
+        self.response_json = []
+        self.full_itins_json = []
+        self.writer = None  # summary_io.JsonlWriter when streaming output, rows and itineraries are then not kept
+        self.latency_histograms = {}  # request class -> Histogram of client side latencies
+        self.sampler = None  # telemetry.TelemetrySampler polling server metrics during the run
+        self.n = 0  # number of responses received
+        self.N = 0  # total number of responses expected
+        self.t0 = 0  # time that search begins
+        self.failures = None  # FailureMonitor when failing fast
+        self.stop = None  # event that tells the engines to stop sending, set by the failure monitor
+        self.store = None  # response_store.ResponseStore that raw responses are saved to
+
+    def record_outcome(self, row):
+        "Count a finished response row towards the failure ratio, stopping the run once the verdict is certain"
+        if self.failures is not None and self.failures.record(response_failure(row)) and self.stop is not None:
+            self.stop.set()
+
+    def record_latency(self, request_class, latency):
+        if request_class not in self.latency_histograms:
+            self.latency_histograms[request_class] = Histogram()
+        self.latency_histograms[request_class].record(latency)
+
+    def record_telemetry_sample(self, row):
+        "Link a response row to the latest server telemetry sample, the one taken while it was being handled"
+        if self.sampler is not None and self.sampler.samples:
+            row['telemetry_sample'] = len(self.sampler.samples) - 1
+
+
 # Generate a callback closure containing the unfinished row.
 # We could potentially avoid this by only saving the URL or query parameters, and not passing in a row.
-def response_callback_factory(row, profile):
+def response_callback_factory(state, row, profile):
     def handle_response(response, *args, **kwargs):
-        global n  # avoid "referenced before assignment" weirdness
-        n += 1
-        t = (time.time() - t0) / 60.0
-        T = (N * t) / n
-        print("Request %d/%d, time %0.2f min of %0.2f (estimated) received" % (n, N, t, T), response, )
+        if state.store is not None and not isinstance(response, response_store.StoredResponse):
+            state.store.put(row['url'], response.status_code, response.content)
+        state.n += 1
+        t = (time.time() - state.t0) / 60.0
+        T = (state.N * t) / state.n
+        print("%sRequest %d/%d, time %0.2f min of %0.2f (estimated) received" % (
+            '' if state.label is None else '[%s] ' % state.label, state.n, state.N, t, T), response, )
         n_itin = 0
         elapsed = 0
         itineraries = []
@@ -360,19 +480,32 @@ def response_callback_factory(row, profile):
                 row['avg_time'] = None if n_itin == 0 else '%f msec' % (float(elapsed) / n_itin)
 
         print(status)
-        response_id = len(response_json)  # not threadsafe -- not atomic with following line
-        response_json.append(row)
+        response_id = row['response_id']
+        if state.writer is None:
+            state.response_json.append(row)
         row['status'] = response.status_code
-        row['response_id'] = response_id
+
+        # Client side timing in seconds from the start of the run. Only async_engine responses carry it.
+        if getattr(response, 'sent', None) is not None:
+            row['sent_time'] = response.sent - state.t0
+            row['received_time'] = response.received - state.t0
+            if response.scheduled is not None:
+                row['scheduled_time'] = response.scheduled - state.t0
+
+        latency = client_latency(response)
+        if latency is not None:
+            row['latency_ms'] = latency
+            state.record_latency(row['request_class'], latency)
 
         # Create a row for each itinerary/option within this single trip planner result
+        row_itins = []
         if profile:
             for (option_number, option) in enumerate(options):
                 option_row = summarize_profile(option)
                 option_row['itinerary_number'] = option_number + 1
                 full_itin = {'response_id': response_id, 'itinerary_number': option_number + 1}
                 full_itin['body'] = option
-                full_itins_json.append(full_itin)
+                row_itins.append(full_itin)
                 row['itins'].append(option_row)
         else:
             for (itinerary_number, itinerary) in enumerate(itineraries):
@@ -381,95 +514,74 @@ def response_callback_factory(row, profile):
                 itin_row['itinerary_number'] = itinerary_number + 1
                 full_itin = {'response_id': response_id, 'itinerary_number': itinerary_number + 1}
                 full_itin['body'] = itinerary
-                full_itins_json.append(full_itin)
+                row_itins.append(full_itin)
                 row['itins'].append(itin_row)
 
+        state.record_telemetry_sample(row)
+        state.record_outcome(row)
+        if state.writer is not None:
+            state.writer.write_response(row, row_itins)
+        else:
+            state.full_itins_json.extend(row_itins)
+
         if SHOW_RESPONSE:
             pp.pprint(row)
-        response.connection.close();
+        # grequests opens a new connection per request, close it. async_engine pools its connections.
+        if response.connection is not None:
+            response.connection.close()
 
     # return the function definition, a closure for a specific instance of 'row'
     return handle_response
 
 
-def run(connect_args, requests_json=None):
-    global t0, N, response_json, full_itins_json, n  # HACK
-    response_json = []
-    full_itins_json = []
-    n = 0  # number of responses received
-    N = 0  # total number of responses expected
-    t0 = 0  # time that search begins
-
-    "This is the principal function..."
-    notes = connect_args.pop('notes')
-    # retry = connect_args.pop('retry')
-    fast = connect_args.pop('fast')
-    count = connect_args.pop('count')
-    host = connect_args.pop('host')
-    profile = connect_args.pop('profile')
-    Date = connect_args.pop('date')
-    Time = connect_args.pop('time')
-    num_itineraries = connect_args.pop('itineraries')
-    output = connect_args.pop('output')
-    modes = connect_args.pop('modes')
-
-    print("TEST DATE:", Date, Time)
-
-    print("profile=%s" % profile)
-    # info = getServerInfo(host)
-    # while retry > 0 and info == None:
-    #     print "Failed to connect to OTP server. Waiting to retry (%d)." % retry
-    #     time.sleep(10)
-    #     info = getServerInfo(host)
-    #     retry -= 1
-    #
-    # if info == None :
-    #     print "Failed to identify OTP version. Exiting."
-    #     exit(-2)
+def request_url(params, host, profile, Date, Time, num_itineraries):
+    "Complete the query parameters of a request from get_params in place, and return its URL"
+    params['date'] = Date
+    params['time'] = Time
+    if profile:
+        api_method = 'profile'
+        params['from'] = params.pop('fromPlace')
+        params['to'] = params.pop('toPlace')
+        params['modes'] = params.pop('mode')
+        params['limit'] = 3
+    else:
+        api_method = 'plan'
+        params['numItineraries'] = num_itineraries
 
-    # Create a dict describing this particular run of the profiler, which will be output as JSON
-    run_time_id = int(time.time())
-    run_row = (notes, run_time_id)
-    run_json = dict(zip(('notes', 'id'), run_row))
+    qstring = urlencode(params)
 
-    all_params = get_params(fast, count, requests_json=requests_json, modes=modes)
+    if "http" in host:
+        url = host
+    else:
+        url = "http://" + host
 
-    t0 = time.time()
-    N = len(all_params)
-    reqs = []
-    for params in all_params:
-        params = dict(params)  # TODO necessary?
-        request_id = params.pop('id')
-        oid = params.pop('oid')
-        tid = params.pop('tid')
+    # check if url path requires completion
+    if (not "/otp/routers" in host) and (not "/routing/v1/routers" in host):
+        url = url + "/routing/v1/routers/hsl"
 
-        params['date'] = Date
-        params['time'] = Time
-        if profile:
-            api_method = 'profile'
-            params['from'] = params.pop('fromPlace')
-            params['to'] = params.pop('toPlace')
-            params['modes'] = params.pop('mode')
-            params['limit'] = 3
-        else:
-            api_method = 'plan'
-            params['numItineraries'] = num_itineraries
+    if not url.endswith('/'):
+        url = url + "/"
 
-        qstring = urlencode(params)
+    return "%s%s?%s" % (url, api_method, qstring)
 
-        if "http" in host:
-            url = host
-        else:
-            url = "http://" + host
 
-        # check if url path requires completion
-        if (not "/otp/routers" in host) and (not "/routing/v1/routers" in host):
-            url = url + "/routing/v1/routers/hsl"
+def new_run_id(started):
+    """Id of a run, used in its file names and in the run store: the epoch second it started, which orders runs,
+    and a random suffix, because parallel runs (otpprofiler_json.py) start in the same second"""
+    return "%d-%s" % (started, uuid.uuid4().hex[:8])
 
-        if not url.endswith('/'):
-            url = url + "/"
 
-        url = "%s%s?%s" % (url, api_method, qstring)
+def build_jobs(state, indexed_params, host, profile, Date, Time, num_itineraries, run_time_id):
+    """Lazily turn (index, params) pairs from get_params into (url, callback) jobs for the request engines.
+    The index becomes the response_id, so ids follow the parameter order and not the order responses arrive in."""
+    for response_id, params in indexed_params:
+        params = dict(params)  # TODO necessary?
+        request_id = params.pop('id')
+        oid = params.pop('oid')
+        tid = params.pop('tid')
+        url = request_url(params, host, profile, Date, Time, num_itineraries)
+        # classed by the query as sent, with the run's time and not the template time of requests.json
+        rclass = request_class(params)
 
         # Tomcat server + spaces in URLs -> HTTP 505 confusion
         if SHOW_PARAMS:
@@ -479,39 +591,426 @@ def run(connect_args, requests_json=None):
             print(url)
         row = {'url': url,
                'run_id': run_time_id,
+               'response_id': response_id,
                'request_id': request_id,
                'origin_id': oid,
                'target_id': tid,
                'id_tuple': "%s-%s-%s" % (oid, tid, request_id),
                'mode': params['mode'] if 'mode' in params else params['modes'],
+               'request_class': rclass,
                'membytes': None, 'from': params['fromPlace'], 'to': params['toPlace']}
         # You can't give arguments to the response callback, you have to make a factory function:
         # "http://stackoverflow.com/questions/25115151/how-to-pass-parameters-to-hooks-in-python-grequests"
         # Closures are created in Python by function calls.
-        response_callback = response_callback_factory(row, profile)
-        headers = {'Accept': 'application/json'}
-        req = grequests.get(url, headers=headers, hooks=dict(response=response_callback))
-        reqs.append(req)
-
-    def exception_handler(request, exception):
-        raise exception
-
-    # Set max number of concurrent requests to 20, OTP should throttle this via worker threads
-    grequests.map(reqs, size=5, exception_handler=exception_handler)
+        response_callback = response_callback_factory(state, row, profile)
+        yield (url, response_callback)
+
+
+def resolve_engine(engine, rate):
+    "Check that the requested engine can run here, falling back from asyncio to grequests."
+    if engine == 'asyncio':
+        try:
+            import async_engine
+        except (ImportError, SyntaxError):
+            print("asyncio engine needs Python 3 and aiohttp, falling back to grequests")
+            engine = 'grequests'
+
+    if rate and engine != 'asyncio':
+        print("Open-loop load (--rate) needs the asyncio engine")
+        exit(-1)
+    return engine
+
+
+def send(jobs, engine, concurrency, rate, arrivals, stop=None, store=None):
+    """Send all (url, callback) jobs with the given engine, returning when every callback has run.
+    Once the stop event is set no more jobs are sent. The asyncio engine also abandons the requests in flight,
+    grequests lets them finish. The replay engine takes the responses from store."""
+    headers = {'Accept': 'application/json'}
+    if stop is not None:
+        jobs = itertools.takewhile(lambda job: not stop.is_set(), jobs)
+    if engine == 'replay':
+        print("engine=%s store=%s" % (engine, store.directory))
+        response_store.replay(jobs, store)
+    elif rate:
+        import async_engine
+        # open loop: requests in flight are not capped, they leave on schedule
+        print("engine=%s open-loop rate=%.2f/s arrivals=%s" % (engine, rate, arrivals))
+        async_engine.fetch_open_loop(jobs, rate, arrivals=arrivals, headers=headers, stop=stop)
+    elif engine == 'asyncio':
+        import async_engine
+        # OTP should throttle concurrent requests via worker threads, concurrency only caps what we send
+        print("engine=%s concurrency=%d" % (engine, concurrency))
+        async_engine.fetch_all(jobs, concurrency=concurrency, headers=headers, stop=stop)
+    else:
+        print("engine=%s concurrency=%d" % (engine, concurrency))
+        # python-requests no longer has first-class support for concurrent asynchronous HTTP requests
+        # the author has moved it to https://github.com/kennethreitz/grequests
+        # python-requests wraps urllib2 providing a much nicer API.
+        import grequests
+
+        def exception_handler(request, exception):
+            raise exception
+
+        # imap pulls requests from the generator as the pool frees up, map would build them all first
+        reqs = (grequests.get(url, headers=headers, hooks=dict(response=response_callback))
+                for (url, response_callback) in jobs)
+        for response in grequests.imap(reqs, size=concurrency, exception_handler=exception_handler):
+            pass
+
+
+# Multi-process runs.
+# A single process handles every response (JSON decoding, summarize_plan) in one Python thread, which caps the load
+# it can generate. With --workers N the parameters are dealt out round-robin over N processes: every worker runs
+# get_params itself, which is deterministic, and takes every Nth request, then sends them with its own engine. Workers stream every handled response back to the parent over a queue instead of collecting them, and
+# send their latency histograms when they are done. The parent keeps the response_id assigned from the parameter
+# order, so a sharded run numbers its responses exactly like a single process run.
+
+class QueueWriter(object):
+    "Stands in for the JsonlWriter in a worker process, forwarding each handled response to the parent."
+
+    def __init__(self, queue):
+        self.queue = queue
+
+    def write_response(self, row, full_itins=()):
+        self.queue.put(('response', row, full_itins))
+
+
+def _worker_main(queue, worker, workers, params_args, run_t0, label, stop, store, job_args, send_args):
+    state = RunState(label)
+    state.stop = stop  # set by the parent, which keeps the failure count of all workers
+    state.store = store
+    state.writer = QueueWriter(queue)
+    state.N = len(range(worker, params_args[1], workers))  # count
+    state.t0 = run_t0  # share the parent's start time so that sent/received times line up across workers
+    try:
+        shard = itertools.islice(enumerate(get_params(*params_args)), worker, None, workers)
+        send(build_jobs(state, shard, *job_args), *send_args, stop=stop, store=store)
+        queue.put(('done', dict((k, h.to_dict()) for k, h in state.latency_histograms.items())))
+    except BaseException:
+        queue.put(('error', traceback.format_exc()))
+
+
+def run_workers(state, params_args, workers, job_args, send_args):
+    """Run the requests over a pool of worker processes, collecting their responses into the run state.
+    params_args are the positional arguments of get_params."""
+    engine, concurrency, rate, arrivals = send_args
+    if rate:
+        # every worker takes its share of the arrival rate
+        send_args = (engine, concurrency, float(rate) / workers, arrivals)
+    queue = multiprocessing.Queue()
+    stop = None
+    if state.failures is not None:
+        stop = state.stop = multiprocessing.Event()
+    procs = [multiprocessing.Process(target=_worker_main,
+                                     args=(queue, i, workers, params_args, state.t0, state.label, stop, state.store,
+                                           job_args, send_args))
+             for i in range(workers)]
+    for proc in procs:
+        proc.start()
+
+    done = 0
+    while done < workers:
+        try:
+            msg = queue.get(timeout=5)
+        except Empty:
+            if not any(proc.is_alive() for proc in procs):
+                raise RuntimeError("profiler worker processes exited without finishing")
+            continue
+        if msg[0] == 'response':
+            row, row_itins = msg[1], msg[2]
+            state.record_telemetry_sample(row)
+            state.record_outcome(row)
+            if state.writer is not None:
+                state.writer.write_response(row, row_itins)
+            else:
+                state.response_json.append(row)
+                state.full_itins_json.extend(row_itins)
+        elif msg[0] == 'done':
+            for request_class, d in msg[1].items():
+                if request_class not in state.latency_histograms:
+                    state.latency_histograms[request_class] = Histogram()
+                state.latency_histograms[request_class].merge(Histogram.from_dict(d))
+            done += 1
+        else:
+            for proc in procs:
+                proc.terminate()
+            raise RuntimeError("profiler worker failed:\n" + msg[1])
+
+    for proc in procs:
+        proc.join()
+    state.response_json.sort(key=lambda row: row['response_id'])
+
+
+# Warm-up.
+# OTP runs on the JVM, and the first few hundred plan requests after a deploy are much slower while HotSpot compiles
+# the routing code and caches fill. With --warmup N a sample of N requests is replayed in windows of --warmupwindow
+# requests before the measured run starts, until the median latency of WARMUP_STEADY_WINDOWS consecutive windows
+# changes by less than --warmuptolerance, or --warmupmax requests have been sent. Warm-up responses are not recorded,
+# but the curve of window medians is kept in the run summary.
+
+WARMUP_STEADY_WINDOWS = 2
+
+
+def median(values):
+    values = sorted(values)
+    mid = len(values) // 2
+    return values[mid] if len(values) % 2 else (values[mid - 1] + values[mid]) / 2.0
+
+
+def warm_up(urls, engine, concurrency, window, tolerance, max_requests):
+    "Replay urls until latency levels off, returns the warm-up record for the run summary"
+    started = time.time()
+    curve = []
+    sent = 0
+    steady = False
+    urls = itertools.cycle(urls)
+    while sent < max_requests and not steady:
+        latencies = []
+
+        def handle_warmup_response(response, *args, **kwargs):
+            latency = client_latency(response)
+            if latency is not None:
+                latencies.append(latency)
+            if response.connection is not None:
+                response.connection.close()
+
+        jobs = [(next(urls), handle_warmup_response) for i in range(min(window, max_requests - sent))]
+        send(jobs, engine, concurrency, None, None)
+        sent += len(jobs)
+        if not latencies:
+            break
+        curve.append(median(latencies))
+        print("warm-up: %d requests, window median latency %.1f msec" % (sent, curve[-1]))
+        steady = len(curve) > WARMUP_STEADY_WINDOWS and all(
+            abs(curve[-i] - curve[-i - 1]) <= tolerance * curve[-i - 1] for i in range(1, WARMUP_STEADY_WINDOWS + 1))
+
+    print("warm-up %s after %d requests" % ("reached steady state" if steady else "stopped", sent))
+    return {'requests': sent, 'duration': time.time() - started, 'steady': steady,
+            'window': window, 'tolerance': tolerance, 'curve': curve}
+
+
+# Fail-fast.
+# A response fails when the request did not return any itineraries that keep to the walk limit. When a data import
+# has broken a router nearly every request fails, and there is no need to wait for the rest of the run (or their
+# timeouts) to know it. With --failfast LIMIT every finished response feeds a sequential probability ratio test
+# of failure rate FAILFAST_DELTA above the limit against FAILFAST_DELTA below it. Once the failure ratio is certain
+# to be above the limit (at error rate FAILFAST_ALPHA) the queued requests are dropped and the ones in flight are
+# cancelled. With --stoponpass the run also stops when the ratio is certain to stay under the limit.
+
+FAILFAST_DELTA = 0.05
+FAILFAST_ALPHA = 0.01
+
+
+def response_failure(row):
+    "'failed' for a failed request or one whose itineraries all exceed the walk limit, 'none' for no itineraries"
+    if not 'itins' in row:
+        return 'failed'
+    if len(row['itins']) == 0:
+        return 'none'
+    if all((itin['walk_limit_exceeded'] for itin in row['itins'])):
+        return 'failed'
+    return None
+
+
+class FailureMonitor(object):
+    """Live failure count of a run with Wald's sequential probability ratio test against a ratio limit."""
+
+    def __init__(self, limit, stop_on_pass=False, delta=FAILFAST_DELTA, alpha=FAILFAST_ALPHA):
+        self.limit = limit
+        self.stop_on_pass = stop_on_pass
+        p0 = max(limit - delta, delta / 10.0)
+        p1 = min(limit + delta, 1 - delta / 10.0)
+        self.step_failed = math.log(p1 / p0)
+        self.step_ok = math.log((1 - p1) / (1 - p0))
+        self.upper = math.log((1 - alpha) / alpha)
+        self.lower = -self.upper
+        self.llr = 0.0
+        self.counts = {'failed': 0, 'none': 0}
+        self.n = 0
+        self.verdict = None  # 'fail' or 'pass' once the test has decided
+        self.decided_after = None
+
+    def record(self, failure):
+        "Count a response_failure() outcome. Returns True when the run should stop."
+        self.n += 1
+        if failure is not None:
+            self.counts[failure] += 1
+        if self.verdict is None:
+            self.llr += self.step_failed if failure is not None else self.step_ok
+            if self.llr >= self.upper:
+                self.verdict = 'fail'
+            elif self.llr <= self.lower:
+                self.verdict = 'pass'
+            if self.verdict is not None:
+                self.decided_after = self.n
+                print("failure ratio is %s %.2f after %d responses (%d failed)" % (
+                    'above' if self.verdict == 'fail' else 'below', self.limit, self.n,
+                    self.counts['failed'] + self.counts['none']))
+        return self.verdict == 'fail' or (self.verdict == 'pass' and self.stop_on_pass)
+
+    def ratio(self):
+        return (self.counts['failed'] + self.counts['none']) / float(self.n) if self.n else 0.0
+
+    def summary(self, stopped):
+        """Failure counts for the run summary. 'failed' is the verdict of the test if it stopped the run,
+        otherwise whether the ratio over all responses is above the limit."""
+        return {'limit': self.limit, 'responses': self.n, 'failed_responses': self.counts['failed'],
+                'none': self.counts['none'], 'ratio': self.ratio(), 'verdict': self.verdict,
+                'decided_after': self.decided_after, 'stopped': stopped,
+                'failed': self.verdict == 'fail' if stopped else self.ratio() > self.limit}
 
-    # Write out all results at the end. Really, this should probably be done in streaming fashion.
 
-    run_json['responses'] = response_json
+def run(connect_args, requests_json=None):
+    """This is the principal function...
+    All state of the run is kept in a RunState, so several runs can be made at the same time from threads.
+    Returns the run summary dict. With streaming output (jsonl) the response rows are only written to the
+    run_summary.ID.jsonl file, and the dict has its name as 'summary_file' instead of 'responses'."""
+    notes = connect_args.pop('notes')
+    # retry = connect_args.pop('retry')
+    fast = connect_args.pop('fast')
+    count = connect_args.pop('count')
+    host = connect_args.pop('host')
+    profile = connect_args.pop('profile')
+    Date = connect_args.pop('date')
+    Time = connect_args.pop('time')
+    num_itineraries = connect_args.pop('itineraries')
+    output = connect_args.pop('output')
+    jsonl = connect_args.pop('jsonl', False)
+    npz = connect_args.pop('npz', False)
+    runstore_file = connect_args.pop('runstore', None)
+    modes = connect_args.pop('modes')
+    engine = connect_args.pop('engine', 'asyncio')
+    concurrency = connect_args.pop('concurrency', 5)
+    rate = connect_args.pop('rate', None)
+    arrivals = connect_args.pop('arrivals', 'constant')
+    workers = connect_args.pop('workers', 1)
+    warmup = connect_args.pop('warmup', 0)
+    warmup_window = connect_args.pop('warmupwindow', 50)
+    warmup_tolerance = connect_args.pop('warmuptolerance', 0.1)
+    warmup_max = connect_args.pop('warmupmax', 2000)
+    metrics_url = connect_args.pop('metricsurl', None)
+    metrics_interval = connect_args.pop('metricsinterval', 1.0)
+    failfast = connect_args.pop('failfast', None)
+    store = connect_args.pop('store', None)
+    stop_on_pass = connect_args.pop('stoponpass', False)
+    state = RunState(connect_args.pop('label', None))
+    if failfast is not None:
+        state.failures = FailureMonitor(failfast, stop_on_pass)
+        state.stop = threading.Event()
+    if store is not None or engine == 'replay':
+        state.store = response_store.ResponseStore(store or response_store.STORE_DIR)
 
-    if output:
-        fpout = open("run_summary.%s.json" % run_time_id, "w")
+    print("TEST DATE:", Date, Time)
 
-        json.dump(run_json, fpout, indent=2)
-        fpout.close()
+    print("profile=%s" % profile)
+    # info = getServerInfo(host)
+    # while retry > 0 and info == None:
+    #     print "Failed to connect to OTP server. Waiting to retry (%d)." % retry
+    #     time.sleep(10)
+    #     info = getServerInfo(host)
+    #     retry -= 1
+    #
+    # if info == None :
+    #     print "Failed to identify OTP version. Exiting."
+    #     exit(-2)
 
-        fpout = open("full_itins.%s.json" % run_time_id, "w")
-        json.dump(full_itins_json, fpout, indent=2)
-        fpout.close()
+    # Create a dict describing this particular run of the profiler, which will be output as JSON
+    started = int(time.time())
+    run_time_id = new_run_id(started)
+    run_row = (notes, run_time_id, started)
+    run_json = dict(zip(('notes', 'id', 'started'), run_row))
+    if rate:
+        run_json['rate'] = rate
+        run_json['arrivals'] = arrivals
+
+    if jsonl:
+        state.writer = summary_io.JsonlWriter(run_json)
+
+    engine = resolve_engine(engine, rate)
+
+    if metrics_url:
+        print("sampling server metrics from %s every %.1f s" % (metrics_url, metrics_interval))
+        state.sampler = telemetry.TelemetrySampler(metrics_url, metrics_interval)
+        state.sampler.start()
+
+    if requests_json is None:
+        requests_json = json.load(open("requests.json"))
+    if modes is None:
+        # build the endpoint distance cache, if it is not there yet, before the clock starts
+        endpoint_distances(requests_json['endpoints'], count)
+
+    if warmup and engine != 'replay':
+        urls = []
+        # every kth request of the run, spread over all request types and endpoints
+        step = max(1, count // warmup)
+        sample = get_params(fast, count, requests_json=requests_json, modes=modes)
+        for params in itertools.islice(sample, 0, step * warmup, step):
+            params = dict(params)
+            for key in ('id', 'oid', 'tid'):
+                params.pop(key)
+            urls.append(request_url(params, host, profile, Date, Time, num_itineraries))
+        run_json['warmup'] = warm_up(urls, engine, concurrency, warmup_window, warmup_tolerance, warmup_max)
+
+    state.t0 = time.time()
+    state.N = count
+    job_args = (host, profile, Date, Time, num_itineraries, run_time_id)
+    send_args = (engine, concurrency, rate, arrivals)
+    if workers > 1:
+        run_workers(state, (fast, count, "requests.json", requests_json, modes), workers, job_args, send_args)
+    else:
+        all_params = get_params(fast, count, requests_json=requests_json, modes=modes)
+        send(build_jobs(state, enumerate(all_params), *job_args), *send_args, stop=state.stop, store=state.store)
+
+    if state.failures is not None:
+        stopped = state.stop.is_set()
+        run_json['failures'] = state.failures.summary(stopped)
+        if stopped:
+            print("stopped early after %d of %d responses" % (state.failures.n, count))
+
+    if state.sampler is not None:
+        # sample times are relative to the start of the measured run like sent_time, warm-up samples are negative
+        samples = state.sampler.stop()
+        for sample in samples:
+            sample['time'] -= state.t0
+        run_json['telemetry'] = {'url': metrics_url, 'interval': metrics_interval, 'samples': samples}
+        state.sampler = None
+
+    run_json['latency'] = histogram.summarize(state.latency_histograms)
+    latency = run_json['latency']['all']
+    if latency['count']:
+        print("client latency (msec): p50 %.1f p90 %.1f p99 %.1f p999 %.1f max %.1f" % tuple(
+            latency[k] for k in ('p50', 'p90', 'p99', 'p999', 'max')))
+
+    if state.writer is not None:
+        # the writer copied run_json when it was opened, before warm-up
+        state.writer.close(warmup=run_json.get('warmup'), latency=run_json['latency'],
+                           telemetry=run_json.get('telemetry'), failures=run_json.get('failures'))
+        run_json['n_responses'] = state.writer.meta['n_responses']
+        run_json['summary_file'] = state.writer.summary_filename
+        state.writer = None
+    else:
+        run_json['responses'] = state.response_json
+        if output:
+            # Write out all results at the end. Use -j to stream them instead.
+            fpout = open("run_summary.%s.json" % run_time_id, "w")
+
+            json.dump(run_json, fpout, indent=2)
+            fpout.close()
+
+            fpout = open("full_itins.%s.json" % run_time_id, "w")
+            json.dump(state.full_itins_json, fpout, indent=2)
+            fpout.close()
+    if npz:
+        # columnar copy of the run summary, see summary_io.py. Streamed rows are read back for it.
+        summary_io.write_npz(summary_io.load_summary(run_json['summary_file']) if 'summary_file' in run_json
+                             else run_json, "run_summary.%s.npz" % run_time_id)
+    if runstore_file:
+        store = runstore.RunStore(runstore_file)
+        if 'summary_file' in run_json:
+            store.ingest(run_json['summary_file'])
+        else:
+            store.add_run(run_json)
+        store.close()
     return run_json
 
 
@@ -532,6 +1031,23 @@ if __name__ == "__main__":
     parser.add_argument('-i', '--itineraries', type=int, default=1) # number of itineraries
     parser.add_argument('-o', '--output', action='store_true', default=False) # generate run_summary and full_itins files
     parser.add_argument('-m', '--modes', type=str, default=None) # Define modes used in requests, for example "BICYCLE,TRANSIT"
+    parser.add_argument('-j', '--jsonl', action='store_true', default=False) # stream run_summary and full_itins as JSON lines
+    parser.add_argument('-z', '--npz', action='store_true', default=False) # also write run_summary in the columnar .npz format
+    parser.add_argument('--runstore', default=None) # add the run to this SQLite run store, see runstore.py
+    parser.add_argument('-e', '--engine', choices=ENGINES, default='asyncio') # HTTP engine, grequests is the fallback, replay reads --store
+    parser.add_argument('-s', '--store', default=None) # save raw responses to this response store directory, see response_store.py
+    parser.add_argument('--concurrency', type=int, default=5) # max number of requests in flight
+    parser.add_argument('--rate', type=float, default=None) # open-loop load: send requests at this rate (requests/s) regardless of responses
+    parser.add_argument('--arrivals', choices=('constant', 'poisson'), default='constant') # arrival schedule for --rate
+    parser.add_argument('-w', '--workers', type=int, default=1) # split the run over this many processes
+    parser.add_argument('--warmup', type=int, default=0) # replay a sample of this many requests until latency levels off
+    parser.add_argument('--warmupwindow', type=int, default=50) # warm-up requests per latency window
+    parser.add_argument('--warmuptolerance', type=float, default=0.1) # steady when window medians change less than this
+    parser.add_argument('--warmupmax', type=int, default=2000) # give up warming up after this many requests
+    parser.add_argument('--metricsurl', default=None) # server metrics endpoint to sample during the run, see telemetry.py
+    parser.add_argument('--metricsinterval', type=float, default=1.0) # seconds between metrics samples
+    parser.add_argument('--failfast', type=float, default=None) # stop as soon as the failure ratio is certain to exceed this
+    parser.add_argument('--stoponpass', action='store_true', default=False) # with --failfast, also stop once it is certain to stay under
     args = parser.parse_args()
 
     # args is a non-iterable, non-mapping Namespace (allowing usage in the form args.name),
@@ -7,6 +7,7 @@ import os
 import otpprofiler
 import json
 import hreport
+from concurrent.futures import ThreadPoolExecutor
 
 
 RATIO_LIMIT = 0.2
@@ -23,72 +24,88 @@ test_routers = set(router_sites.keys())
 if len(sys.argv) == 3:
     test_routers = set(sys.argv[2].split(','))
 
-print('TARGET OTP',OTP_URL)
-for router, rsites in ((tr, router_sites[tr]) for tr in test_routers):
-    print(router)
+# Every run stops as soon as its failure ratio is certain to exceed RATIO_LIMIT, see otpprofiler.FailureMonitor.
+# With OTPQA_STOP_ON_PASS=1 it also stops once the ratio is certain to stay under it, which makes for shorter
+# reports.
+STOP_ON_PASS = os.getenv('OTPQA_STOP_ON_PASS', '0') == '1'
+
+# Sites are profiled in parallel threads. OTPQA_CONCURRENCY requests are in flight per site and OTPQA_BUDGET
+# caps the requests in flight over all sites, so OTPQA_BUDGET // OTPQA_CONCURRENCY sites run at a time.
+CONCURRENCY = int(os.getenv('OTPQA_CONCURRENCY', 5))
+BUDGET = int(os.getenv('OTPQA_BUDGET', 20))
+
+
+def profile_site(router_url, site):
+    params = {
+        'date': otpprofiler.DATE,
+        'time': '14:00',
+        'retry': 5,
+        'count': int(os.getenv('OTPQA_COUNT',200)),
+        'notes': None,
+        'fast': False,
+        'profile': False,
+        'host': router_url,
+        'itineraries': 1,
+        'output': False,
+        'modes': None,
+        'engine': 'asyncio',
+        'concurrency': CONCURRENCY,
+        'failfast': RATIO_LIMIT,
+        'stoponpass': STOP_ON_PASS,
+        'label': site['name']
+    }
+    return otpprofiler.run(params, requests_json=site['requests'])
 
 
+print('TARGET OTP',OTP_URL)
+parallel = max(1, BUDGET // CONCURRENCY)
+if otpprofiler.resolve_engine('asyncio', None) != 'asyncio':
+    parallel = 1  # grequests monkeypatches threads with gevent, run the sites one at a time
+print('sites in parallel:', parallel)
+
+pool = ThreadPoolExecutor(max_workers=parallel)
+runs = []
+for router in test_routers:
     router_url = OTP_URL
     if OTP_URL.find('%s') > -1:
         router_url = OTP_URL % router
+    runs.append((router, [(site, pool.submit(profile_site, router_url, site)) for site in router_sites[router]]))
+
+# reports are written in router and site order as the runs finish
+for router, site_runs in runs:
+    print(router)
 
     f = open('otpqa_report_%s.html' % router, 'w+')
-    for site in rsites:
+    for site, future in site_runs:
+        response_json = future.result()
         print(site['name'])
-        nfailed = 0
-        nnone = 0
-        totaln = 0
-
-        params = {
-            'date': otpprofiler.DATE,
-            'time': '14:00',
-            'retry': 5,
-            'count': int(os.getenv('OTPQA_COUNT',200)),
-            'notes': None,
-            'fast': False,
-            'profile': False,
-            'host': router_url,
-            'itineraries': 1,
-            'output': False,
-            'modes': None
-
-        }
-        response_json = otpprofiler.run(params, requests_json=site['requests'])
-
+        failures = response_json['failures']
 
-        for r in response_json['responses']:
-            if not 'itins' in r:
-                nfailed += 1
-                continue
-
-            if all((itin['walk_limit_exceeded'] for itin in r['itins'])):
-                nfailed += 1
-                continue
-
-            if len(r['itins']) == 0:
-                nnone += 1
-
-        totaln += float(len(response_json['responses']))
-
-        ratio = (nfailed + nnone) / totaln
-
-        print('total:', totaln, 'failed:', nfailed, 'none:', nnone, 'ratio:', ratio)
-
-        report_html = ''.join(hreport.main(None, response_json, site['name']))
+        print('total:', failures['responses'], 'failed:', failures['failed_responses'], 'none:', failures['none'],
+              'ratio:', failures['ratio'])
+        if failures['stopped']:
+            print('stopped early, failure ratio certainly', 'above' if failures['verdict'] == 'fail' else 'below',
+                  RATIO_LIMIT)
 
         f.write('<h1>%s</h1>' % site['name'])
-        f.write(report_html)
+        # written as it is generated, large sites get their own pages linked from here
+        hreport.write_report(f, input_blob=response_json, dt_url=site['name'],
+                             page_prefix='otpqa_report_%s_%s' % (router, site['name']))
 
-        if ratio > RATIO_LIMIT:
+        if failures['failed']:
             print('FAILED RATIO >',RATIO_LIMIT)
             f.close()
+            # sites that have not started yet are skipped, running ones are waited for
+            for _, other_runs in runs:
+                for _, other in other_runs:
+                    other.cancel()
+            pool.shutdown()
             sys.exit(1)
 
     f.close()
 
-
+pool.shutdown()
 
 
 
 sys.exit(0)
-
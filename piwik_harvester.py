@@ -0,0 +1,238 @@
+from __future__ import print_function
+
+# Asynchronous harvesting of route search page urls from Piwik, for generate_piwik_requests.py.
+# Every site has a 'reitti' page url table whose sub-tables list the from places searched, and each of those has a
+# sub-table of the to places. All sites and all their sub-tables are fetched concurrently over one aiohttp session,
+# so the TLS handshake with the client certificate is made once per connection and not once per request. Requests
+# are paced by a token bucket, and failed ones (connection errors, timeouts, 429 and 5xx responses) are retried with
+# exponential backoff. Other 4xx responses fail just the table requested: it is reported and left out, and not
+# written to the checkpoint, so that a harvest started again with the same checkpoint asks for it again.
+#
+# Progress is appended to a checkpoint file, one JSON object per line:
+#   {'period': ..., 'date': ...}                                    header, the harvest the file belongs to
+#   {'site': ID, 'from': [[label, idsubdatatable, hits], ...]}      the from places of a site
+#   {'site': ID, 'subtable': IDSUB, 'to': [[label, hits], ...]}     one finished to place sub-table
+# An interrupted harvest started again with the same checkpoint only fetches what is missing. A checkpoint of
+# another day or period is started over. Requires Python 3 and aiohttp.
+
+import asyncio
+import datetime
+import json
+import os
+import random
+import ssl
+import time
+
+import aiohttp
+
+import summary_io
+
+RATE = 10.0  # requests per second
+BURST = 20
+CONCURRENCY = 20  # connections
+RETRIES = 5
+BACKOFF = 1.0  # seconds before the first retry, doubled for every next one
+TIMEOUT = 120  # seconds per request
+FILTER_LIMIT = 5000
+
+
+class TokenBucket(object):
+    """Allows rate acquisitions per second on average and bursts of up to burst at once."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+
+    async def acquire(self):
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class RetryableError(Exception):
+    pass
+
+
+class RequestFailed(Exception):
+    "A request Piwik answered with a 4xx status other than 429, which retrying will not fix"
+    pass
+
+
+def clean_label(label):
+    label = label.strip('/')
+    return label[:label.find('?')]
+
+
+class Harvester(object):
+
+    def __init__(self, baseurl, token, client_cert=None, period='month', checkpoint=None,
+                 rate=RATE, burst=BURST, concurrency=CONCURRENCY, retries=RETRIES):
+        self.baseurl = baseurl
+        self.token = token
+        self.client_cert = client_cert
+        self.period = period
+        self.checkpoint = checkpoint
+        self.bucket = TokenBucket(rate, burst)
+        self.concurrency = concurrency
+        self.retries = retries
+        self.session = None
+        self.fp_checkpoint = None
+        self.done_from = {}  # site -> from places of a previous attempt
+        self.done_to = {}  # (site, idsubdatatable) -> to places of a previous attempt
+        self.n_requests = 0
+        self.failed = []  # (site, idsubdatatable or None, error) of the tables that could not be fetched
+
+    def api_url(self, method, **params):
+        params = dict(params, module='API', method=method, format='JSON', token_auth=self.token)
+        return '%s/?%s' % (self.baseurl, '&'.join('%s=%s' % kv for kv in sorted(params.items())))
+
+    async def get_json(self, url):
+        delay = BACKOFF
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                self.n_requests += 1
+                async with self.session.get(url, headers={'Accept': 'application/json'}) as r:
+                    if r.status == 429 or r.status >= 500:
+                        raise RetryableError('HTTP %d' % r.status)
+                    if r.status >= 400:
+                        raise RequestFailed('HTTP %d: %s' % (r.status, url.replace(self.token, '***')))
+                    return await r.json(content_type=None)
+            except (aiohttp.ClientConnectionError, aiohttp.ClientPayloadError, asyncio.TimeoutError,
+                    RetryableError) as e:
+                if attempt == self.retries:
+                    raise
+                print('retrying in %.1f s after %r: %s' % (delay, e, url.replace(self.token, '***')))
+                await asyncio.sleep(delay * (0.5 + random.random()))
+                delay *= 2
+
+    # checkpoint
+
+    def load_checkpoint(self, date):
+        header = {'period': self.period, 'date': date}
+        if os.path.exists(self.checkpoint):
+            records = summary_io.iter_jsonl(self.checkpoint)
+            if next(records, None) == header:
+                for record in records:
+                    if 'from' in record:
+                        self.done_from[record['site']] = record['from']
+                    else:
+                        self.done_to[(record['site'], record['subtable'])] = record['to']
+                print('resuming harvest from %s: %d sites, %d sub-tables done' % (
+                    self.checkpoint, len(self.done_from), len(self.done_to)))
+                self.fp_checkpoint = open(self.checkpoint, 'a')
+                return
+            print('%s is from another harvest, starting over' % self.checkpoint)
+        self.fp_checkpoint = open(self.checkpoint, 'w')
+        self.save(header)
+
+    def save(self, record):
+        if self.fp_checkpoint is not None:
+            self.fp_checkpoint.write(json.dumps(record) + '\n')
+            self.fp_checkpoint.flush()
+
+    # harvest
+
+    def skip(self, siteid, idsubdatatable, error):
+        print('skipping site %s sub-table %s after %s' % (siteid, idsubdatatable, error))
+        self.failed.append((siteid, idsubdatatable, str(error)))
+
+    async def from_places(self, siteid):
+        "[label, idsubdatatable, hits] of the from places of a site, or None when it has no reitti page"
+        if siteid in self.done_from:
+            return self.done_from[siteid]
+        try:
+            pageurls = await self.get_json(self.api_url(
+                'Actions.getPageUrls', idSite=siteid, period=self.period, date='today',
+                filter_column='label', filter_pattern='^reitti$'))
+            if len(pageurls) == 0 or pageurls[0]['label'] != 'reitti':
+                print('Retrieving page url for reitti-pages failed for sited %s' % siteid)
+                return None
+
+            frompageurls = await self.get_json(self.api_url(
+                'Actions.getPageUrls', idSite=siteid, period=self.period, date='today', filter_limit=FILTER_LIMIT,
+                idSubtable=pageurls[0]['idsubdatatable']))
+        except RequestFailed as e:
+            self.skip(siteid, None, e)
+            return None
+        ret = []
+        for fpu in frompageurls:
+            if fpu['label'] == 'Others':
+                continue
+            if 'idsubdatatable' not in fpu:
+                continue
+            if fpu['label'].strip() == '':
+                continue
+            ret.append([clean_label(fpu['label']), fpu['idsubdatatable'], fpu['nb_hits']])
+        self.save({'site': siteid, 'from': ret})
+        return ret
+
+    async def to_places(self, siteid, idsubdatatable):
+        "[label, hits] of the to places searched from one from place"
+        key = (siteid, idsubdatatable)
+        if key in self.done_to:
+            return self.done_to[key]
+        try:
+            tourls = await self.get_json(self.api_url(
+                'Actions.getPageUrls', idSite=siteid, period=self.period, date='today', filter_limit=FILTER_LIMIT,
+                idSubtable=idsubdatatable))
+        except RequestFailed as e:
+            self.skip(siteid, idsubdatatable, e)
+            return []
+        ret = [[clean_label(tu['label']), tu['nb_hits']] for tu in tourls
+               if tu['label'] != 'Others' and tu['label'].strip() != '']
+        self.save({'site': siteid, 'subtable': idsubdatatable, 'to': ret})
+        return ret
+
+    async def site_places(self, siteid, accept):
+        """{label: hits} of a site: the hits of every from place, plus the hits of the to places searched from
+        accepted from places that are accepted themselves. accept(label) tells a place label apart from others."""
+        froms = await self.from_places(siteid)
+        if froms is None:
+            return None
+        places = dict((label, hits) for label, idsubdatatable, hits in froms)
+        tos = await asyncio.gather(*[self.to_places(siteid, idsubdatatable)
+                                     for label, idsubdatatable, hits in froms])
+        for (label, idsubdatatable, hits), to in zip(froms, tos):
+            if not accept(label):
+                continue
+            for tolabel, tohits in to:
+                if accept(tolabel):
+                    places[tolabel] = places.get(tolabel, 0) + tohits
+        print(siteid, len(froms), 'sub-tables done')
+        return places
+
+    async def _harvest(self, siteids, accept):
+        ssl_context = ssl.create_default_context()
+        if self.client_cert is not None:
+            ssl_context.load_cert_chain(self.client_cert)
+        connector = aiohttp.TCPConnector(ssl=ssl_context, limit=self.concurrency)
+        timeout = aiohttp.ClientTimeout(total=TIMEOUT)
+        async with aiohttp.ClientSession(connector=connector, timeout=timeout) as self.session:
+            sites = await self.get_json(self.api_url('SitesManager.getSitesWithAtLeastViewAccess'))
+            available = set(psite['idsite'] for psite in sites)
+            siteids = [siteid for siteid in siteids if siteid in available]
+            places = await asyncio.gather(*[self.site_places(siteid, accept) for siteid in siteids])
+        return dict((siteid, p) for siteid, p in zip(siteids, places) if p is not None)
+
+    def harvest(self, siteids, accept):
+        "{siteid: {label: hits}} of those of siteids that Piwik has, see site_places"
+        if self.checkpoint is not None:
+            self.load_checkpoint(datetime.date.today().isoformat())
+        started = time.time()
+        try:
+            return asyncio.run(self._harvest(siteids, accept))
+        finally:
+            if self.fp_checkpoint is not None:
+                self.fp_checkpoint.close()
+            print('%d requests in %.1f s' % (self.n_requests, time.time() - started))
+            if self.failed:
+                print('%d tables could not be fetched and were left out, run again with the same checkpoint to '
+                      'retry them' % len(self.failed))
@@ -0,0 +1,97 @@
+from __future__ import print_function
+
+# Content-addressed store of raw router responses.
+# A run summary only keeps what summarize_plan and summarize_profile took from each response, so changing either of
+# them, or what compare.py looks at, used to mean querying the router again. With --store DIR every response body is
+# also saved, gzipped, under the sha1 of its request URL:
+#   DIR/ab/ab12...ef.gz    a JSON header line {'url', 'status'} followed by the body exactly as received
+# The replay engine (-e replay) answers requests from the store instead of the network, so a run made with the same
+# date, time, count and endpoints goes through the normal response callbacks without any router. Replayed responses
+# have no client side latency. Requests whose URL is not in the store are skipped.
+
+import gzip
+import hashlib
+import json
+import os
+import tempfile
+
+STORE_DIR = os.getenv('OTPQA_STORE', 'response_store')
+
+
+def url_key(url):
+    return hashlib.sha1(url.encode('utf-8')).hexdigest()
+
+
+class StoredResponse(object):
+    """A response read back from the store, with the attributes the profiler response callbacks use."""
+
+    connection = None
+
+    def __init__(self, url, status_code, content):
+        self.url = url
+        self.status_code = status_code
+        self.content = content
+
+    def json(self):
+        return json.loads(self.content.decode('utf-8'))
+
+    def __repr__(self):
+        return '<StoredResponse [%s]>' % self.status_code
+
+
+class ResponseStore(object):
+
+    def __init__(self, directory=STORE_DIR):
+        self.directory = directory
+
+    def path(self, url):
+        key = url_key(url)
+        return os.path.join(self.directory, key[:2], key + '.gz')
+
+    def __contains__(self, url):
+        return os.path.exists(self.path(url))
+
+    def put(self, url, status_code, content):
+        path = self.path(url)
+        if not os.path.isdir(os.path.dirname(path)):
+            try:
+                os.makedirs(os.path.dirname(path))
+            except OSError:
+                pass  # made by a parallel run in the meantime
+        # written aside and renamed into place, parallel runs may store the same URL
+        fd, tmpname = tempfile.mkstemp(suffix='.gz', dir=os.path.dirname(path))
+        fileobj = os.fdopen(fd, 'wb')
+        fp = gzip.GzipFile(fileobj=fileobj, mode='wb')
+        fp.write(json.dumps({'url': url, 'status': status_code}).encode('utf-8') + b'\n')
+        fp.write(content)
+        fp.close()
+        fileobj.close()
+        os.chmod(tmpname, 0o644)
+        os.rename(tmpname, path)
+
+    def get(self, url):
+        "The stored response for url, or None"
+        path = self.path(url)
+        if not os.path.exists(path):
+            return None
+        fp = gzip.open(path, 'rb')
+        header = json.loads(fp.readline().decode('utf-8'))
+        content = fp.read()
+        fp.close()
+        return StoredResponse(header['url'], header['status'], content)
+
+
+def replay(jobs, store, stop=None):
+    "Call the callback of every (url, callback) job with its stored response, returning the number of URLs missing"
+    missing = 0
+    for url, callback in jobs:
+        if stop is not None and stop.is_set():
+            break
+        response = store.get(url)
+        if response is None:
+            missing += 1
+            continue
+        callback(response)
+    if missing:
+        print("%d requests were not in the response store %s" % (missing, store.directory))
+    return missing
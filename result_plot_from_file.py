@@ -1,4 +1,6 @@
-import json, violin
+from __future__ import print_function
+import violin
+import summary_io
 
 def plot_results(dataset, label):
 
@@ -18,8 +20,9 @@ if __name__=='__main__':
     import sys
 
     if len(sys.argv)<3:
-        print "usage: cmd json_summary_file_name plot_label"
+        print("usage: cmd json_summary_file_name plot_label")
         exit()
 
-    dataset = json.load(open(sys.argv[1]))
+    # only total_time is read from .npz summaries
+    dataset = summary_io.load_summary(sys.argv[1], columns=('total_time',))
     plot_results(dataset, sys.argv[2])
@@ -0,0 +1,194 @@
+from __future__ import print_function
+
+# Historical store of profiler runs in SQLite.
+# compare.py only compares two summaries. To follow a query or a request class over months of nightly runs, run
+# summaries (any format summary_io reads) are ingested into one SQLite file with a row per response:
+#   python runstore.py ingest run_summary.*.json
+#   python runstore.py trend --metric latency_ms --class 'WALK,TRANSIT|departAt|14:00' --last 30
+#   python runstore.py trend --metric total_time --id 12-345-3
+# otpprofiler.py --runstore FILE adds every run as it finishes. responses is indexed on (id_tuple, run_id) and on
+# (request_class, run_id), so the history of one query or class does not scan the other runs. SQLite has no
+# percentile aggregate; trend() fetches the values of the selected runs and computes them with NumPy.
+
+import datetime
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+import summary_io
+
+RUNSTORE = os.getenv('OTPQA_RUNSTORE', 'runstore.sqlite')
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS runs (
+    run_id TEXT PRIMARY KEY,  -- run_summary id, e.g. '1700000000-3f2a9c1b', in older summaries the epoch time
+    started INTEGER,  -- epoch time the run started
+    notes TEXT,
+    source TEXT,  -- file the run was ingested from
+    n_responses INTEGER,
+    meta TEXT  -- run metadata except the responses, as JSON
+);
+CREATE TABLE IF NOT EXISTS responses (
+    run_id TEXT NOT NULL REFERENCES runs (run_id),
+    response_id INTEGER,
+    id_tuple TEXT NOT NULL,
+    request_class TEXT,
+    mode TEXT,
+    status INTEGER,
+    n_itins INTEGER,  -- NULL for failed requests
+    duration REAL,  -- sec, of the first itinerary
+    total_time REAL,  -- msec, server side
+    avg_time REAL,  -- msec, server side per itinerary
+    latency_ms REAL,  -- client side
+    timed_out INTEGER
+);
+CREATE INDEX IF NOT EXISTS responses_id_tuple ON responses (id_tuple, run_id);
+CREATE INDEX IF NOT EXISTS responses_request_class ON responses (request_class, run_id);
+'''
+
+METRICS = ('latency_ms', 'total_time', 'avg_time', 'duration', 'n_itins')
+PERCENTILES = (50, 90, 99)
+
+# the response fields ingest reads from a .npz summary
+RESPONSE_FIELDS = ('response_id', 'id_tuple', 'request_class', 'request_id', 'mode', 'status', 'itins.duration',
+                   'total_time', 'avg_time', 'latency_ms', 'debug.timedOut')
+
+
+def _number(value):
+    "'11 msec' -> 11.0, '694 sec' -> 694.0, None stays None"
+    if value is None:
+        return None
+    return float(str(value).split()[0])
+
+
+def run_started(run_json):
+    "Epoch time a run started. Run ids used to be just that, now they are followed by a random suffix."
+    if 'started' in run_json:
+        return run_json['started']
+    return int(str(run_json['id']).split('-')[0])
+
+
+def response_values(run_id, response):
+    itins = response.get('itins')
+    debug = response.get('debug') or {}
+    timed_out = debug.get('timedOut')
+    return (run_id, response.get('response_id'), response['id_tuple'],
+            # summaries from before request classes were recorded are grouped by request id
+            response.get('request_class', str(response.get('request_id'))),
+            response.get('mode'), response.get('status'),
+            None if itins is None else len(itins),
+            _number(itins[0]['duration']) if itins else None,
+            _number(response.get('total_time')), _number(response.get('avg_time')), response.get('latency_ms'),
+            None if timed_out is None else int(timed_out))
+
+
+class RunStore(object):
+
+    def __init__(self, filename=RUNSTORE):
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, timeout=60)
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def add_run(self, run_json, source=None):
+        """Add a run summary dict, replacing an earlier copy of the same run.
+        Its responses may be any iterable, they are inserted as they are read."""
+        run_id = str(run_json['id'])
+        meta = dict((k, v) for k, v in run_json.items() if k != 'responses')
+        n_responses = [0]
+
+        def rows():
+            for response in run_json['responses']:
+                n_responses[0] += 1
+                yield response_values(run_id, response)
+
+        with self.conn:
+            self.conn.execute('DELETE FROM responses WHERE run_id = ?', (run_id,))
+            self.conn.execute('INSERT OR REPLACE INTO runs (run_id, started, notes, source, n_responses, meta) '
+                              'VALUES (?, ?, ?, ?, ?, ?)', (run_id, run_started(run_json), run_json.get('notes'),
+                                                            source, None, json.dumps(meta)))
+            self.conn.executemany('INSERT INTO responses VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows())
+            self.conn.execute('UPDATE runs SET n_responses = ? WHERE run_id = ?', (n_responses[0], run_id))
+        return run_id
+
+    def ingest(self, filename):
+        "Add a run summary file. JSON lines summaries are streamed into the store."
+        return self.add_run(summary_io.load_summary(filename, columns=RESPONSE_FIELDS, stream=True),
+                            os.path.abspath(filename))
+
+    def runs(self, last=None):
+        "(run_id, started, notes, n_responses) of the stored runs, oldest first, only the last ones if given"
+        rows = self.conn.execute('SELECT run_id, started, notes, n_responses FROM runs '
+                                 'ORDER BY started DESC, run_id DESC LIMIT ?',
+                                 (-1 if last is None else last,)).fetchall()
+        return rows[::-1]
+
+    def trend(self, metric='latency_ms', id_tuple=None, request_class=None, last=None, percentiles=PERCENTILES):
+        """Percentiles of a metric per run, oldest run first, over the responses of one query (id_tuple), of one
+        request class, or all of them. Runs without values of the metric are left out."""
+        if metric not in METRICS:
+            raise ValueError("metric must be one of %s" % (METRICS,))
+        runs = self.runs(last)
+        if not runs:
+            return []
+        query = ('SELECT runs.run_id, %s FROM responses JOIN runs USING (run_id) WHERE started >= ? AND %s IS NOT NULL'
+                 % (metric, metric))
+        args = [runs[0][1]]
+        if id_tuple is not None:
+            query += ' AND id_tuple = ?'
+            args.append(id_tuple)
+        if request_class is not None:
+            query += ' AND request_class = ?'
+            args.append(request_class)
+        values = {}
+        for run_id, value in self.conn.execute(query, args):
+            values.setdefault(run_id, []).append(value)
+
+        ret = []
+        for run_id, started, notes, n_responses in runs:
+            if run_id not in values:
+                continue
+            run_values = np.array(values[run_id], dtype=np.float64)
+            point = {'run_id': run_id, 'started': started, 'notes': notes, 'count': len(run_values),
+                     'mean': run_values.mean()}
+            for p, value in zip(percentiles, np.percentile(run_values, percentiles)):
+                point['p%g' % p] = value
+            ret.append(point)
+        return ret
+
+
+def main(args):
+    store = RunStore(args.db)
+    if args.command == 'ingest':
+        for filename in args.filenames:
+            run_id = store.ingest(filename)
+            print("%s: run %s" % (filename, run_id))
+    else:
+        percentiles = ['p%g' % p for p in PERCENTILES]
+        print('\t'.join(['run_id', 'date', 'count', 'mean'] + percentiles + ['notes']))
+        for point in store.trend(args.metric, args.id, args.request_class, args.last):
+            date = datetime.datetime.fromtimestamp(point['started']).strftime('%Y-%m-%d %H:%M')
+            print('\t'.join([str(point['run_id']), date, str(point['count']), '%.1f' % point['mean']] +
+                            ['%.1f' % point[p] for p in percentiles] + [str(point['notes'])]))
+    store.close()
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='store profiler runs and query trends across them')
+    parser.add_argument('--db', default=RUNSTORE) # SQLite file, $OTPQA_RUNSTORE by default
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    ingest = commands.add_parser('ingest', help='add run summaries to the store')
+    ingest.add_argument('filenames', nargs='+') # run_summary files in any format
+    trend = commands.add_parser('trend', help='percentiles of a metric per run')
+    trend.add_argument('--metric', choices=METRICS, default='latency_ms')
+    trend.add_argument('--id', default=None) # trend of one query, by id_tuple
+    trend.add_argument('--class', dest='request_class', default=None) # trend of one request class
+    trend.add_argument('--last', type=int, default=None) # only the last N runs
+    main(parser.parse_args())
@@ -0,0 +1,245 @@
+from __future__ import print_function
+
+# Reading and writing of profiler run output.
+#
+# The classic output is run_summary.ID.json, one pretty-printed object {'notes', 'id', 'responses': [...]}
+# written at the end of a run, plus full_itins.ID.json holding every itinerary body.
+#
+# The streaming output writes the same rows as line-delimited JSON while the run progresses:
+#   run_summary.ID.jsonl        one response row per line, appended when its response has been handled
+#   full_itins.ID.jsonl         one {'response_id', 'itinerary_number', 'body'} object per line
+#   run_summary.ID.index.json   run metadata ('notes', 'id', ...) plus 'complete', 'n_responses' and 'n_itins'.
+#                               It is written when the run starts and rewritten when it ends, so an index
+#                               with 'complete': false marks a run that died halfway.
+#
+# The columnar output, run_summary.ID.npz, is a np.savez_compressed archive written at the end of a run or converted
+# from an existing summary with `python summary_io.py run_summary.ID.json`. Every archive member is one compressed
+# column, and np.load only decompresses the members that are accessed, so readers that pass columns= to
+# iter_responses or load_summary only pay for the fields they use. Members are named after the path of the field:
+#   meta                        the run metadata ('notes', 'id', 'latency', ...) as a JSON string
+#   responses@dict              marks the response rows, a list of dicts
+#   responses.status            a field of every row, as an int64, float64, bool or unicode array
+#   responses.avg_time@none     True where the field is None. Such positions hold 0, NaN, False or ''
+#   responses.debug@dict        True where a field holds a dict, whose fields are responses.debug.totalTime etc.
+#   responses.itins@has         True where a row has the field at all. Only written when some rows lack it
+#   responses.itins@len         length of a list field, -1 where it is None or missing
+#   responses.itins[].duration  the fields of the list items, concatenated over all rows
+#   responses.x@json            a field of mixed types, JSON encoded
+# so itins[0].duration of every row is responses.itins[].duration at the offsets of the cumulative itins@len.
+# Field names must not contain '.', '@' or '['.
+
+import json
+import numbers
+import os
+import re
+
+import numpy as np
+
+
+def index_filename(filename):
+    "run_summary.ID.jsonl -> run_summary.ID.index.json"
+    return filename[:-len('.jsonl')] + '.index.json'
+
+
+class JsonlWriter(object):
+    """Appends response rows and full itineraries to line-delimited JSON files as they arrive."""
+
+    def __init__(self, run_json, directory='.'):
+        self.meta = dict(run_json)
+        self.meta['complete'] = False
+        self.meta['n_responses'] = 0
+        self.meta['n_itins'] = 0
+        self.summary_filename = os.path.join(directory, "run_summary.%s.jsonl" % run_json['id'])
+        self.itins_filename = os.path.join(directory, "full_itins.%s.jsonl" % run_json['id'])
+        self.fp_summary = open(self.summary_filename, "w")
+        self.fp_itins = open(self.itins_filename, "w")
+        self._write_index()
+
+    def _write_index(self):
+        fpout = open(index_filename(self.summary_filename), "w")
+        json.dump(self.meta, fpout, indent=2)
+        fpout.close()
+
+    def write_response(self, row, full_itins=()):
+        # itineraries first, so that a row in the summary always has its bodies on disk
+        for full_itin in full_itins:
+            self.fp_itins.write(json.dumps(full_itin) + "\n")
+            self.meta['n_itins'] += 1
+        self.fp_itins.flush()
+        self.fp_summary.write(json.dumps(row) + "\n")
+        self.fp_summary.flush()
+        self.meta['n_responses'] += 1
+
+    def close(self, **meta):
+        "Close the streams and mark the run complete. Keyword arguments are added to the index."
+        self.fp_summary.close()
+        self.fp_itins.close()
+        self.meta.update(meta)
+        self.meta['complete'] = True
+        self._write_index()
+
+
+def iter_jsonl(filename):
+    """Yield the objects of a line-delimited JSON file. A truncated last line, left by a run
+    that crashed mid-write, is skipped."""
+    fp = open(filename)
+    for line in fp:
+        try:
+            yield json.loads(line)
+        except ValueError:
+            print("skipping truncated line in %s" % filename)
+    fp.close()
+
+
+def _leaf(values):
+    "Encode a list of scalars (or None) as (array, none mask or None), or None when they need JSON"
+    present = [v for v in values if v is not None]
+    none = np.array([v is None for v in values]) if len(present) < len(values) else None
+    if all(isinstance(v, bool) for v in present):
+        return np.array([bool(v) for v in values]), none
+    if not any(isinstance(v, bool) for v in present):
+        if all(isinstance(v, numbers.Integral) for v in present) and present:
+            return np.array([0 if v is None else v for v in values], dtype=np.int64), none
+        if all(isinstance(v, numbers.Real) for v in present):
+            return np.array([np.nan if v is None else v for v in values], dtype=np.float64), none
+        if all(isinstance(v, (type(u''), str)) for v in present):
+            return np.array([u'' if v is None else v for v in values], dtype=np.str_), none
+    return None
+
+
+def _encode(name, values, out):
+    if not values:
+        return
+    if any(isinstance(v, list) for v in values) and all(v is None or isinstance(v, list) for v in values):
+        out[name + '@len'] = np.array([-1 if v is None else len(v) for v in values], dtype=np.int64)
+        _encode(name + '[]', [item for v in values if v is not None for item in v], out)
+    elif any(isinstance(v, dict) for v in values) and all(v is None or isinstance(v, dict) for v in values):
+        out[name + '@dict'] = np.array([v is not None for v in values])
+        keys = sorted(set(k for v in values if v is not None for k in v))
+        for k in keys:
+            if not all(k in v for v in values if v is not None):
+                out['%s.%s@has' % (name, k)] = np.array([v is not None and k in v for v in values])
+            _encode('%s.%s' % (name, k), [None if v is None else v.get(k) for v in values], out)
+    else:
+        leaf = _leaf(values)
+        if leaf is None:
+            out[name + '@json'] = np.array([json.dumps(v) for v in values], dtype=np.str_)
+        else:
+            out[name] = leaf[0]
+            if leaf[1] is not None:
+                out[name + '@none'] = leaf[1]
+
+
+def _wanted(path, columns):
+    "Whether a field path like 'itins.duration' is one of columns, inside one, or on the way to one"
+    return columns is None or any(path == c or path.startswith(c + '.') or c.startswith(path + '.')
+                                  for c in columns)
+
+
+def _decode(npz, names, name, path, n, columns):
+    "The n values of the field encoded under name. path is its field path, without 'responses' and []"
+    if n == 0:
+        return []
+    if name + '@len' in names:
+        lengths = npz[name + '@len'].tolist()
+        items = _decode(npz, names, name + '[]', path, sum(l for l in lengths if l > 0), columns)
+        ret = []
+        start = 0
+        for l in lengths:
+            ret.append(None if l < 0 else items[start:start + l])
+            start += max(l, 0)
+        return ret
+    if name + '@dict' in names:
+        ret = [{} if is_dict else None for is_dict in npz[name + '@dict'].tolist()]
+        keys = set(m.group(1) for m in (re.match(re.escape(name) + r'\.([^.@\[]+)', key) for key in names) if m)
+        for k in sorted(keys):
+            child_path = k if not path else '%s.%s' % (path, k)
+            if not _wanted(child_path, columns):
+                continue
+            child = '%s.%s' % (name, k)
+            has = npz[child + '@has'].tolist() if child + '@has' in names else [True] * n
+            for d, h, v in zip(ret, has, _decode(npz, names, child, child_path, n, columns)):
+                if d is not None and h:
+                    d[k] = v
+        return ret
+    if name + '@json' in names:
+        return [json.loads(v) for v in npz[name + '@json'].tolist()]
+    if name not in names:
+        return [None] * n
+    values = npz[name].tolist()
+    if name + '@none' in names:
+        values = [None if none else v for v, none in zip(values, npz[name + '@none'].tolist())]
+    return values
+
+
+def write_npz(run_json, filename):
+    "Write a run summary dict as a columnar .npz archive"
+    out = {}
+    _encode('responses', run_json['responses'], out)
+    meta = dict((k, v) for k, v in run_json.items() if k != 'responses')
+    out['meta'] = np.array(json.dumps(meta))
+    np.savez_compressed(filename, **out)
+
+
+def _load_npz(filename, columns=None):
+    npz = np.load(filename)
+    meta = json.loads(npz['meta'].item())
+    names = set(npz.files)
+    n = len(npz['responses@dict']) if 'responses@dict' in names else 0
+    responses = _decode(npz, names, 'responses', '', n, columns)
+    npz.close()
+    return meta, responses
+
+
+def load_column(filename, name):
+    """One raw column of a .npz summary by member name, e.g. 'responses.total_time' or 'responses.itins@len',
+    as a NumPy array. Only that member is decompressed."""
+    npz = np.load(filename)
+    column = npz[name]
+    npz.close()
+    return column
+
+
+def iter_responses(filename, columns=None):
+    """Yield the response rows of a run summary in any output format.
+    JSON lines are streamed, a classic .json summary has to be parsed whole first. From a .npz summary only the fields
+    listed in columns (paths like 'id_tuple' or 'itins.duration') are loaded, all of them when columns is None."""
+    if filename.endswith('.jsonl'):
+        return iter_jsonl(filename)
+    if filename.endswith('.npz'):
+        return iter(_load_npz(filename, columns)[1])
+    return iter(json.load(open(filename))['responses'])
+
+
+def load_summary(filename, columns=None, stream=False):
+    """Load a run summary written in any output format as a {'notes', 'id', ..., 'responses'} dict.
+    columns projects the response fields of a .npz summary as in iter_responses. With stream the responses of a
+    .jsonl summary are an iterator over the file instead of a list."""
+    if filename.endswith('.npz'):
+        run_json, responses = _load_npz(filename, columns)
+        run_json['responses'] = responses
+        return run_json
+    if not filename.endswith('.jsonl'):
+        return json.load(open(filename))
+
+    run_json = {}
+    if os.path.exists(index_filename(filename)):
+        run_json = json.load(open(index_filename(filename)))
+        if not run_json['complete']:
+            print("%s is from a run that did not complete" % filename)
+    run_json['responses'] = iter_jsonl(filename) if stream else list(iter_jsonl(filename))
+    return run_json
+
+
+if __name__ == '__main__':
+    import argparse
+
+    parser = argparse.ArgumentParser(description='convert run summaries to the columnar .npz format')
+    parser.add_argument('filenames', nargs='+') # run_summary.ID.json or run_summary.ID.jsonl files
+    args = parser.parse_args()
+
+    for filename in args.filenames:
+        npz_filename = re.sub(r'\.jsonl?$', '', filename) + '.npz'
+        write_npz(load_summary(filename), npz_filename)
+        print("%s -> %s (%d -> %d bytes)" % (filename, npz_filename, os.path.getsize(filename),
+                                             os.path.getsize(npz_filename)))
@@ -0,0 +1,88 @@
+from __future__ import print_function
+
+from future.standard_library import install_aliases
+
+install_aliases()
+
+# Background sampling of server resource metrics during a profiler run, so that a latency regression can be told
+# apart from GC pressure or a saturated CPU on the router. Two kinds of metrics endpoints are understood:
+#   - a Spring Boot style actuator, given as its base URL (http://host/actuator). The metrics in ACTUATOR_METRICS
+#     are read from /actuator/metrics/<name> on every sample.
+#   - any other URL is expected to return one flat JSON object per request, for example a small JMX-over-HTTP
+#     bridge next to the router. Its numeric fields are recorded as they are, ideally using the FIELDS names.
+# Every sample is a dict with 'time' (epoch seconds) and the metric values; a failed poll records 'error' instead.
+# The actuator reports GC pause time and count cumulatively since the JVM started, compare consecutive samples.
+
+import json
+import threading
+import time
+from urllib.request import urlopen, Request
+
+FIELDS = ('heap_used', 'gc_pause_ms', 'gc_count', 'threads', 'cpu')
+
+# field -> (actuator metric, statistic)
+ACTUATOR_METRICS = {
+    'heap_used': ('jvm.memory.used?tag=area:heap', 'VALUE'),
+    'gc_pause_ms': ('jvm.gc.pause', 'TOTAL_TIME'),
+    'gc_count': ('jvm.gc.pause', 'COUNT'),
+    'threads': ('jvm.threads.live', 'VALUE'),
+    'cpu': ('process.cpu.usage', 'VALUE'),
+}
+
+TIMEOUT = 5  # seconds
+
+
+def get_json(url):
+    req = Request(url)
+    req.add_header('Accept', 'application/json')
+    response = urlopen(req, timeout=TIMEOUT)
+    content = response.read()
+    response.close()
+    return json.loads(content.decode('utf-8'))
+
+
+def read_actuator(base_url):
+    sample = {}
+    for field, (metric, statistic) in ACTUATOR_METRICS.items():
+        objs = get_json('%s/metrics/%s' % (base_url.rstrip('/'), metric))
+        for measurement in objs['measurements']:
+            if measurement['statistic'] == statistic:
+                sample[field] = measurement['value']
+    if 'gc_pause_ms' in sample:
+        sample['gc_pause_ms'] *= 1000  # actuator reports seconds
+    return sample
+
+
+def read_flat(url):
+    objs = get_json(url)
+    return dict((k, v) for k, v in objs.items() if isinstance(v, (int, float)) and not isinstance(v, bool))
+
+
+class TelemetrySampler(threading.Thread):
+    """Polls a metrics endpoint every interval seconds until stop() is called."""
+
+    def __init__(self, url, interval=1.0):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.url = url
+        self.interval = interval
+        self.read = read_actuator if url.rstrip('/').endswith('/actuator') else read_flat
+        self.samples = []
+        self._stop_event = threading.Event()
+
+    def run(self):
+        while not self._stop_event.is_set():
+            started = time.time()
+            try:
+                sample = self.read(self.url)
+            except Exception as e:
+                sample = {'error': str(e)}
+            sample['time'] = started
+            self.samples.append(sample)
+            self._stop_event.wait(max(0, self.interval - (time.time() - started)))
+
+    def stop(self):
+        "Stop sampling and return the samples"
+        self._stop_event.set()
+        self.join()
+        return self.samples
@@ -0,0 +1,116 @@
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    pytest.skip('the async engine needs Python 3', allow_module_level=True)
+
+import async_engine
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # keep-alive
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        self.server.client_ports.add(self.client_address[1])
+        if self.path.startswith('/slow'):
+            time.sleep(2)
+        body = ('{"path": "%s"}' % self.path).encode('utf-8')
+        self.send_response(404 if self.path.startswith('/missing') else 200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    httpd.client_ports = set()
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def base_url(httpd):
+    return 'http://127.0.0.1:%d' % httpd.server_address[1]
+
+
+def test_fetch_all_calls_every_callback(server):
+    responses = []
+    jobs = [('%s/plan?i=%d' % (base_url(server), i), responses.append) for i in range(20)]
+    async_engine.fetch_all(jobs, concurrency=4)
+    assert sorted(r.json()['path'] for r in responses) == sorted('/plan?i=%d' % i for i in range(20))
+    for r in responses:
+        assert r.status_code == 200
+        assert r.sent <= r.received
+        assert r.scheduled is None
+
+
+def test_connections_are_kept_alive(server):
+    responses = []
+    async_engine.fetch_all([(base_url(server) + '/plan', responses.append)] * 30, concurrency=3)
+    assert len(responses) == 30
+    assert len(server.client_ports) <= 3
+
+
+def test_fetch_all_passes_error_statuses_to_callbacks(server):
+    responses = []
+    async_engine.fetch_all([(base_url(server) + '/missing', responses.append)])
+    assert [r.status_code for r in responses] == [404]
+
+
+def test_callback_error_aborts_the_batch(server):
+    def fail(response):
+        raise RuntimeError('callback failed')
+
+    with pytest.raises(RuntimeError):
+        async_engine.fetch_all([(base_url(server) + '/plan', fail)] * 3, concurrency=1)
+
+
+def test_stop_drops_queued_jobs_and_cancels_requests_in_flight(server):
+    stop = threading.Event()
+    responses = []
+
+    def handle(response):
+        responses.append(response)
+        stop.set()
+
+    url = base_url(server)
+    jobs = [(url + '/plan', handle), (url + '/slow', handle)] + [(url + '/plan', handle)] * 10
+    started = time.time()
+    async_engine.fetch_all(jobs, concurrency=2, stop=stop)
+    assert len(responses) == 1
+    assert time.time() - started < 1.5
+
+def test_open_loop_sends_on_schedule(server):
+    responses = []
+    jobs = [('%s/plan?i=%d' % (base_url(server), i), responses.append) for i in range(10)]
+    async_engine.fetch_open_loop(jobs, rate=50)
+    assert len(responses) == 10
+    scheduled = sorted(r.scheduled for r in responses)
+    gaps = [b - a for a, b in zip(scheduled, scheduled[1:])]
+    assert gaps == pytest.approx([0.02] * 9, abs=1e-6)
+    for r in responses:
+        assert r.sent >= r.scheduled - 0.01
+
+
+def test_poisson_arrivals_are_reproducible():
+    def offsets(seed):
+        return [o for o, i in zip(async_engine.arrival_offsets(10, 'poisson', seed), range(100))]
+
+    assert offsets(1) == offsets(1)
+    assert offsets(1) != offsets(2)
+    assert offsets(1)[-1] == pytest.approx(10, rel=0.3)
+    constant = [o for o, i in zip(async_engine.arrival_offsets(4), range(5))]
+    assert constant == [0, 0.25, 0.5, 0.75, 1.0]
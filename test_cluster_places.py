@@ -0,0 +1,110 @@
+import numpy as np
+import pytest
+
+import utm
+from sklearn.cluster import DBSCAN
+
+from cluster_places import JITTER, UTM_ZONE, clusterEndpoints, jitter
+
+
+def place(name, lat, lon, hits=None):
+    ret = {'name': name, 'lat': str(lat), 'lon': str(lon)}
+    if hits is not None:
+        ret['hits'] = str(hits)
+    return ret
+
+
+# two groups of places a few hundred meters apart in Helsinki and Espoo, and one lone place in Tampere
+PLACES = [place('kamppi', 60.1690, 24.9320, 1), place('tampere', 61.4978, 23.7610, 5),
+          place('kamppi 2', 60.1700, 24.9330, 3), place('tapiola', 60.1750, 24.8050),
+          place('tapiola 2', 60.1760, 24.8060)]
+
+
+def test_clusters_and_outliers():
+    endpoints = clusterEndpoints(PLACES)
+    assert [e['name'] for e in endpoints] == ['o0', 'c1', 'c2']
+    assert [e['hits'] for e in endpoints] == [5, 4, 0]
+
+    outlier, kamppi, tapiola = endpoints
+    # hit weighted centroid, the plain mean without hits; all within the jitter of 50 m
+    assert outlier['lat'] == pytest.approx(61.4978, abs=0.001)
+    assert kamppi['lat'] == pytest.approx(60.16975, abs=0.001)
+    assert kamppi['lon'] == pytest.approx(24.93275, abs=0.001)
+    assert tapiola['lat'] == pytest.approx(60.1755, abs=0.001)
+    assert tapiola['lon'] == pytest.approx(24.8055, abs=0.001)
+
+
+def test_no_outliers():
+    endpoints = clusterEndpoints(PLACES[:1] + PLACES[2:])
+    assert [(e['name'], e['hits']) for e in endpoints] == [('c0', 4), ('c1', 0)]
+
+
+def test_outliers_can_be_left_out():
+    endpoints = clusterEndpoints(PLACES, return_outliers=False)
+    assert [e['name'] for e in endpoints] == ['c0', 'c1']
+
+
+def test_duplicate_places_form_a_cluster():
+    endpoints = clusterEndpoints([place('a', 60.17, 24.93), place('b', 61.5, 23.76), place('a', 60.17, 24.93)])
+    assert [e['name'] for e in endpoints] == ['o0', 'c1']
+
+
+def test_places_without_coordinates_are_skipped():
+    endpoints = clusterEndpoints([place('nowhere', float('nan'), 24.93)] + PLACES)
+    assert len(endpoints) == 3
+    assert clusterEndpoints([place('nowhere', float('nan'), 24.93)]) == []
+    assert all(np.isfinite(e['lat']) for e in endpoints)
+
+
+def test_clustering_is_reproducible():
+    assert clusterEndpoints(PLACES) == clusterEndpoints(PLACES)
+    assert clusterEndpoints(PLACES, seed=1) != clusterEndpoints(PLACES)
+
+
+def test_jitter():
+    offsets = jitter(['a', 'b', 'a'], np.array([60.17, 60.17, 60.18]), np.array([24.93, 24.93, 24.93]))
+    assert offsets.shape == (3, 2)
+    assert (np.abs(offsets) <= JITTER).all()
+    assert (offsets[0] != offsets[1]).all() and (offsets[0] != offsets[2]).all()
+    assert (jitter(['a'], np.array([60.17]), np.array([24.93])) == offsets[:1]).all()
+
+
+def test_jitter_is_the_same_everywhere():
+    # pinned: the offsets must not change with the Python or NumPy version, or with the type of the coordinates
+    expected = pytest.approx([46.910319617018104, -24.65174337849021])
+    assert list(jitter(['kamppi'], np.array([60.169]), np.array([24.932]))[0]) == expected
+    assert list(jitter(['kamppi'], [60.169], [24.932])[0]) == expected
+
+
+def test_previous_endpoints_keep_their_ids():
+    previous = [{'id': 7, 'lat': '60.1695', 'lon': '24.9325'}, {'id': 3, 'lat': '62.0', 'lon': '25.0'}]
+    endpoints = clusterEndpoints(PLACES, previous=previous, match_radius=500)
+    # the matched endpoints come first, in the order of previous
+    assert [(e['name'], e['id']) for e in endpoints] == [('c1', 7), ('o0', 8), ('c2', 9)]
+    assert (endpoints[0]['lat'], endpoints[0]['lon']) == (60.1695, 24.9325)
+
+    assert [e['id'] for e in clusterEndpoints(PLACES, previous=[])] == [0, 1, 2]
+
+
+def test_places_are_clustered_as_jittered():
+    # eps as small as the jitter: clusters depend on it, and must be those of DBSCAN over the jittered places
+    rng = np.random.RandomState(0)
+    lats, lons = 60.17 + rng.uniform(0, 0.02, 300), 24.93 + rng.uniform(0, 0.04, 300)
+    places = [place('p%d' % i, lat, lon) for i, (lat, lon) in enumerate(zip(lats, lons))]
+    places += places[:30]
+    endpoints = clusterEndpoints(places, eps=100)
+
+    lats = np.array([float(p['lat']) for p in places])
+    lons = np.array([float(p['lon']) for p in places])
+    x, y = utm.from_latlon(lats, lons, UTM_ZONE)[:2]
+    xy = np.column_stack((x, y)) + jitter([p['name'] for p in places], lats, lons)
+    labels = DBSCAN(eps=100, min_samples=2).fit(xy).labels_
+    assert sum(1 for e in endpoints if e['name'].startswith('o')) == np.count_nonzero(labels == -1)
+    assert sum(1 for e in endpoints if e['name'].startswith('c')) == labels.max() + 1
+
+
+def test_previous_ids_are_matched_one_to_one_nearest_first():
+    # both clusters are near previous endpoint 2, the nearer takes it; the other still gets the free id 5
+    previous = [{'id': 5, 'lat': 60.1765, 'lon': 24.8065}, {'id': 2, 'lat': 60.1740, 'lon': 24.8700}]
+    endpoints = clusterEndpoints(PLACES, previous=previous, match_radius=5000)
+    assert sorted((e['name'], e['id']) for e in endpoints) == [('c1', 2), ('c2', 5), ('o0', 6)]
@@ -0,0 +1,318 @@
+import json
+import subprocess
+import sys
+
+import numpy as np
+import pytest
+
+import compare
+import summary_io
+
+
+def itinerary(duration, leg_modes, leg_times, walk_distance, trips=('t1',)):
+    return {'duration': '%d sec' % duration, 'leg_modes': list(leg_modes), 'leg_times': list(leg_times), 'n_legs': len(leg_modes),
+            'trips': list(trips), 'walk_distance': walk_distance}
+
+
+def response(id_tuple, itins, total_time=100, avg_time='50 msec', timed_out=False):
+    ret = {'id_tuple': id_tuple, 'request_id': 0, 'avg_time': avg_time,
+           'debug': {'totalTime': total_time, 'timedOut': timed_out}}
+    if itins is not None:
+        ret['itins'] = itins
+    return ret
+
+
+BUS = itinerary(1000, ['WALK', 'BUS', 'WALK'], [100, 800, 100], 244.4)
+TRAM = itinerary(1100, ['WALK', 'TRAM'], [200, 900], 244.4)
+BIKE = itinerary(900, ['BICYCLE'], [900], 4500.0, trips=())
+
+BENCHMARK = [
+    response('1-2-0', [BUS]),
+    response('1-2-1', [BUS, TRAM], total_time=300, avg_time='150 msec'),
+    response('1-2-2', None),
+    response('1-2-3', [BIKE]),
+    response('1-2-4', [TRAM], timed_out=True),
+    response('1-2-5', [BUS]),
+]
+PROFILE = [
+    response('1-2-5', [BUS]),
+    response('1-2-4', [TRAM]),
+    response('1-2-3', [itinerary(950, ['BICYCLE'], [1000], 4500.0, trips=())]),
+    response('1-2-2', [BUS]),
+    response('1-2-1', [itinerary(1400, ['WALK', 'BUS', 'WALK'], [300, 800, 300], 366.6)], total_time=900,
+             avg_time='900 msec'),
+    response('1-2-0', []),
+]
+
+
+def write_summary(path, responses):
+    json.dump({'notes': '', 'id': 1, 'responses': responses}, open(str(path), 'w'))
+    return str(path)
+
+
+@pytest.fixture
+def summaries(tmp_path):
+    return write_summary(tmp_path / 'benchmark.json', BENCHMARK), write_summary(tmp_path / 'profile.json', PROFILE)
+
+
+def compare_args(benchmark, profile, **args):
+    "main() arguments as the command line defaults would give them"
+    defaults = {'benchmark': benchmark, 'profile': profile, 'threshold': 60, 'limit': 95, 'itineraries': False,
+                'itinerarythreshold': 1, 'modes': False, 'modethreshold': 1, 'legs': False, 'legthreshold': 1,
+                'trips': False, 'tripthreshold': 1, 'speeds': False, 'speedthreshold': 0.2, 'performance': False,
+                'totaltimethreshold': 200, 'averagetimethreshold': 40}
+    defaults.update(args)
+    return defaults
+
+
+def run_compare(capsys, *args, **kwargs):
+    "Output lines of compare.main and whether it failed the comparison"
+    try:
+        compare.main(compare_args(*args, **kwargs))
+        failed = False
+    except SystemExit as e:
+        failed = e.code != 0
+    return capsys.readouterr().out.splitlines(), failed
+
+
+def test_load_table(summaries):
+    table = compare.load_table(summaries[0])
+    assert table['ids'] == ['1-2-0', '1-2-1', '1-2-2', '1-2-3', '1-2-4', '1-2-5']
+    assert list(table['duration']) == [1000, 1000, -1, 900, 1100, 1000]
+    assert list(table['n_itins']) == [1, 2, 0, 1, 1, 1]
+    # WALK only counts when an itinerary has nothing else: BUS + TRAM, and BICYCLE alone
+    assert list(table['n_modes']) == [1, 2, 0, 1, 1, 1]
+    assert list(table['avg_time']) == [50, 150, 50, 50, 50, 50]
+
+
+def test_npz_summaries_load_the_same_table(summaries, tmp_path):
+    npz_filename = str(tmp_path / 'benchmark.npz')
+    summary_io.write_npz(summary_io.load_summary(summaries[0]), npz_filename)
+    table, npz_table = compare.load_table(summaries[0]), compare.load_table(npz_filename)
+    assert npz_table['ids'] == table['ids']
+    for column in compare.COLUMNS:
+        assert np.array_equal(npz_table[column], table[column], equal_nan=True), column
+
+def test_extract_functions(summaries):
+    speeds = compare.extractspeeds(summaries[0])
+    assert speeds['walk_speeds'] == pytest.approx({'1-2-0': 1.222, '1-2-1': 1.222, '1-2-4': 1.222, '1-2-5': 1.222})
+    assert speeds['bicycle_speeds'] == {'1-2-3': 5.0}
+    assert speeds['average_walk_speed'] == pytest.approx(1.222)
+    performance = compare.extractperformance(summaries[1])
+    assert performance['total_times']['1-2-1'] == 900
+    assert performance['avg_times']['1-2-1'] == 900.0
+    assert not any(performance['timeouts'].values())
+    assert compare.extractdurations(summaries[1])['1-2-0'] == -1
+
+
+def test_durations(summaries, capsys):
+    lines, failed = run_compare(capsys, *summaries)
+    assert failed
+    assert 'Test route duration 1-2-0 t1=1000 t2=-1 diff=-1001' in lines
+    assert 'Test route duration 1-2-1 t1=1000 t2=1400 diff=400' in lines
+    assert 'Test route duration 1-2-2 t1=-1 t2=1000 diff=1001' in lines
+    assert 'Routes that are slower in %s: 0' % summaries[0] in lines
+    assert 'Routes that are slower in %s: 1' % summaries[1] in lines
+    assert 'Route duration regressions: 2' in lines
+    assert 'Route duration comparison rate: 83' in lines
+
+
+def test_counts(summaries, capsys):
+    lines, failed = run_compare(capsys, *summaries, itineraries=True, modes=True, legs=True, trips=True)
+    assert 'Test itinerarys 1-2-0 t1=1 t2=0 diff=-1' in lines
+    assert 'Test itinerarys 1-2-1 t1=2 t2=1 diff=-1' in lines
+    assert 'Test itinerarys 1-2-2 t1=0 t2=1 diff=1' in lines
+    assert 'Test modes 1-2-1 t1=2 t2=1 diff=-1' in lines
+    assert 'Test legs 1-2-2 t1=0 t2=3 diff=3' in lines
+    assert 'Test trips 1-2-0 t1=1 t2=0 diff=-1' in lines
+    assert 'Routes that have less modes in %s: 2' % summaries[1] in lines
+    assert 'Mode test failed, 83 < 95' in lines
+
+
+def test_speeds(summaries, capsys):
+    lines, failed = run_compare(capsys, *summaries, speeds=True)
+    assert 'Test walk_speeds 1-2-1 t1=1.222000 t2=0.611000 diff=-0.611000' in lines
+    assert 'Test bicycle_speeds 1-2-3 t1=5.000000 t2=4.500000 diff=-0.500000' in lines
+    assert 'Routes that have slower cycling in %s: 1' % summaries[1] in lines
+    assert 'Speed test failed, 66 < 95' in lines
+    assert 'Average cycling speed %s: 5.000000 m/s' % summaries[0] in lines
+
+
+def test_performance(summaries, capsys):
+    lines, failed = run_compare(capsys, *summaries, performance=True)
+    assert 'Test total time 1-2-1 t1=300 t2=900 diff=-600' in lines
+    assert 'Test average time 1-2-1 t1=150.000000 t2=900.000000 diff=-750.000000' in lines
+    assert 'Test timeouts 1-2-4 t1=True t2=False' in lines
+    assert 'Total request time of all requests summed in %s: 800' % summaries[0] in lines
+    assert 'Routes that have more timeouts in %s: 1' % summaries[0] in lines
+    assert 'Total request time test failed, 83 < 95' in lines
+
+
+def test_identical_runs_pass(summaries, capsys):
+    lines, failed = run_compare(capsys, summaries[0], summaries[0], itineraries=True, modes=True, legs=True,
+                                trips=True, speeds=True, performance=True)
+    assert not failed
+    assert lines[-1] == 'Test passed'
+
+
+ALL_FLAGS_OUTPUT = """\
+Detecting regressions with a time threshold of 60 seconds and test threshold 95 
+Detecting regressions with a itinerary number threshold of 1 and test threshold 95 
+Detecting regressions with a mode number threshold of 1 and test threshold 95 
+Detecting regressions with a leg number threshold of 1 and test threshold 95 
+Detecting regressions with a trip number threshold of 1 and test threshold 95 
+Detecting regressions with a speed difference threshold of 0 and test threshold 95 
+Detecting regressions with a total request time difference threshold of 200, an average request time \
+difference threshold of 40,                            and test threshold 95 
+Test route duration 1-2-0 t1=1000 t2=-1 diff=-1001
+Test itinerarys 1-2-0 t1=1 t2=0 diff=-1
+Test modes 1-2-0 t1=1 t2=0 diff=-1
+Test legs 1-2-0 t1=3 t2=0 diff=-3
+Test trips 1-2-0 t1=1 t2=0 diff=-1
+Test route duration 1-2-1 t1=1000 t2=1400 diff=400
+Test itinerarys 1-2-1 t1=2 t2=1 diff=-1
+Test modes 1-2-1 t1=2 t2=1 diff=-1
+Test walk_speeds 1-2-1 t1=1.222000 t2=0.611000 diff=-0.611000
+Test total time 1-2-1 t1=300 t2=900 diff=-600
+Test average time 1-2-1 t1=150.000000 t2=900.000000 diff=-750.000000
+Test route duration 1-2-2 t1=-1 t2=1000 diff=1001
+Test itinerarys 1-2-2 t1=0 t2=1 diff=1
+Test modes 1-2-2 t1=0 t2=1 diff=1
+Test legs 1-2-2 t1=0 t2=3 diff=3
+Test trips 1-2-2 t1=0 t2=1 diff=1
+Test bicycle_speeds 1-2-3 t1=5.000000 t2=4.500000 diff=-0.500000
+Test timeouts 1-2-4 t1=True t2=False
+Test count: 6
+Routings that failed only in B: 1
+Routings that failed only in P: 1
+Routes that are slower in B: 0
+Routes that are slower in P: 1
+Route duration regressions: 2
+Route duration comparison rate: 83
+Route duration test failed, 83 < 95
+Routes that have less itineraries in B: 1
+Routes that have less itineraries in P: 2
+Itinerary test failed, 83 < 95
+Routes that have less modes in B: 1
+Routes that have less modes in P: 2
+Mode test failed, 83 < 95
+Routes that have less legs in B: 1
+Routes that have less legs in P: 1
+Routes that have less trips in B: 1
+Routes that have less trips in P: 1
+Routes that have slower walk in B: 0
+Routes that have slower cycling in B: 0
+Routes that have slower walk in P: 1
+Routes that have slower cycling in P: 1
+Speed test failed, 66 < 95
+Average walk speed in B: 1.222000 m/s
+Average cycling speed B: 5.000000 m/s
+Average walk speed P: 1.069250 m/s
+Average cycling speed P: 4.500000 m/s
+Total request time of all requests summed in B: 800
+Total request time of all requests summed in P: 1400
+Difference in total request time of all requests summed -600
+Percentage difference in total request time of all requests summed -42.857143
+Routes that have longer total request time in B: 0
+Routes that have longer total request time in P: 1
+Routes that have longer average request time in B: 0
+Routes that have longer average request time in P: 1
+Routes that have more timeouts in B: 1
+Routes that have more timeouts in P: 0
+Total request time test failed, 83 < 95
+Average request time test failed, 83 < 95
+"""
+
+
+def test_all_comparisons(summaries, capsys):
+    "Every line of a run with all comparisons. The per-route lines may come in any order."
+    lines, failed = run_compare(capsys, *summaries, itineraries=True, modes=True, legs=True, trips=True, speeds=True,
+                                performance=True)
+    assert failed
+    output = '\n'.join(lines).replace(summaries[0], 'B').replace(summaries[1], 'P').splitlines()
+    assert sorted(output) == sorted(ALL_FLAGS_OUTPUT.splitlines())
+
+
+def timing_run(path, slowdown, seed):
+    "A run summary of 40 routes in two request classes, class B slowed down by the slowdown factor"
+    rng = np.random.RandomState(seed)
+    responses = []
+    for i in range(40):
+        request_class = 'A' if i % 2 else 'B'
+        base = 100 + 10 * i
+        factor = slowdown if request_class == 'B' else 1.0
+        responses.append(dict(response('1-2-%d' % i, [BUS], total_time=int(base * factor * rng.uniform(0.95, 1.05))),
+                              request_class=request_class))
+    return write_summary(path, responses)
+
+
+def test_significant_slowdown_is_found_per_class(tmp_path, capsys):
+    tables1 = [compare.load_table(timing_run(tmp_path / ('b%d.json' % i), 1.0, i)) for i in range(3)]
+    tables2 = [compare.load_table(timing_run(tmp_path / ('p%d.json' % i), 1.3, 10 + i)) for i in range(3)]
+    assert compare.significance(tables1, tables2, 'total_time', 0.05, 1.0, 500)
+    lines = capsys.readouterr().out.splitlines()
+    assert lines[1].startswith('  all: n=40 ')
+    assert lines[2].startswith('  A: n=20 ') and not lines[2].endswith('SIGNIFICANT SLOWDOWN')
+    assert lines[3].startswith('  B: n=20 ') and lines[3].endswith('SIGNIFICANT SLOWDOWN')
+
+
+def test_noise_is_not_a_slowdown(tmp_path, capsys):
+    tables1 = [compare.load_table(timing_run(tmp_path / ('b%d.json' % i), 1.0, i)) for i in range(3)]
+    tables2 = [compare.load_table(timing_run(tmp_path / ('p%d.json' % i), 1.0, 10 + i)) for i in range(3)]
+    assert not compare.significance(tables1, tables2, 'total_time', 0.05, 1.0, 500)
+
+
+def test_min_slowdown(tmp_path, capsys):
+    tables1 = [compare.load_table(timing_run(tmp_path / 'b.json', 1.0, 0))]
+    tables2 = [compare.load_table(timing_run(tmp_path / 'p.json', 1.3, 1))]
+    assert compare.significance(tables1, tables2, 'total_time', 0.05, 1.0, 500)
+    assert not compare.significance(tables1, tables2, 'total_time', 0.05, 1.5, 500)
+
+
+def test_classes_are_bonferroni_corrected(tmp_path, capsys, monkeypatch):
+    alphas = []
+    slowdown_test = compare.slowdown_test
+    monkeypatch.setattr(compare, 'slowdown_test', lambda m1, m2, alpha, *args: alphas.append(alpha) or
+                        slowdown_test(m1, m2, alpha, *args))
+    tables1 = [compare.load_table(timing_run(tmp_path / 'b.json', 1.0, 0))]
+    tables2 = [compare.load_table(timing_run(tmp_path / 'p.json', 1.3, 1))]
+    compare.significance(tables1, tables2, 'total_time', 0.05, 1.0, 100)
+    assert alphas == [0.05, 0.025, 0.025]
+
+
+def test_bootstrap_ratio_is_reproducible():
+    m1 = np.arange(100, 130, dtype=np.float64)
+    ratio, low, high = compare.bootstrap_ratio(m1, m1 * 1.2, 0.05, 1000)
+    assert ratio == pytest.approx(1.2)
+    assert low == pytest.approx(1.2) and high == pytest.approx(1.2)
+    assert compare.bootstrap_ratio(m1, m1[::-1], 0.05, 1000) == compare.bootstrap_ratio(m1, m1[::-1], 0.05, 1000)
+
+
+def test_threshold_failures_only_count_with_significance(tmp_path, capsys):
+    "A few slow routes fail the -p threshold test, but are no significant slowdown"
+    responses = [dict(response('1-2-%d' % i, [BUS], total_time=100 + 10 * i), request_class='A') for i in range(40)]
+    benchmark = write_summary(tmp_path / 'b.json', responses)
+    for r in responses[:3]:
+        r['debug']['totalTime'] += 1000
+    profile = write_summary(tmp_path / 'p.json', responses)
+    lines, failed = run_compare(capsys, benchmark, profile, performance=True)
+    assert 'Total request time test failed, 92 < 95' in lines
+    assert failed
+    lines, failed = run_compare(capsys, benchmark, profile, performance=True, significance=True)
+    assert 'Total request time test failed, 92 < 95' in lines
+    assert not failed
+    assert lines[-1] == 'Test passed'
+
+
+def test_scipy_is_only_needed_for_significance(summaries):
+    script = ('import sys; sys.modules["scipy"] = None; import compare; '
+              'print(compare.load_table(sys.argv[1])["n_itins"].sum())')
+    assert subprocess.check_output([sys.executable, '-c', script, summaries[0]]).strip() == b'6'
+
+
+def test_old_scipy_is_refused(monkeypatch):
+    scipy = pytest.importorskip('scipy')
+    assert compare.load_wilcoxon() is scipy.stats.wilcoxon
+    monkeypatch.setattr(scipy, '__version__', '1.1.0')
+    with pytest.raises(SystemExit):
+        compare.load_wilcoxon()
@@ -0,0 +1,60 @@
+import numpy as np
+import pytest
+
+import distance_cache
+import otpprofiler
+from vincenty import vincenty_inverse
+
+ENDPOINTS = [{'lat': 60.1 + 0.013 * i, 'lon': 24.9 + 0.029 * (i % 5)} for i in range(12)]
+
+
+def test_matrix_matches_vincenty(tmp_path):
+    matrix = distance_cache.DistanceMatrix(ENDPOINTS, cache_dir=str(tmp_path))
+    i, j = np.meshgrid(np.arange(12), np.arange(12))
+    dists = matrix.distances(i.ravel(), j.ravel())
+    for a, b, dist in zip(i.ravel(), j.ravel(), dists):
+        p1, p2 = ENDPOINTS[a], ENDPOINTS[b]
+        assert dist == pytest.approx(vincenty_inverse((p1['lat'], p1['lon']), (p2['lat'], p2['lon'])), abs=1e-9)
+
+
+def test_matrix_is_cached_and_memory_mapped(tmp_path, monkeypatch):
+    first = distance_cache.DistanceMatrix(ENDPOINTS, cache_dir=str(tmp_path))
+    assert [p.name for p in tmp_path.iterdir()] == ['distances.%s.npy' % distance_cache.endpoints_hash(ENDPOINTS)]
+
+    def build(endpoints, filename):
+        raise AssertionError('the cached matrix should have been used')
+
+    monkeypatch.setattr(distance_cache, 'build', build)
+    second = distance_cache.DistanceMatrix(ENDPOINTS, cache_dir=str(tmp_path))
+    assert isinstance(second.matrix, np.memmap)
+    assert np.array_equal(first.matrix, second.matrix)
+
+
+def test_hash_follows_the_coordinates():
+    moved = [dict(endpoint) for endpoint in ENDPOINTS]
+    moved[3]['lon'] += 1e-6
+    assert distance_cache.endpoints_hash(moved) != distance_cache.endpoints_hash(ENDPOINTS)
+    assert distance_cache.endpoints_hash(ENDPOINTS[::-1]) != distance_cache.endpoints_hash(ENDPOINTS)
+
+
+def test_condensed_index():
+    n = 6
+    positions = [distance_cache.condensed_index(i, j, n) for i in range(n) for j in range(i + 1, n)]
+    assert positions == list(range(n * (n - 1) // 2))
+    assert distance_cache.condensed_index(4, 1, n) == distance_cache.condensed_index(1, 4, n)
+
+
+def test_large_endpoint_sets_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(distance_cache, 'MAX_ENDPOINTS', len(ENDPOINTS) - 1)
+    monkeypatch.setattr(distance_cache.DistanceMatrix.__init__, '__defaults__', (str(tmp_path),))
+    assert otpprofiler.endpoint_distances(ENDPOINTS, 1000) is None
+    assert list(tmp_path.iterdir()) == []
+
+
+def test_in_order_pairs_are_not_cached(tmp_path, monkeypatch):
+    monkeypatch.setattr(distance_cache.DistanceMatrix.__init__, '__defaults__', (str(tmp_path),))
+    # with at least 2 * count endpoints the pairs are taken in order and need no matrix
+    assert otpprofiler.endpoint_distances(ENDPOINTS, len(ENDPOINTS) // 2) is None
+    assert list(tmp_path.iterdir()) == []
+    assert otpprofiler.endpoint_distances(ENDPOINTS, len(ENDPOINTS) // 2 + 1) is not None
+    assert len(list(tmp_path.iterdir())) == 1
@@ -0,0 +1,158 @@
+from zipfile import ZipFile
+
+import numpy as np
+import pytest
+
+pytest.importorskip('imposm.parser')
+
+import gen_points
+from gen_points import NodeIndex
+
+
+def test_node_index(tmp_path):
+    index = NodeIndex(str(tmp_path))
+    index.add([(5, 24.9, 60.1), (7, 24.95, 60.15)])
+    index.add([])
+    index.add([(2, 25.0, 60.2)])  # out of order, as from another parser process
+    index.finish()
+    assert index.n == 3
+    assert list(index.ids) == [2, 5, 7]
+
+    coords, found = index.lookup(np.array([7, 3, 2, 9]))
+    assert list(found) == [True, False, True, False]
+    assert np.allclose(coords, [[24.95, 60.15], [25.0, 60.2]])
+
+
+def test_empty_node_index(tmp_path):
+    index = NodeIndex(str(tmp_path))
+    index.finish()
+    coords, found = index.lookup(np.array([1]))
+    assert len(coords) == 0 and list(found) == [False]
+
+
+class FakeParser(object):
+    "Calls back with the nodes and ways of a small street grid, like imposm does, in two blocks"
+    nodes = [(i, 24.9 + i / 1000.0, 60.1) for i in range(1, 10)]
+    ways = [(100, {'highway': 'residential'}, [1, 2, 3]), (101, {'highway': 'primary'}, [3, 4, 5, 6]),
+            (102, {'building': 'yes'}, [6, 7, 8, 6]), (103, {'highway': 'service'}, [8, 9, 8])]
+
+    def __init__(self, concurrency=None, coords_callback=None, ways_callback=None):
+        FakeParser.concurrency = concurrency
+        self.coords_callback = coords_callback
+        self.ways_callback = ways_callback
+
+    def parse(self, filename):
+        self.coords_callback(self.nodes[5:])
+        self.ways_callback(self.ways[:2])
+        self.coords_callback(self.nodes[:5])
+        self.ways_callback(self.ways[2:])
+
+
+def test_intersection_nodes(monkeypatch):
+    monkeypatch.setattr(gen_points, 'OSMParser', FakeParser)
+    coords = gen_points.intersection_nodes('extract.osm.pbf')
+    # 3 is on two highways and 8 twice on the same one; 6 is only on one highway and a building
+    assert np.allclose(coords, [[24.903, 60.1], [24.908, 60.1]])
+    # imposm deadlocks with more than one parser process
+    assert FakeParser.concurrency == 1
+
+
+def test_project():
+    xy = gen_points.project([(24.9, 60.0), (0.0, 0.0)])
+    assert xy.shape == (2, 2)
+    assert np.allclose(xy, [[24.9 * 0.5 * 111111.0, 60.0 * 111111.0], [0, 0]])
+
+
+def test_stratified_choice():
+    # 80 points in one grid cell and 20 in another
+    xy = np.concatenate((np.random.RandomState(1).uniform(0, 1000, (80, 2)), [[7500.0, 7500.0]] * 20))
+    chosen = gen_points.stratified_choice(xy, 10, np.random.RandomState(0))
+    assert len(set(chosen)) == 10
+    assert np.count_nonzero(chosen < 80) == 8
+
+    # remainders: 3 points over cells of 2 and 1 points, with 2 and 1 of them exactly
+    xy = np.array([[0.0, 0.0], [1.0, 1.0], [7500.0, 7500.0]])
+    assert sorted(gen_points.stratified_choice(xy, 3, np.random.RandomState(0))) == [0, 1, 2]
+
+
+# stops in Helsinki and in Kerava, 10 intersections near the first, 5 near the second and 5 far from both
+STOPS = 'stop_id,stop_name,stop_lat,stop_lon\n1,Kamppi,60.1,24.9\n2,Kerava,60.4,25.1\n'
+INTERSECTIONS = np.array([(24.9 + i / 1000.0, 60.1) for i in range(10)] +
+                         [(25.1, 60.4 + i / 1000.0) for i in range(5)] +
+                         [(27.0 + i / 1000.0, 62.0) for i in range(5)])
+
+
+@pytest.fixture(autouse=True)
+def stops_cache_dir(tmp_path, monkeypatch):
+    "Keeps the stops of the test feeds out of the user's cache"
+    monkeypatch.setattr(gen_points.load_stops, '__defaults__', (str(tmp_path / 'cache'),))
+    return tmp_path / 'cache'
+
+
+@pytest.fixture
+def osm_dir(tmp_path, monkeypatch):
+    open(str(tmp_path / 'extract.osm.pbf'), 'wb').close()
+    with ZipFile(str(tmp_path / 'gtfs.zip'), 'w') as zf:
+        zf.writestr('stops.txt', STOPS)
+    monkeypatch.setattr(gen_points, 'intersection_nodes', lambda filename: INTERSECTIONS.copy())
+    return str(tmp_path)
+
+
+@pytest.mark.parametrize('sampling', gen_points.SAMPLING)
+def test_get_random_points(osm_dir, sampling):
+    points = gen_points.get_random_points(osm_dir, 6, sampling=sampling, seed=1)
+    assert len(set(points)) == 6
+    assert all(point in [tuple(c) for c in INTERSECTIONS[:15]] for point in points)
+    assert gen_points.get_random_points(osm_dir, 6, sampling=sampling, seed=1) == points
+
+    everything = gen_points.get_random_points(osm_dir, 100, sampling=sampling)
+    assert sorted(everything) == sorted(tuple(c) for c in INTERSECTIONS[:15])
+
+
+@pytest.mark.parametrize('sampling', gen_points.SAMPLING)
+def test_no_intersection_near_a_stop(osm_dir, monkeypatch, sampling):
+    monkeypatch.setattr(gen_points, 'intersection_nodes', lambda filename: INTERSECTIONS[15:].copy())
+    assert gen_points.get_random_points(osm_dir, 6, sampling=sampling) == []
+
+
+def test_stratified_sampling_covers_both_areas(osm_dir):
+    points = gen_points.get_random_points(osm_dir, 3, sampling='stratified', seed=2)
+    assert sum(1 for lon, lat in points if lat > 60.3) == 1
+
+
+def test_unknown_sampling(osm_dir):
+    with pytest.raises(ValueError):
+        gen_points.get_random_points(osm_dir, 3, sampling='systematic')
+
+
+def gtfs(path, stops=STOPS, bom=False):
+    with ZipFile(str(path), 'w') as zf:
+        if stops is not None:
+            zf.writestr('stops.txt', (b'\xef\xbb\xbf' if bom else b'') + stops.encode('utf-8'))
+    return str(path)
+
+
+def test_read_stops(tmp_path):
+    stops = STOPS + '3,Pasila entrance,,\n4\n'
+    assert gen_points.read_stops(gtfs(tmp_path / 'a.zip', stops, bom=True)).tolist() == [[24.9, 60.1],
+                                                                                          [25.1, 60.4]]
+    assert 'does not contain a stops.txt' in gen_points.read_stops(gtfs(tmp_path / 'b.zip', None))
+    assert 'lat or lon' in gen_points.read_stops(gtfs(tmp_path / 'c.zip', 'stop_id,stop_name\n1,Kamppi\n'))
+
+
+def test_load_stops_is_cached(tmp_path, stops_cache_dir):
+    feeds = [gtfs(tmp_path / 'a.zip'), gtfs(tmp_path / 'b.zip', STOPS + '3,Pasila,60.2,24.93\n'),
+             gtfs(tmp_path / 'c.zip', None)]
+    stops = gen_points.load_stops(feeds)
+    assert stops.tolist() == [[24.9, 60.1], [24.93, 60.2], [25.1, 60.4]]
+    cached = list(stops_cache_dir.iterdir())
+    assert len(cached) == 1
+
+    # a hit reads the cache file, whatever the feeds hold
+    np.save(str(cached[0]), stops[:1])
+    assert gen_points.load_stops(feeds[::-1]).tolist() == [[24.9, 60.1]]
+
+    # a changed feed misses
+    gtfs(tmp_path / 'c.zip', 'stop_id,stop_lat,stop_lon\n9,61.0,25.0\n')
+    assert len(gen_points.load_stops(feeds)) == 4
+    assert len(list(stops_cache_dir.iterdir())) == 2
@@ -0,0 +1,78 @@
+import random
+
+import pytest
+
+import histogram
+from histogram import Histogram
+
+
+def test_small_values_are_exact():
+    h = Histogram()
+    for ms in (0.001, 0.1, 0.2, 0.3):
+        h.record(ms)
+    assert h.percentile(50) == 0.1
+    assert h.percentile(100) == 0.3
+    assert h.summary()['max'] == 0.3
+
+
+def test_percentile_error_is_bounded():
+    rnd = random.Random(1)
+    values = sorted(rnd.lognormvariate(4, 1) for i in range(10000))
+    h = Histogram()
+    for ms in values:
+        h.record(ms)
+    assert h.count == len(values)
+    for p in (50.0, 90.0, 99.0, 99.9):
+        exact = values[int(-(-p * len(values) // 100)) - 1]
+        assert h.percentile(p) == pytest.approx(exact, rel=1.0 / 2 ** (histogram.SUB_BUCKET_BITS - 1))
+    assert h.mean() == pytest.approx(sum(values) / len(values), rel=1e-5)
+
+
+def test_merge_equals_recording_everything_in_one():
+    rnd = random.Random(2)
+    parts = [[rnd.expovariate(0.01) for i in range(1000)] for j in range(3)]
+    merged = Histogram()
+    for part in parts:
+        h = Histogram()
+        for ms in part:
+            h.record(ms)
+        merged.merge(h)
+    whole = Histogram()
+    for ms in sum(parts, []):
+        whole.record(ms)
+    assert merged.counts == whole.counts
+    assert merged.summary() == whole.summary()
+
+
+def test_merge_with_empty_histograms():
+    h = Histogram()
+    h.record(5)
+    assert h.merge(Histogram()).summary() == Histogram().merge(h).summary()
+    empty = Histogram().merge(Histogram())
+    assert empty.percentile(50) is None and empty.mean() is None and empty.min is None
+
+
+def test_dict_round_trip():
+    h = Histogram()
+    for ms in (1, 2, 3, 1500, 70000):
+        h.record(ms)
+    restored = Histogram.from_dict(h.to_dict())
+    assert restored.counts == h.counts
+    assert restored.summary() == h.summary()
+
+
+def test_from_dict_rejects_other_resolution():
+    d = Histogram().to_dict()
+    d['sub_bucket_bits'] += 1
+    with pytest.raises(ValueError):
+        Histogram.from_dict(d)
+
+
+def test_summarize_merges_classes():
+    a, b = Histogram(), Histogram()
+    a.record(10)
+    b.record(30)
+    summary = histogram.summarize({'WALK': a, 'TRANSIT': b})
+    assert sorted(summary['classes']) == ['TRANSIT', 'WALK']
+    assert summary['all']['count'] == 2
+    assert summary['all']['max'] == 30
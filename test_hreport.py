@@ -0,0 +1,81 @@
+import io
+import json
+import os
+import subprocess
+import sys
+
+import hreport
+
+
+def response(i, fail=False):
+    itins = [] if fail else [{'walk_limit_exceeded': False, 'walk_distance': 500.0, 'wait_time_sec': 60,
+                              'leg_modes': ['WALK', 'BUS'], 'leg_times': [120, 600]}]
+    return {'id_tuple': '1-2-%d' % i, 'total_time': '%d msec' % (10 * (i + 1)), 'avg_time': None,
+            'mode': 'WALK,TRANSIT', 'itins': itins}
+
+
+def blob(n, fails=()):
+    return {'id': 1, 'responses': [response(i, i in fails) for i in range(n)]}
+
+
+def write(tmp_path, n, page_size, fails=()):
+    filename = str(tmp_path / 'report.html')
+    with open(filename, 'w') as fp:
+        pages = hreport.write_report(fp, input_blob=blob(n, fails), page_prefix=str(tmp_path / 'report'),
+                                     page_size=page_size)
+    return pages, open(filename).read()
+
+
+def test_single_page_up_to_page_size(tmp_path):
+    pages, html = write(tmp_path, 4, 4, fails=[1])
+    assert pages == []
+    assert os.listdir(str(tmp_path)) == ['report.html']
+    assert html.count('<tr><td rowspan="2"') == 4
+    assert 'fails: 1 (25.00%)' in html
+    assert html == ''.join(hreport.main(None, blob(4, fails=[1])))
+
+
+def test_pages_above_page_size(tmp_path):
+    pages, index = write(tmp_path, 5, 2, fails=[0, 4])
+    assert [os.path.basename(page) for page in pages] == ['report.1.html', 'report.2.html', 'report.3.html']
+    rows = [open(page).read().count('<tr><td rowspan="2"') for page in pages]
+    assert rows == [2, 2, 1]
+
+    assert '<a href="report.1.html">page 1</a></td><td>1-2-0 ... 1-2-1</td><td>fails: 1</td>' in index
+    assert '<a href="report.2.html">page 2</a></td><td>1-2-2 ... 1-2-3</td><td>fails: 0</td>' in index
+    assert '<a href="report.3.html">page 3</a></td><td>1-2-4 ... 1-2-4</td><td>fails: 1</td>' in index
+    assert 'fails: 2 (40.00%)' in index
+
+    first, middle, last = [open(page).read() for page in pages]
+    assert 'previous' not in first and '<a href="report.2.html">next</a>' in first
+    assert '<a href="report.1.html">previous</a>' in middle and '<a href="report.3.html">next</a>' in middle
+    assert '<a href="report.2.html">previous</a>' in last and 'next' not in last
+    assert '<a href="report.html">index</a>' in last
+
+
+def test_stats_over_all_pages(tmp_path):
+    single = io.StringIO()
+    hreport.write_report(single, input_blob=blob(9))
+    pages, index = write(tmp_path, 9, 3)
+    stats = [line for line in single.getvalue().split('<tr>') if line.startswith('<td>stats')]
+    assert len(stats) == 1
+    assert stats[0] in index
+
+
+def test_pages_written_to_a_stream_do_not_link_to_an_index(tmp_path):
+    stdout = io.StringIO()
+    stdout.name = '<stdout>'
+    pages = hreport.write_report(stdout, input_blob=blob(3), page_prefix=str(tmp_path / 'report'), page_size=2)
+    assert len(pages) == 2
+    assert all('index' not in open(page).read() for page in pages)
+
+
+def test_output_file(tmp_path):
+    summary = str(tmp_path / 'run_summary.1.json')
+    json.dump(blob(hreport.PAGE_SIZE + 1), open(summary, 'w'))
+    (tmp_path / 'out').mkdir()
+    subprocess.check_call([sys.executable, os.path.abspath(hreport.__file__), '-o', 'out/site.html', summary],
+                          cwd=str(tmp_path))
+    assert sorted(os.listdir(str(tmp_path / 'out'))) == ['site.1.html', 'site.2.html', 'site.html']
+    assert '<a href="site.2.html">page 2</a>' in open(str(tmp_path / 'out' / 'site.html')).read()
+    assert '<a href="site.html">index</a>' in open(str(tmp_path / 'out' / 'site.2.html')).read()
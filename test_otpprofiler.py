@@ -0,0 +1,361 @@
+import itertools
+import json
+import os
+import threading
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    BaseHTTPRequestHandler = object
+    ThreadingHTTPServer = None
+
+import distance_cache
+import otpprofiler
+import runstore
+import summary_io
+
+REQUESTS_JSON = {
+    'requests': [{'min': 'QUICK', 'arriveBy': False, 'maxWalkDistance': 2000, 'mode': 'WALK,TRANSIT',
+                  'time': '08:50:00', 'id': 0, 'typical': True},
+                 {'min': 'QUICK', 'arriveBy': True, 'maxWalkDistance': 2000, 'mode': 'WALK',
+                  'time': '08:50:00', 'id': 1, 'typical': True}],
+    'endpoints': [{'id': i, 'name': 'place %d' % i, 'lat': 60.1 + i / 100.0, 'lon': 24.9 + i / 100.0}
+                  for i in range(8)],
+}
+
+
+@pytest.fixture(autouse=True)
+def distance_cache_dir(tmp_path, monkeypatch):
+    "Keeps the distance matrices of the test endpoints out of the user's cache"
+    monkeypatch.setattr(distance_cache.DistanceMatrix.__init__, '__defaults__', (str(tmp_path / 'cache'),))
+
+
+class FakeOTP(BaseHTTPRequestHandler):
+    "Answers every plan request with one walk and bus itinerary, or with an error when the server is failing"
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.server.failing:
+            body = json.dumps({'debugOutput': {'totalTime': 7, 'timedOut': False},
+                               'error': {'id': 404, 'msg': 'PATH_NOT_FOUND'}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+        walk = {'mode': 'WALK', 'startTime': 0, 'endTime': 60000, 'from': {'departure': 0}}
+        bus = {'mode': 'BUS', 'startTime': 60000, 'endTime': 600000, 'route': '55', 'tripId': 't1',
+               'from': {'departure': 60000, 'arrival': 50000}}
+        itinerary = {'legs': [walk, bus], 'startTime': 0, 'duration': 600, 'walkDistance': 70.0,
+                     'walkLimitExceeded': False, 'waitingTime': 10, 'transitTime': 540}
+        body = json.dumps({'debugOutput': {'totalTime': 7, 'timedOut': False},
+                           'plan': {'itineraries': [itinerary]}}).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def start_otp(failing):
+    if ThreadingHTTPServer is None:
+        pytest.skip('the fake OTP server needs Python 3')
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakeOTP)
+    httpd.failing = failing
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    return httpd
+
+
+@pytest.fixture
+def otp():
+    httpd = start_otp(False)
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+@pytest.fixture
+def broken_otp():
+    httpd = start_otp(True)
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def run_args(host, **args):
+    "run() arguments as the command line defaults would give them"
+    defaults = {'host': host, 'fast': False, 'notes': 'test', 'date': '2026-10-19', 'time': '14:00', 'count': 6,
+                'profile': False, 'itineraries': 1, 'output': False, 'modes': None, 'engine': 'asyncio',
+                'concurrency': 2}
+    defaults.update(args)
+    return defaults
+
+
+def test_workers_number_responses_like_a_single_process(otp):
+    single = otpprofiler.run(run_args(otp), requests_json=REQUESTS_JSON)
+    sharded = otpprofiler.run(run_args(otp, workers=3), requests_json=REQUESTS_JSON)
+    rows = lambda run_json: sorted((r['response_id'], r['id_tuple']) for r in run_json['responses'])
+    assert len(single['responses']) >= 4
+    assert rows(sharded) == rows(single)
+    assert sharded['latency']['all']['count'] == len(single['responses'])
+
+
+def test_requests_are_classed_by_the_time_of_the_run(otp):
+    run_json = otpprofiler.run(run_args(otp, time='16:30'), requests_json=REQUESTS_JSON)
+    assert run_json['responses']
+    assert all(r['request_class'].endswith('|16:30') for r in run_json['responses'])
+    assert otpprofiler.request_class({'modes': 'WALK', 'arriveBy': False, 'time': '09:00'}) == 'WALK|departAt|09:00'
+
+
+@pytest.mark.parametrize('n', [1, 2, 3, 5, 7, 16, 17, 100, 1000, 4097])
+def test_feistel_permutation_is_a_permutation(n):
+    assert sorted(otpprofiler.feistel_permutation(n, 1)) == list(range(n))
+
+
+def test_feistel_permutation_is_seeded():
+    assert list(otpprofiler.feistel_permutation(1000, 1)) == list(otpprofiler.feistel_permutation(1000, 1))
+    assert list(otpprofiler.feistel_permutation(1000, 1)) != list(otpprofiler.feistel_permutation(1000, 2))
+    assert list(otpprofiler.feistel_permutation(1000, 1)) != list(range(1000))
+
+
+def test_feistel_permutation_is_lazy():
+    # the domain of 2 ** 48 values is never built
+    first = list(itertools.islice(otpprofiler.feistel_permutation(1 << 48, 1), 1000))
+    assert len(set(first)) == 1000
+    assert all(0 <= k < 1 << 48 for k in first)
+
+
+def test_endpoint_pairs_in_order_with_enough_endpoints():
+    assert list(itertools.islice(otpprofiler.endpoint_pairs(list(range(10)), 3), 3)) == [(0, 1), (2, 3), (4, 5)]
+    # by id, skipping ids that are missing, into the list positions
+    assert list(otpprofiler.endpoint_pairs([5, 4, 0, 1, 2, 7, 8, 9], 3)) == [(2, 3), (1, 0), (6, 7)]
+
+
+def test_endpoint_pairs_sampled():
+    pairs = list(otpprofiler.endpoint_pairs(list(range(7)), 20))
+    # every ordered pair of distinct endpoints once, then the generator runs out
+    assert len(pairs) == len(set(pairs)) == 7 * 6
+    assert all(o != t and 0 <= o < 7 and 0 <= t < 7 for o, t in pairs)
+    assert pairs == list(otpprofiler.endpoint_pairs(list(range(7)), 20))
+    assert pairs != list(otpprofiler.endpoint_pairs(list(range(7)), 20, seed=2))
+
+
+def test_endpoint_pairs_of_kept_endpoints_stay():
+    ids = list(range(20))
+    before = list(otpprofiler.endpoint_pairs(ids, 50))
+    # endpoint 3 is dropped and 20 added at the end
+    after_ids = [i for i in ids if i != 3] + [20]
+    after = [(after_ids[o], after_ids[t]) for o, t in otpprofiler.endpoint_pairs(after_ids, 50)]
+    kept = [(o, t) for o, t in before if 3 not in (o, t)]
+    assert [(o, t) for o, t in after if 20 not in (o, t)][:len(kept)] == kept
+
+
+def test_endpoint_pairs_without_usable_ids_use_positions():
+    assert list(otpprofiler.endpoint_pairs(['a', 'b', 'c', 'd'], 2)) == [(0, 1), (2, 3)]
+    assert list(otpprofiler.endpoint_pairs([1, 1, 2, 3], 2)) == [(0, 1), (2, 3)]
+    assert list(otpprofiler.endpoint_pairs([], 2)) == []
+
+
+def test_get_params_makes_count_requests():
+    params = list(otpprofiler.get_params(False, 30, requests_json=REQUESTS_JSON))
+    assert len(params) == 30
+    assert len(set((p['oid'], p['tid']) for p in params)) == 30
+    assert [p['id'] for p in params[:4]] == [0, 1, 0, 1]
+
+
+class FakeResponse(object):
+    connection = None
+    scheduled = None
+
+    def __init__(self, latency_ms):
+        self.sent = 0.0
+        self.received = latency_ms / 1000.0
+
+
+def fake_send(latencies, sent_urls):
+    def send(jobs, engine, concurrency, rate, arrivals, stop=None, store=None):
+        for url, callback in jobs:
+            sent_urls.append(url)
+            callback(FakeResponse(next(latencies)))
+    return send
+
+
+def test_warm_up_stops_when_latency_levels_off(monkeypatch):
+    # a cold router: 100 ms, then 50, then steady at 20
+    latencies = itertools.chain([100] * 10, [50] * 10, itertools.repeat(20))
+    urls = []
+    monkeypatch.setattr(otpprofiler, 'send', fake_send(latencies, urls))
+    record = otpprofiler.warm_up(['a', 'b', 'c'], 'asyncio', 5, window=10, tolerance=0.1, max_requests=1000)
+    assert record['steady']
+    assert record['curve'] == [100, 50, 20, 20, 20]
+    assert record['requests'] == 50 == len(urls)
+    assert urls[:4] == ['a', 'b', 'c', 'a']
+
+
+def test_warm_up_gives_up_after_max_requests(monkeypatch):
+    monkeypatch.setattr(otpprofiler, 'send', fake_send(itertools.cycle([10] * 7 + [100] * 7), []))
+    record = otpprofiler.warm_up(['a'], 'asyncio', 5, window=7, tolerance=0.1, max_requests=30)
+    assert not record['steady']
+    assert record['requests'] == 30
+    assert len(record['curve']) == 5
+
+
+def test_median():
+    assert otpprofiler.median([3, 1, 2]) == 2
+    assert otpprofiler.median([4, 1, 3, 2]) == 2.5
+
+
+def test_run_records_the_warm_up(otp):
+    run_json = otpprofiler.run(run_args(otp, warmup=4, warmupwindow=4, warmupmax=8), requests_json=REQUESTS_JSON)
+    # steady state needs more than two windows, so warm-up gives up at --warmupmax
+    assert run_json['warmup']['requests'] == 8
+    assert len(run_json['warmup']['curve']) == 2
+    assert not run_json['warmup']['steady']
+
+
+def test_streamed_run_records_the_warm_up(otp, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    run_json = otpprofiler.run(run_args(otp, output=True, jsonl=True, warmup=4, warmupwindow=4, warmupmax=8),
+                               requests_json=REQUESTS_JSON)
+    index = json.load(open(summary_io.index_filename(run_json['summary_file'])))
+    assert index['complete']
+    assert index['warmup'] == run_json['warmup']
+    assert index['warmup']['requests'] == 8
+
+
+def test_parallel_runs_keep_their_own_responses(otp):
+    sites = [dict(REQUESTS_JSON, endpoints=[dict(endpoint, id=100 * site + endpoint['id'])
+                                            for endpoint in REQUESTS_JSON['endpoints']]) for site in range(4)]
+    results = [None] * len(sites)
+
+    def profile(site):
+        results[site] = otpprofiler.run(run_args(otp, count=10, label='site %d' % site), requests_json=sites[site])
+
+    threads = [threading.Thread(target=profile, args=(site,)) for site in range(len(sites))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    for site, run_json in enumerate(results):
+        assert len(run_json['responses']) == 10
+        assert sorted(r['response_id'] for r in run_json['responses']) == list(range(10))
+        # id_tuple is origin-target-request, the endpoint ids tell the sites apart
+        assert all(int(oid) // 100 == site and int(tid) // 100 == site
+                   for oid, tid, request in (r['id_tuple'].split('-') for r in run_json['responses']))
+        assert run_json['latency']['all']['count'] == 10
+    # started in the same second, the runs still have their own ids and files
+    assert len(set(run_json['id'] for run_json in results)) == len(sites)
+    assert all(run_json['id'].split('-')[0] == str(run_json['started']) for run_json in results)
+
+
+def test_new_run_id():
+    run_ids = [otpprofiler.new_run_id(1700000000) for i in range(100)]
+    assert len(set(run_ids)) == 100
+    assert all(run_id.startswith('1700000000-') and len(run_id) == 19 for run_id in run_ids)
+
+
+def test_streamed_run_keeps_no_rows(otp, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    runstore_file = str(tmp_path / 'runstore.sqlite')
+    run_json = otpprofiler.run(run_args(otp, output=True, jsonl=True, npz=True, runstore=runstore_file),
+                               requests_json=REQUESTS_JSON)
+    assert 'responses' not in run_json
+    assert os.path.basename(run_json['summary_file']) == 'run_summary.%s.jsonl' % run_json['id']
+    streamed = summary_io.load_summary(run_json['summary_file'])['responses']
+    assert len(streamed) == run_json['n_responses'] >= 4
+
+    assert len(summary_io.load_summary('run_summary.%s.npz' % run_json['id'])['responses']) == len(streamed)
+    store = runstore.RunStore(runstore_file)
+    assert store.runs() == [(run_json['id'], run_json['started'], 'test', len(streamed))]
+    store.close()
+
+
+def test_response_failure():
+    assert otpprofiler.response_failure({}) == 'failed'
+    assert otpprofiler.response_failure({'itins': []}) == 'none'
+    assert otpprofiler.response_failure({'itins': [{'walk_limit_exceeded': True}]}) == 'failed'
+    assert otpprofiler.response_failure({'itins': [{'walk_limit_exceeded': True},
+                                                   {'walk_limit_exceeded': False}]}) is None
+
+
+def test_failure_monitor_stops_a_broken_run_early():
+    monitor = otpprofiler.FailureMonitor(0.2)
+    stopped_after = None
+    for i in range(1000):
+        if monitor.record('failed' if i % 2 else None):
+            stopped_after = i + 1
+            break
+    assert monitor.verdict == 'fail'
+    assert stopped_after == monitor.decided_after < 100
+    summary = monitor.summary(stopped=True)
+    assert summary['failed'] and summary['stopped']
+    assert summary['failed_responses'] == stopped_after // 2
+
+
+def test_failure_monitor_passes_a_healthy_run_without_stopping():
+    monitor = otpprofiler.FailureMonitor(0.2)
+    outcomes = [None] * 19 + ['none']  # 5% failures
+    stops = [monitor.record(outcome) for i in range(20) for outcome in outcomes]
+    assert monitor.verdict == 'pass'
+    assert not any(stops)
+    assert monitor.counts == {'failed': 0, 'none': 20}
+    summary = monitor.summary(stopped=False)
+    assert summary['ratio'] == 0.05 and not summary['failed']
+
+
+def test_failure_monitor_stop_on_pass():
+    monitor = otpprofiler.FailureMonitor(0.2, stop_on_pass=True)
+    for i in range(1000):
+        if monitor.record(None):
+            break
+    assert monitor.verdict == 'pass'
+    assert monitor.n == monitor.decided_after < 1000
+
+
+def test_failure_monitor_near_the_limit_stays_undecided_longer():
+    clear = otpprofiler.FailureMonitor(0.2)
+    close = otpprofiler.FailureMonitor(0.2)
+    for i in range(200):
+        clear.record('failed' if i % 2 else None)  # 50%
+        close.record('failed' if i % 4 == 0 else None)  # 25%
+    assert clear.decided_after < (close.decided_after or 201)
+
+
+def test_run_fails_fast_on_a_broken_router(broken_otp):
+    run_json = otpprofiler.run(run_args(broken_otp, count=50, failfast=0.2), requests_json=REQUESTS_JSON)
+    failures = run_json['failures']
+    assert failures['stopped'] and failures['failed'] and failures['verdict'] == 'fail'
+    # requests in flight when the verdict came are cancelled, so a few more responses may have been counted
+    assert failures['decided_after'] <= failures['responses'] < 50
+    assert len(run_json['responses']) < 50
+
+
+def test_healthy_run_is_not_stopped(otp):
+    run_json = otpprofiler.run(run_args(otp, count=30, failfast=0.2), requests_json=REQUESTS_JSON)
+    assert run_json['failures']['failed'] is False
+    assert run_json['failures']['stopped'] is False
+    assert len(run_json['responses']) == 30
+
+
+def test_replay_from_the_response_store(otp, tmp_path):
+    store = str(tmp_path / 'store')
+    live = otpprofiler.run(run_args(otp, count=10, store=store), requests_json=REQUESTS_JSON)
+    # the same requests answered from the store, at a host that does not exist
+    replayed = otpprofiler.run(run_args('http://127.0.0.1:9', count=10, store=store, engine='replay'),
+                               requests_json=REQUESTS_JSON)
+    assert replayed['responses'] == []  # a different host makes different URLs
+    replayed = otpprofiler.run(run_args(otp, count=10, store=store, engine='replay'), requests_json=REQUESTS_JSON)
+    # replayed responses have no client side timing
+    timing = ('run_id', 'latency_ms', 'sent_time', 'received_time')
+    strip = lambda rows: sorted((dict((k, v) for k, v in row.items() if k not in timing) for row in rows),
+                                key=lambda row: row['response_id'])
+    assert len(replayed['responses']) == 10
+    assert strip(replayed['responses']) == strip(live['responses'])
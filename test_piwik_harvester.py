@@ -0,0 +1,141 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('aiohttp')
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import piwik_harvester
+from piwik_harvester import Harvester, RequestFailed, TokenBucket
+
+# idSubtable -> rows of the fake Piwik page url tables of site 1
+TABLES = {
+    None: [{'label': 'reitti', 'idsubdatatable': 10}],
+    '10': [{'label': '/Kamppi?from', 'idsubdatatable': 11, 'nb_hits': 3},
+           {'label': '/Pasila?from', 'idsubdatatable': 12, 'nb_hits': 2},
+           {'label': 'Others', 'idsubdatatable': 13, 'nb_hits': 9}],
+    '11': [{'label': '/Pasila?to', 'nb_hits': 4}, {'label': 'Others', 'nb_hits': 1}],
+    '12': [{'label': '/Kamppi?to', 'nb_hits': 1}],
+}
+PLACES = {1: {'Kamppi': 4, 'Pasila': 6}}
+
+
+class FakePiwik(BaseHTTPRequestHandler):
+    "Serves the site list and the page url tables of TABLES, failing the first requests with 503 if asked to"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        params = dict((k, v[0]) for k, v in parse_qs(urlparse(self.path).query).items())
+        self.server.requests.append(params)
+        if self.server.unavailable > 0:
+            self.server.unavailable -= 1
+            self.send_response(503)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if params.get('idSubtable', params['method']) in self.server.refused:
+            self.send_response(403)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if params['method'] == 'SitesManager.getSitesWithAtLeastViewAccess':
+            rows = [{'idsite': 1}]
+        else:
+            rows = TABLES[params.get('idSubtable')]
+        body = json.dumps(rows).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def piwik():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), FakePiwik)
+    httpd.requests = []
+    httpd.unavailable = 0
+    httpd.refused = set()  # idSubtable or method of the requests answered with 403
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    httpd.url = 'http://127.0.0.1:%d' % httpd.server_address[1]
+    yield httpd
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def harvest(piwik, checkpoint=None):
+    harvester = Harvester(piwik.url, 'secret', checkpoint=checkpoint, rate=1000, burst=100)
+    return harvester.harvest([1, 2], lambda label: True), harvester.n_requests
+
+
+def test_harvest(piwik):
+    assert harvest(piwik) == (PLACES, 5)
+    assert all(request['token_auth'] == 'secret' for request in piwik.requests)
+
+
+def test_harvest_is_resumed_from_the_checkpoint(piwik, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    assert harvest(piwik, checkpoint) == (PLACES, 5)
+    records = open(checkpoint).readlines()
+    assert len(records) == 4
+
+    # interrupted before the last to place sub-table was saved: only it and the site list are fetched again
+    open(checkpoint, 'w').writelines(records[:3])
+    assert harvest(piwik, checkpoint) == (PLACES, 2)
+    assert piwik.requests[-1]['idSubtable'] == str(json.loads(records[3])['subtable'])
+    assert harvest(piwik, checkpoint) == (PLACES, 1)
+
+
+def test_checkpoint_of_another_harvest_is_started_over(piwik, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    with open(checkpoint, 'w') as fp:
+        fp.write(json.dumps({'period': 'month', 'date': '2000-01-01'}) + '\n')
+        fp.write(json.dumps({'site': 1, 'from': []}) + '\n')
+    assert harvest(piwik, checkpoint) == (PLACES, 5)
+
+
+def test_unavailable_server_is_retried(piwik, monkeypatch):
+    monkeypatch.setattr(piwik_harvester, 'BACKOFF', 0.01)
+    piwik.unavailable = 2
+    assert harvest(piwik) == (PLACES, 7)
+
+
+def test_refused_table_is_skipped_and_retried_next_time(piwik, tmp_path):
+    checkpoint = str(tmp_path / 'checkpoint.jsonl')
+    piwik.refused.add('12')
+    harvester = Harvester(piwik.url, 'secret', checkpoint=checkpoint, rate=1000, burst=100)
+    assert harvester.harvest([1], lambda label: True) == {1: {'Kamppi': 3, 'Pasila': 6}}
+    assert [(site, subtable) for site, subtable, error in harvester.failed] == [(1, 12)]
+    assert 'secret' not in harvester.failed[0][2]
+
+    piwik.refused.clear()
+    assert harvest(piwik, checkpoint) == (PLACES, 2)
+
+
+def test_refused_site_list_aborts(piwik):
+    piwik.refused.add('SitesManager.getSitesWithAtLeastViewAccess')
+    with pytest.raises(RequestFailed):
+        harvest(piwik)
+
+
+def test_token_bucket():
+    bucket = TokenBucket(rate=20, burst=3)
+
+    async def acquire(n):
+        for i in range(n):
+            await bucket.acquire()
+
+    started = time.monotonic()
+    asyncio.run(acquire(3))
+    assert time.monotonic() - started < 0.05
+    asyncio.run(acquire(2))
+    assert time.monotonic() - started >= 0.09
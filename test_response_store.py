@@ -0,0 +1,65 @@
+import gzip
+import json
+import os
+import threading
+
+from response_store import ResponseStore, replay, url_key
+
+URL = 'http://localhost:8080/otp/routers/default/plan?fromPlace=60.1,24.9&toPlace=60.2,25.0'
+
+
+def test_put_and_get(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    assert URL not in store
+    assert store.get(URL) is None
+    body = b'{"plan": {"itineraries": []}}'
+    store.put(URL, 200, body)
+    assert URL in store
+    response = store.get(URL)
+    assert (response.url, response.status_code, response.content) == (URL, 200, body)
+    assert response.json() == {'plan': {'itineraries': []}}
+
+
+def test_layout_and_body_kept_as_received(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    body = b'not json \xff'
+    store.put(URL, 500, body)
+    key = url_key(URL)
+    path = os.path.join(str(tmp_path), key[:2], key + '.gz')
+    assert store.path(URL) == path
+    fp = gzip.open(path, 'rb')
+    assert json.loads(fp.readline().decode('utf-8')) == {'url': URL, 'status': 500}
+    assert fp.read() == body
+    fp.close()
+    assert os.listdir(os.path.dirname(path)) == [key + '.gz']
+
+
+def test_put_replaces(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    store.put(URL, 500, b'error')
+    store.put(URL, 200, b'{}')
+    assert store.get(URL).status_code == 200
+
+
+def test_replay_skips_missing_urls(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    for i in range(3):
+        store.put('%s&i=%d' % (URL, i), 200, ('{"i": %d}' % i).encode('utf-8'))
+    seen = []
+    jobs = [('%s&i=%d' % (URL, i), lambda response: seen.append(response.json()['i'])) for i in range(5)]
+    assert replay(jobs, store) == 2
+    assert seen == [0, 1, 2]
+
+
+def test_replay_stops(tmp_path):
+    store = ResponseStore(str(tmp_path))
+    store.put(URL, 200, b'{}')
+    stop = threading.Event()
+    seen = []
+
+    def handle(response):
+        seen.append(response)
+        stop.set()
+
+    replay([(URL, handle)] * 3, store, stop)
+    assert len(seen) == 1
@@ -0,0 +1,96 @@
+import json
+
+import pytest
+
+import summary_io
+from runstore import RunStore
+
+
+def make_run(run_id, started, latencies, request_class='WALK,TRANSIT|departAt|14:00'):
+    return {'notes': 'run %s' % run_id, 'id': run_id, 'started': started,
+            'responses': [{'response_id': i, 'id_tuple': '1-2-%d' % i, 'request_class': request_class,
+                           'mode': 'WALK,TRANSIT', 'status': 200, 'total_time': '%d msec' % latency,
+                           'avg_time': None, 'latency_ms': float(latency),
+                           'debug': {'timedOut': False}, 'itins': [{'duration': 600 + i}]}
+                          for i, latency in enumerate(latencies)]}
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = RunStore(str(tmp_path / 'runstore.sqlite'))
+    yield store
+    store.close()
+
+
+def test_ingest_every_summary_format(store, tmp_path):
+    run = make_run('1700000000-aaaa', 1700000000, [10, 20, 30])
+    json_filename = str(tmp_path / 'run_summary.a.json')
+    json.dump(run, open(json_filename, 'w'))
+    npz_filename = str(tmp_path / 'run_summary.b.npz')
+    summary_io.write_npz(make_run('1700003600-bbbb', 1700003600, [40, 50]), npz_filename)
+    streamed = make_run('1700007200-cccc', 1700007200, [60])
+    writer = summary_io.JsonlWriter(dict((k, v) for k, v in streamed.items() if k != 'responses'), str(tmp_path))
+    for row in streamed['responses']:
+        writer.write_response(row)
+    writer.close()
+
+    assert store.ingest(json_filename) == '1700000000-aaaa'
+    assert store.ingest(npz_filename) == '1700003600-bbbb'
+    assert store.ingest(writer.summary_filename) == '1700007200-cccc'
+    assert store.runs() == [('1700000000-aaaa', 1700000000, 'run 1700000000-aaaa', 3),
+                            ('1700003600-bbbb', 1700003600, 'run 1700003600-bbbb', 2),
+                            ('1700007200-cccc', 1700007200, 'run 1700007200-cccc', 1)]
+    row = store.conn.execute('SELECT n_itins, duration, total_time, latency_ms, timed_out FROM responses '
+                             'WHERE run_id = ? AND response_id = 1', ('1700003600-bbbb',)).fetchone()
+    assert row == (1, 601.0, 50.0, 50.0, 0)
+
+
+def test_ingest_replaces_the_same_run(store):
+    store.add_run(make_run('1-a', 1, [10, 20, 30]))
+    store.add_run(make_run('1-a', 1, [10]))
+    assert store.runs() == [('1-a', 1, 'run 1-a', 1)]
+    assert store.conn.execute('SELECT COUNT(*) FROM responses').fetchone() == (1,)
+
+
+def test_runs_in_the_same_second_are_kept_apart(store):
+    store.add_run(make_run('100-a', 100, [10]))
+    store.add_run(make_run('100-b', 100, [20]))
+    assert [point['mean'] for point in store.trend()] == [10, 20]
+
+
+def test_trend(store):
+    store.add_run(make_run('300-c', 300, [30, 40]))
+    store.add_run(make_run('100-a', 100, range(1, 101)))
+    store.add_run(make_run('200-b', 200, [5], request_class='WALK|arriveBy|09:00'))
+
+    points = store.trend()
+    assert [(p['run_id'], p['started'], p['count']) for p in points] == [('100-a', 100, 100), ('200-b', 200, 1),
+                                                                           ('300-c', 300, 2)]
+    assert points[0]['mean'] == 50.5
+    assert points[0]['p50'] == pytest.approx(50.5)
+    assert points[0]['p99'] == pytest.approx(99.01)
+
+    assert [p['run_id'] for p in store.trend(last=2)] == ['200-b', '300-c']
+    assert [p['run_id'] for p in store.trend(request_class='WALK|arriveBy|09:00')] == ['200-b']
+    by_query = store.trend(metric='duration', id_tuple='1-2-1')
+    assert [(p['run_id'], p['mean']) for p in by_query] == [('100-a', 601), ('300-c', 601)]
+    assert store.trend(metric='avg_time') == []
+    with pytest.raises(ValueError):
+        store.trend(metric='notes')
+
+
+def test_runs_of_older_summaries_started_at_their_id(store):
+    old = make_run(1600000000, 1600000000, [15])
+    del old['started']
+    store.add_run(old)
+    store.add_run(make_run('1700000000-aaaa', 1700000000, [25]))
+    assert store.runs() == [('1600000000', 1600000000, 'run 1600000000', 1),
+                            ('1700000000-aaaa', 1700000000, 'run 1700000000-aaaa', 1)]
+    assert [p['mean'] for p in store.trend()] == [15, 25]
+
+
+def test_responses_are_streamed_in(store):
+    run = make_run('100-a', 100, [10, 20, 30])
+    store.add_run(dict(run, responses=iter(run['responses'])))
+    assert store.runs() == [('100-a', 100, 'run 100-a', 3)]
+    assert [p['count'] for p in store.trend()] == [3]
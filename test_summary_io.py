@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+import json
+
+import summary_io
+
+RUN = {
+    'notes': 'nightly', 'id': 1700000000,
+    'latency': {'unit': 'msec', 'all': {'count': 3, 'p50': 12.5}},
+    'responses': [
+        {'response_id': 0, 'id_tuple': '1-2-3', 'status': 200, 'total_time': '11 msec', 'latency_ms': 12.5,
+         'debug': {'totalTime': 11, 'timedOut': False},
+         'itins': [{'duration': 694, 'routes': ['550', '6'], 'walk_limit_exceeded': False},
+                   {'duration': 720, 'routes': [], 'walk_limit_exceeded': True}]},
+        {'response_id': 1, 'id_tuple': '1-2-4', 'status': 500, 'total_time': None, 'latency_ms': None,
+         'debug': None},
+        {'response_id': 2, 'id_tuple': u'1-2-5 ä', 'status': 200, 'total_time': '9 msec', 'latency_ms': 3,
+         'debug': {'totalTime': 9, 'timedOut': True}, 'itins': [],
+         'extra': [1, 'two', None]},
+    ],
+}
+
+
+def write_jsonl(run, directory):
+    writer = summary_io.JsonlWriter(dict((k, v) for k, v in run.items() if k != 'responses'), directory)
+    writer.write_response(run['responses'][0], [{'response_id': 0, 'itinerary_number': 0, 'body': {}}])
+    for row in run['responses'][1:]:
+        writer.write_response(row)
+    return writer
+
+
+def test_jsonl_stream(tmp_path):
+    writer = write_jsonl(RUN, str(tmp_path))
+    filename = writer.summary_filename
+    assert json.load(open(summary_io.index_filename(filename)))['complete'] is False
+    writer.close(n_requests=3)
+    index = json.load(open(summary_io.index_filename(filename)))
+    assert (index['complete'], index['n_responses'], index['n_itins'], index['n_requests']) == (True, 3, 1, 3)
+    assert summary_io.load_summary(filename)['responses'] == RUN['responses']
+    assert list(summary_io.iter_jsonl(writer.itins_filename)) == [
+        {'response_id': 0, 'itinerary_number': 0, 'body': {}}]
+
+
+def test_jsonl_summary_streamed(tmp_path):
+    writer = write_jsonl(RUN, str(tmp_path))
+    writer.close()
+    run_json = summary_io.load_summary(writer.summary_filename, stream=True)
+    assert not isinstance(run_json['responses'], list)
+    assert list(run_json['responses']) == RUN['responses']
+
+
+def test_load_classic_summary(tmp_path):
+    filename = str(tmp_path / 'run_summary.1700000000.json')
+    json.dump(RUN, open(filename, 'w'))
+    assert summary_io.load_summary(filename) == RUN
+
+
+def test_unfinished_run(tmp_path, capsys):
+    writer = write_jsonl(RUN, str(tmp_path))
+    writer.fp_summary.flush()
+    assert summary_io.load_summary(writer.summary_filename)['responses'] == RUN['responses']
+    assert 'did not complete' in capsys.readouterr().out
+
+
+def test_truncated_jsonl_line_is_skipped(tmp_path):
+    filename = str(tmp_path / 'run_summary.1.jsonl')
+    with open(filename, 'w') as fp:
+        fp.write(json.dumps(RUN['responses'][0]) + '\n' + json.dumps(RUN['responses'][1])[:20])
+    assert list(summary_io.iter_jsonl(filename)) == RUN['responses'][:1]
+
+
+def test_npz_round_trip(tmp_path):
+    filename = str(tmp_path / 'run_summary.1700000000.npz')
+    summary_io.write_npz(RUN, filename)
+    assert summary_io.load_summary(filename) == RUN
+    assert list(summary_io.iter_responses(filename)) == RUN['responses']
+
+
+def test_npz_round_trip_keeps_types(tmp_path):
+    filename = str(tmp_path / 'run.npz')
+    summary_io.write_npz(RUN, filename)
+    responses = summary_io.load_summary(filename)['responses']
+    assert type(responses[0]['status']) is int
+    assert type(responses[0]['itins'][1]['walk_limit_exceeded']) is bool
+    assert type(responses[0]['latency_ms']) is float and type(responses[2]['latency_ms']) is float
+
+
+def test_npz_empty_run(tmp_path):
+    filename = str(tmp_path / 'run.npz')
+    summary_io.write_npz({'notes': '', 'id': 1, 'responses': []}, filename)
+    assert summary_io.load_summary(filename) == {'notes': '', 'id': 1, 'responses': []}
+
+
+def test_column_projection(tmp_path):
+    filename = str(tmp_path / 'run.npz')
+    summary_io.write_npz(RUN, filename)
+    rows = list(summary_io.iter_responses(filename, columns=['id_tuple', 'itins.duration', 'debug.timedOut']))
+    assert rows == [
+        {'id_tuple': '1-2-3', 'debug': {'timedOut': False}, 'itins': [{'duration': 694}, {'duration': 720}]},
+        {'id_tuple': '1-2-4', 'debug': None},
+        {'id_tuple': u'1-2-5 ä', 'debug': {'timedOut': True}, 'itins': []},
+    ]
+    assert summary_io.load_column(filename, 'responses.itins@len').tolist() == [2, -1, 0]
+    assert summary_io.load_column(filename, 'responses.itins[].duration').tolist() == [694, 720]
+
+
+def test_jsonl_to_npz(tmp_path):
+    writer = write_jsonl(RUN, str(tmp_path))
+    writer.close()
+    npz_filename = writer.summary_filename[:-len('.jsonl')] + '.npz'
+    summary_io.write_npz(summary_io.load_summary(writer.summary_filename), npz_filename)
+    assert summary_io.load_summary(npz_filename)['responses'] == RUN['responses']
@@ -0,0 +1,80 @@
+import json
+import threading
+import time
+
+import pytest
+
+try:
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+except ImportError:
+    pytest.skip('the test server needs Python 3', allow_module_level=True)
+
+import telemetry
+
+ACTUATOR = {
+    'jvm.memory.used?tag=area:heap': [{'statistic': 'VALUE', 'value': 5e8}],
+    'jvm.gc.pause': [{'statistic': 'COUNT', 'value': 12}, {'statistic': 'TOTAL_TIME', 'value': 0.25},
+                     {'statistic': 'MAX', 'value': 0.05}],
+    'jvm.threads.live': [{'statistic': 'VALUE', 'value': 40}],
+    'process.cpu.usage': [{'statistic': 'VALUE', 'value': 0.5}],
+}
+
+
+class Handler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.startswith('/actuator/metrics/'):
+            body = {'measurements': ACTUATOR[self.path[len('/actuator/metrics/'):]]}
+        elif self.path == '/flat':
+            body = {'heap_used': 1000, 'threads': 20, 'up': True, 'name': 'router'}
+        else:
+            self.send_error(404)
+            return
+        body = json.dumps(body).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={'poll_interval': 0.05})
+    thread.daemon = True
+    thread.start()
+    yield 'http://127.0.0.1:%d' % httpd.server_address[1]
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_read_actuator(server):
+    assert telemetry.read_actuator(server + '/actuator/') == {'heap_used': 5e8, 'gc_pause_ms': 250.0, 'gc_count': 12,
+                                                              'threads': 40, 'cpu': 0.5}
+
+
+def test_read_flat_keeps_numbers(server):
+    assert telemetry.read_flat(server + '/flat') == {'heap_used': 1000, 'threads': 20}
+
+
+def test_sampler(server):
+    sampler = telemetry.TelemetrySampler(server + '/actuator', interval=0.05)
+    sampler.start()
+    time.sleep(0.3)
+    samples = sampler.stop()
+    assert len(samples) >= 3
+    assert all(sample['threads'] == 40 for sample in samples)
+    times = [sample['time'] for sample in samples]
+    assert times == sorted(times)
+    assert not sampler.is_alive()
+
+
+def test_sampler_records_errors(server):
+    sampler = telemetry.TelemetrySampler(server + '/missing', interval=0.05)
+    sampler.start()
+    time.sleep(0.1)
+    samples = sampler.stop()
+    assert samples and all('error' in sample and 'time' in sample for sample in samples)
@@ -0,0 +1,42 @@
+import numpy as np
+import pytest
+
+from vincenty import vincenty_inverse, vincenty_inverse_batch
+
+BOSTON = (42.3541165, -71.0693514)
+NEWYORK = (40.7791472, -73.9680804)
+
+
+def test_known_distances():
+    pairs = [((0.0, 0.0), (0.0, 1.0)), ((0.0, 0.0), (1.0, 0.0)), ((0.0, 0.0), (0.5, 179.5)), (BOSTON, NEWYORK)]
+    lat1, lon1, lat2, lon2 = np.array([p1 + p2 for p1, p2 in pairs]).T
+    dists, converged = vincenty_inverse_batch(lat1, lon1, lat2, lon2)
+    assert converged.all()
+    assert dists == pytest.approx([111.319491, 110.574389, 19936.288579, 298.396057], abs=1e-6)
+
+
+def test_coincident_and_diverging_pairs():
+    dists, converged = vincenty_inverse_batch([0.0, 0.0, 60.2], [0.0, 0.0, 24.9], [0.0, 0.5, 60.2], [0.0, 179.7, 24.9])
+    assert converged.tolist() == [True, False, True]
+    assert dists[0] == 0.0 and dists[2] == 0.0
+    assert np.isnan(dists[1])
+    assert vincenty_inverse((0.0, 0.0), (0.5, 179.7)) is None
+
+
+def test_batch_matches_scalar():
+    rnd = np.random.RandomState(1)
+    lat1, lat2 = rnd.uniform(-80, 80, (2, 500))
+    lon1, lon2 = rnd.uniform(-180, 180, (2, 500))
+    dists, converged = vincenty_inverse_batch(lat1, lon1, lat2, lon2)
+    for i in range(500):
+        expected = vincenty_inverse((lat1[i], lon1[i]), (lat2[i], lon2[i]))
+        if expected is None:
+            assert not converged[i]
+        else:
+            assert dists[i] == pytest.approx(expected, rel=1e-12, abs=1e-9)
+
+
+def test_broadcasts_one_point_against_many():
+    dists, converged = vincenty_inverse_batch(BOSTON[0], BOSTON[1], [BOSTON[0], NEWYORK[0]], [BOSTON[1], NEWYORK[1]])
+    assert dists.shape == (2,)
+    assert dists == pytest.approx([0.0, 298.396057], abs=1e-6)
@@ -1,6 +1,8 @@
 #https://github.com/maurycyp/vincenty
 import math
 
+import numpy as np
+
 # WGS 84
 a = 6378137  # meters
 f = 1 / 298.257223563
@@ -85,3 +87,79 @@ def vincenty_inverse(point1, point2):
     s /= 1000  # meters to kilometers
 
     return s
+
+
+def vincenty_inverse_batch(lat1, lon1, lat2, lon2):
+    """
+    Vectorized vincenty_inverse over NumPy arrays of coordinates in degrees.
+    All pairs are iterated together, each one stops updating when it has converged.
+    Returns (distances, converged): distances in kilometers, NaN where the iteration
+    did not converge (vincenty_inverse returns None there), and the boolean convergence mask.
+    """
+    lat1, lon1, lat2, lon2 = np.broadcast_arrays(*[np.asarray(x, dtype=np.float64) for x in (lat1, lon1, lat2, lon2)])
+
+    U1 = np.arctan((1 - f) * np.tan(np.radians(lat1)))
+    U2 = np.arctan((1 - f) * np.tan(np.radians(lat2)))
+    L = np.radians(lon2 - lon1)
+    Lambda = L.copy()
+
+    sinU1 = np.sin(U1)
+    cosU1 = np.cos(U1)
+    sinU2 = np.sin(U2)
+    cosU2 = np.cos(U2)
+
+    # coincident points are done before the first iteration
+    coincident = (lat1 == lat2) & (lon1 == lon2)
+    converged = coincident.copy()
+    active = ~coincident
+
+    shape = lat1.shape
+    sinSigma = np.zeros(shape)
+    cosSigma = np.ones(shape)
+    sigma = np.zeros(shape)
+    cosSqAlpha = np.ones(shape)
+    cos2SigmaM = np.zeros(shape)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for iteration in range(MAX_ITERATIONS):
+            if not active.any():
+                break
+            sinLambda = np.sin(Lambda[active])
+            cosLambda = np.cos(Lambda[active])
+            sinSigma_ = np.sqrt((cosU2[active] * sinLambda) ** 2 +
+                                (cosU1[active] * sinU2[active] - sinU1[active] * cosU2[active] * cosLambda) ** 2)
+            cosSigma_ = sinU1[active] * sinU2[active] + cosU1[active] * cosU2[active] * cosLambda
+            sigma_ = np.arctan2(sinSigma_, cosSigma_)
+            sinAlpha = cosU1[active] * cosU2[active] * sinLambda / sinSigma_
+            cosSqAlpha_ = 1 - sinAlpha ** 2
+            cos2SigmaM_ = np.where(cosSqAlpha_ == 0, 0.0, cosSigma_ - 2 * sinU1[active] * sinU2[active] / cosSqAlpha_)
+            C = f / 16 * cosSqAlpha_ * (4 + f * (4 - 3 * cosSqAlpha_))
+            LambdaPrev = Lambda[active]
+            Lambda_ = L[active] + (1 - C) * f * sinAlpha * (sigma_ + C * sinSigma_ *
+                                                        (cos2SigmaM_ + C * cosSigma_ *
+                                                         (-1 + 2 * cos2SigmaM_ ** 2)))
+            idx = np.flatnonzero(active)
+            sinSigma[idx] = sinSigma_
+            cosSigma[idx] = cosSigma_
+            sigma[idx] = sigma_
+            cosSqAlpha[idx] = cosSqAlpha_
+            cos2SigmaM[idx] = cos2SigmaM_
+            Lambda[idx] = Lambda_
+
+            # sinSigma == 0 means coincident points, which the scalar version returns as 0.0
+            done = (sinSigma_ == 0) | (np.abs(Lambda_ - LambdaPrev) < CONVERGENCE_THRESHOLD)
+            converged[idx[done]] = True
+            coincident[idx[sinSigma_ == 0]] = True
+            active[idx[done]] = False
+
+        uSq = cosSqAlpha * (a ** 2 - b ** 2) / (b ** 2)
+        A = 1 + uSq / 16384 * (4096 + uSq * (-768 + uSq * (320 - 175 * uSq)))
+        B = uSq / 1024 * (256 + uSq * (-128 + uSq * (74 - 47 * uSq)))
+        deltaSigma = B * sinSigma * (cos2SigmaM + B / 4 * (cosSigma *
+                     (-1 + 2 * cos2SigmaM ** 2) - B / 6 * cos2SigmaM *
+                     (-3 + 4 * sinSigma ** 2) * (-3 + 4 * cos2SigmaM ** 2)))
+        s = b * A * (sigma - deltaSigma) / 1000  # meters to kilometers
+
+    s[coincident] = 0.0
+    s[~converged] = np.nan
+    return s, converged